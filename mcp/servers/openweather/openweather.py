@@ -9,13 +9,48 @@ Author: MCPO Platform
 License: MIT
 """
 
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import FastMCP, Context, Image
+import asyncio
 import os
 import re
+import sys
+import random
+import json
+import gzip
+import bisect
+import mmap
+import struct
+import unicodedata
 import httpx
 import math
+import threading
+import time
+import atexit
+import itertools
+import operator
+import contextvars
+import argparse
+import hashlib
+import inspect
+import tempfile
+import sqlite3
+import base64
+import hmac
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from array import array
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, NamedTuple, TypedDict, Callable, Iterator
+
+try:
+    import orjson  # optional: faster decoding of upstream JSON payloads
+except ImportError:
+    orjson = None
 
 # Version information
 __version__ = "0.3.0"
@@ -28,11 +63,316 @@ app = FastMCP(
     version=__version__,
 )
 
-# Get API key from environment variable
-API_KEY = os.getenv("OPENWEATHER_API_KEY", "")
+# API keys from environment: a single OPENWEATHER_API_KEY and/or a comma-separated OPENWEATHER_API_KEYS pool
+API_KEYS = list(dict.fromkeys(
+    key.strip() for key in f"{os.getenv('OPENWEATHER_API_KEY', '')},{os.getenv('OPENWEATHER_API_KEYS', '')}".split(",")
+    if key.strip()
+))
+API_KEY = API_KEYS[0] if API_KEYS else ""
+KEY_CALLS_PER_MINUTE = int(os.getenv("KEY_CALLS_PER_MINUTE", "60"))  # per-key rate limit used for balancing
+KEY_BENCH_SECONDS = int(os.getenv("KEY_BENCH_SECONDS", "60"))  # how long a key sits out after a 429 (10x from a family after a 401)
+KEY_REJECTED_STATUSES = {401, 429}
 BASE_URL = "https://api.openweathermap.org/data/2.5"
 UNITS = os.getenv("UNITS", "imperial")  # imperial or metric
+CACHE_TTL = int(os.getenv("CACHE_TTL", "600"))  # seconds; OWM refreshes roughly every 10 minutes
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # parallel upstream requests per batch call
+MAX_BATCH_LOCATIONS = 20
+GROUP_BATCH_WINDOW_MS = float(os.getenv("GROUP_BATCH_WINDOW_MS", "0"))  # collect concurrent single-city fetches into one /group call (0 disables)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "text")  # default tool output: text or json
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "256"))
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "120"))  # seconds to remember unknown locations
+NOT_FOUND_STATUSES = {400, 404}
+DATA_DIR = os.getenv("OPENWEATHER_DATA_DIR", "/memory/mcp-servers/openweather")  # writable work dir
+CITY_LIST_URL = "https://bulk.openweathermap.org/sample/city.list.json.gz"
+CITY_LIST_PATH = os.getenv("CITY_LIST_PATH", os.path.join(DATA_DIR, "city.list.json.gz"))
+CITY_INDEX_PATH = os.path.join(DATA_DIR, "city_index.bin")
+QUOTA_WINDOW_HOURS = int(os.getenv("QUOTA_WINDOW_HOURS", "24"))  # rolling window for upstream call accounting
+QUOTA_SOFT_LIMIT = int(os.getenv("QUOTA_SOFT_LIMIT", "0"))  # upstream calls per window before cache-only mode (0 disables)
+QUOTA_FAMILY_LIMITS = os.getenv("QUOTA_FAMILY_LIMITS", "")  # per API family, e.g. "onecall=900,geo=5000"
+QUOTA_PATH = os.path.join(DATA_DIR, "quota.json")
+DEBUG = os.getenv("DEBUG", "false").lower() in ("1", "true", "yes")  # append a timing trailer to tool responses
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # JSONL file receiving one OTLP-style span per line (empty disables)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # fraction of tool calls to profile (0 disables)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # stack sampling interval
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+RECORD_FILE = os.getenv("RECORD_FILE", "")  # record tool calls and upstream responses here from startup (empty disables)
+RECORDING_DIR = os.path.join(DATA_DIR, "recordings")
+DELTA_THRESHOLDS = os.getenv("DELTA_THRESHOLDS", "")  # delta-mode overrides, e.g. "temp=0.5,humidity=10"
+ALERT_POLL_INTERVAL = int(os.getenv("ALERT_POLL_INTERVAL", "600"))  # seconds between alert watcher polls
+HISTORY_PATH = os.getenv("HISTORY_PATH", os.path.join(DATA_DIR, "history.sqlite"))  # observation store (empty disables)
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "30"))  # raw observations and hourly rollups kept this long; daily rollups are kept
+TILE_DIR = os.path.join(DATA_DIR, "tiles")
+TILE_CACHE_MB = int(os.getenv("TILE_CACHE_MB", "256"))  # disk budget of the map tile cache
+TILE_TTLS = os.getenv("TILE_TTLS", "")  # per layer tile lifetime in seconds, e.g. "precipitation=300,temp=3600"
+TILE_PREFETCH_RADIUS = int(os.getenv("TILE_PREFETCH_RADIUS", "1"))  # neighbor rings fetched after each tile (0 disables)
+ALERT_WATCH_MAX_LOCATIONS = int(os.getenv("ALERT_WATCH_MAX_LOCATIONS", "20"))  # each costs one One Call request per poll
+SHARD_PEERS = os.getenv("SHARD_PEERS", "")  # base URLs of all replicas, e.g. "http://127.0.0.1:9101,http://127.0.0.1:9102" (empty disables)
+SHARD_SELF = os.getenv("SHARD_SELF", "").strip().rstrip("/")  # this replica's URL in SHARD_PEERS; peer requests are served on its port
+SHARD_SECRET = os.getenv("SHARD_SECRET", "")  # token peers must present; required unless SHARD_SELF is a loopback address
+
+MISSING_API_KEY = "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY (or OPENWEATHER_API_KEYS) environment variable."
+
+# ---------------------------------------------------------------------------
+# Tracing: spans for each phase of a tool call, collected per call in a
+# context variable (so they follow asyncio.to_thread) and exported as
+# OTLP-style JSON lines and/or a DEBUG timing trailer
+# ---------------------------------------------------------------------------
+
+_active_trace: contextvars.ContextVar = contextvars.ContextVar("openweather_trace", default=None)
+_active_span: contextvars.ContextVar = contextvars.ContextVar("openweather_span", default="")
+_trace_file_lock = threading.Lock()
+
+def tracing_enabled() -> bool:
+    return DEBUG or bool(TRACE_FILE)
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a phase of the current tool call. Yields the span's attribute
+    dict so callers can annotate it; a no-op outside a traced call.
+    """
+    trace = _active_trace.get()
+    if trace is None:
+        yield attributes
+        return
+    span_id = os.urandom(8).hex()
+    token = _active_span.set(span_id)
+    start = time.time_ns()
+    try:
+        yield attributes
+    finally:
+        _active_span.reset(token)
+        trace["spans"].append({
+            "traceId": trace["trace_id"],
+            "spanId": span_id,
+            "parentSpanId": _active_span.get(),
+            "name": name,
+            "startTimeUnixNano": start,
+            "endTimeUnixNano": time.time_ns(),
+            "attributes": attributes,
+        })
+
+def traced(name: str) -> Callable:
+    """Decorator recording a span around every call of a helper."""
+    def decorate(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _active_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def export_trace(trace: dict) -> None:
+    """Append a finished trace's spans to TRACE_FILE, one JSON object per line."""
+    lines = "".join(json.dumps(record, separators=(",", ":"), default=str) + "\n" for record in trace["spans"])
+    try:
+        with _trace_file_lock, open(TRACE_FILE, "a") as f:
+            f.write(lines)
+    except OSError:
+        pass  # tracing must never fail a tool call
+
+def timing_breakdown(trace: dict) -> Tuple[float, List[Tuple[str, float]]]:
+    """Return the root span's duration and per-phase totals (ms), in order of first appearance."""
+    root = trace["spans"][-1]
+    phases: Dict[str, float] = {}
+    for record in sorted(trace["spans"][:-1], key=lambda record: record["startTimeUnixNano"]):
+        duration = (record["endTimeUnixNano"] - record["startTimeUnixNano"]) / 1e6
+        phases[record["name"]] = phases.get(record["name"], 0.0) + duration
+    return (root["endTimeUnixNano"] - root["startTimeUnixNano"]) / 1e6, list(phases.items())
+
+def append_timing(result: any, trace: dict) -> any:
+    """Append the DEBUG timing breakdown to a tool response (a "timing" key for JSON objects)."""
+    if not isinstance(result, str):
+        return result
+    total, phases = timing_breakdown(trace)
+    if result.startswith("{"):
+        try:
+            payload = json.loads(result)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            payload["timing"] = {"total_ms": round(total, 3), **{name: round(ms, 3) for name, ms in phases}}
+            return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    breakdown = " · ".join(f"{name} {ms:.2f}" for name, ms in phases)
+    return f"{result}\n\n⏱️ {total:.2f} ms total" + (f" | {breakdown} (ms)" if breakdown else "")
+
+# ---------------------------------------------------------------------------
+# Sampling profiler: a background thread snapshots Python stacks every
+# PROFILE_INTERVAL_MS and aggregates them as collapsed stacks, the input
+# format of flamegraph.pl and speedscope
+# ---------------------------------------------------------------------------
+
+PROFILE_FLUSH_INTERVAL = 60  # seconds between rewrites of the sampled-calls profile
+PROFILER_THREAD_NAME = "openweather-profiler"
+_profiled_threads: Dict[int, str] = {}  # thread id -> root label while a sampled call runs there
+_profiled_tasks: Dict[asyncio.Task, Tuple[asyncio.AbstractEventLoop, int, str]] = {}  # sampled async call -> (loop, thread id, root label)
+_profile_label: contextvars.ContextVar = contextvars.ContextVar("openweather_profile", default=None)
+_profilers: Dict[str, "StackSampler"] = {}  # "window" / "sampled" -> running sampler
+_profilers_lock = threading.Lock()
+
+def collapse_stack(frame) -> str:
+    """Render a frame chain root-first as "func (file:line);..." for collapsed-stack output."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def write_collapsed(path: str, counts: Counter) -> None:
+    """Write stack counts as "frame;frame;frame count" lines."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(temp_path, path)
+
+class StackSampler:
+    """
+    Wall-clock sampler for a set of threads. targets() returns the
+    {thread id: root label} to sample at each tick; samples are written
+    to path every flush_interval seconds and when the sampler stops.
+    """
+
+    def __init__(self, path: str, targets: Callable[[], Dict[int, str]], interval: float,
+                 duration: Optional[float] = None, flush_interval: Optional[float] = None):
+        self.path = path
+        self.targets = targets
+        self.interval = interval
+        self.deadline = time.monotonic() + duration if duration else None
+        self.flush_interval = flush_interval
+        self.counts: Counter = Counter()
+        self.ticks = 0
+        self.error = ""
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=PROFILER_THREAD_NAME, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def flush(self) -> None:
+        try:
+            write_collapsed(self.path, self.counts)
+            self.error = ""
+        except OSError as e:
+            self.error = str(e)
+
+    def _run(self) -> None:
+        flushed = time.monotonic()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, label in self.targets().items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.counts[f"{label};{collapse_stack(frame)}"] += 1
+            self.ticks += 1
+            now = time.monotonic()
+            if self.deadline is not None and now >= self.deadline:
+                break
+            if self.flush_interval and now - flushed >= self.flush_interval:
+                self.flush()
+                flushed = now
+        self.flush()
+
+def all_threads() -> Dict[int, str]:
+    """Sampling targets for a window profile: every live thread except the samplers, labelled by name."""
+    return {
+        thread.ident: f"thread:{thread.name}"
+        for thread in threading.enumerate()
+        if thread.ident and thread.name != PROFILER_THREAD_NAME
+    }
+
+def start_window_profile(seconds: float, interval_ms: float) -> StackSampler:
+    """Sample every thread for a fixed window; raises RuntimeError if one is already running."""
+    with _profilers_lock:
+        current = _profilers.get("window")
+        if current is not None and current.running:
+            raise RuntimeError(f"a profile is already being written to {current.path}")
+        path = os.path.join(PROFILE_DIR, f"window-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed")
+        sampler = _profilers["window"] = StackSampler(path, all_threads, interval_ms / 1000, duration=seconds)
+        sampler.start()
+        return sampler
+
+def sampled_call_threads() -> Dict[int, str]:
+    """
+    Sampling targets for sampled calls: threads running a sampled sync
+    call or one of its workers, plus an event-loop thread while the task
+    of a sampled async call is the one running on it (other tools' tasks
+    share that thread and must not be charged to the sampled call).
+    """
+    targets = dict(_profiled_threads)
+    for task, (loop, ident, label) in dict(_profiled_tasks).items():
+        if asyncio.current_task(loop) is task:
+            targets[ident] = label
+    return targets
+
+def profile_sampled_call(name: str, task: Optional[asyncio.Task] = None) -> Optional[any]:
+    """
+    Decide whether to profile this tool call (PROFILE_SAMPLE_RATE) and if
+    so register it: the task of an async call, else the calling thread.
+    Returns the registration to pass to end_sampled_call.
+    """
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    with _profilers_lock:
+        sampler = _profilers.get("sampled")
+        if sampler is None or not sampler.running:
+            path = os.path.join(PROFILE_DIR, f"sampled-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed")
+            sampler = _profilers["sampled"] = StackSampler(
+                path, sampled_call_threads, PROFILE_INTERVAL_MS / 1000,
+                flush_interval=PROFILE_FLUSH_INTERVAL,
+            )
+            sampler.start()
+    _profile_label.set(f"tool:{name}")
+    if task is not None:
+        _profiled_tasks[task] = (task.get_loop(), threading.get_ident(), f"tool:{name}")
+        return task
+    ident = threading.get_ident()
+    _profiled_threads[ident] = f"tool:{name}"
+    return ident
+
+def end_sampled_call(registration: any) -> None:
+    """Unregister a call registered by profile_sampled_call."""
+    if isinstance(registration, asyncio.Task):
+        _profiled_tasks.pop(registration, None)
+    else:
+        _profiled_threads.pop(registration, None)
+    _profile_label.set(None)
+
+def profiled_call(fn: Callable, *args):
+    """Run fn in a worker thread, attributing its samples to the sampled tool call that spawned it."""
+    label = _profile_label.get()
+    if label is None:
+        return fn(*args)
+    ident = threading.get_ident()
+    _profiled_threads[ident] = label
+    try:
+        return fn(*args)
+    finally:
+        _profiled_threads.pop(ident, None)
+
+def flush_profiles() -> None:
+    """Write out running profiles (also run at interpreter exit)."""
+    with _profilers_lock:
+        samplers = list(_profilers.values())
+    for sampler in samplers:
+        if sampler.counts:
+            sampler.flush()
 
+atexit.register(flush_profiles)
+
+@traced("clean_city_input")
 def clean_city_input(city_input: str) -> str:
     """
     Clean up city input to handle common issues:
@@ -75,650 +415,4968 @@ def format_date(timestamp: int, timezone_offset: int) -> str:
     dt = datetime.utcfromtimestamp(timestamp + timezone_offset)
     return dt.strftime("%A, %b %d")
 
-def make_http_request(url: str, timeout: int = 10) -> tuple[bool, any]:
+def parse_coordinates(location: str) -> Optional[Tuple[float, float]]:
+    """Return (lat, lon) if the input is a "lat,lon" pair, otherwise None."""
+    parts = location.split(",")
+    if len(parts) != 2:
+        return None
+    try:
+        lat, lon = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+# ---------------------------------------------------------------------------
+# Location canonicalization
+# ---------------------------------------------------------------------------
+
+# Country names and common aliases -> ISO 3166 alpha-2 code
+COUNTRY_CODES: Dict[str, str] = {
+    "united kingdom": "gb", "uk": "gb", "great britain": "gb", "britain": "gb",
+    "england": "gb", "scotland": "gb", "wales": "gb", "northern ireland": "gb",
+    "united states": "us", "united states of america": "us", "usa": "us", "u.s.": "us", "u.s.a.": "us", "america": "us",
+    "canada": "ca", "mexico": "mx", "brazil": "br", "argentina": "ar", "chile": "cl", "colombia": "co", "peru": "pe",
+    "france": "fr", "germany": "de", "deutschland": "de", "spain": "es", "españa": "es", "portugal": "pt",
+    "italy": "it", "italia": "it", "netherlands": "nl", "holland": "nl", "belgium": "be", "switzerland": "ch",
+    "austria": "at", "ireland": "ie", "denmark": "dk", "norway": "no", "sweden": "se", "finland": "fi",
+    "iceland": "is", "poland": "pl", "czech republic": "cz", "czechia": "cz", "hungary": "hu", "greece": "gr",
+    "turkey": "tr", "türkiye": "tr", "russia": "ru", "ukraine": "ua", "romania": "ro",
+    "china": "cn", "japan": "jp", "south korea": "kr", "korea": "kr", "india": "in", "pakistan": "pk",
+    "indonesia": "id", "thailand": "th", "vietnam": "vn", "philippines": "ph", "malaysia": "my",
+    "singapore": "sg", "taiwan": "tw", "hong kong": "hk", "australia": "au", "new zealand": "nz",
+    "egypt": "eg", "south africa": "za", "nigeria": "ng", "kenya": "ke", "morocco": "ma",
+    "israel": "il", "saudi arabia": "sa", "united arab emirates": "ae", "uae": "ae", "qatar": "qa", "iran": "ir",
+}
+
+# US state names -> postal abbreviation
+US_STATES: Dict[str, str] = {
+    "alabama": "al", "alaska": "ak", "arizona": "az", "arkansas": "ar", "california": "ca",
+    "colorado": "co", "connecticut": "ct", "delaware": "de", "district of columbia": "dc", "florida": "fl",
+    "georgia": "ga", "hawaii": "hi", "idaho": "id", "illinois": "il", "indiana": "in", "iowa": "ia",
+    "kansas": "ks", "kentucky": "ky", "louisiana": "la", "maine": "me", "maryland": "md",
+    "massachusetts": "ma", "michigan": "mi", "minnesota": "mn", "mississippi": "ms", "missouri": "mo",
+    "montana": "mt", "nebraska": "ne", "nevada": "nv", "new hampshire": "nh", "new jersey": "nj",
+    "new mexico": "nm", "new york": "ny", "north carolina": "nc", "north dakota": "nd", "ohio": "oh",
+    "oklahoma": "ok", "oregon": "or", "pennsylvania": "pa", "rhode island": "ri", "south carolina": "sc",
+    "south dakota": "sd", "tennessee": "tn", "texas": "tx", "utah": "ut", "vermont": "vt",
+    "virginia": "va", "washington": "wa", "west virginia": "wv", "wisconsin": "wi", "wyoming": "wy",
+}
+US_STATE_CODES = set(US_STATES.values())
+# State names that are also country names; resolved only when followed by the US
+AMBIGUOUS_STATE_NAMES = {"georgia"}
+
+# Free-text location key -> canonical key learned from upstream answers
+_location_aliases: Dict[str, str] = {}
+_location_aliases_lock = threading.Lock()
+
+def normalize_location_key(location: str) -> str:
     """
-    Make HTTP request using httpx.
-    Returns (success: bool, response_data_or_error: any)
+    Map a free-text location to a normalized "city[,state][,country]" key.
+    Case, whitespace, country names and US state names are normalized.
+    Two-letter codes are kept as given because many are both a US state
+    and a country (e.g. "AZ", "CA", "DE"); the alias table resolves them
+    once the API has answered. The same goes for state names that are
+    also countries ("Tbilisi, Georgia") unless the US is given after them.
     """
-    try:
-        with httpx.Client() as client:
-            response = client.get(url, timeout=timeout)
-            response.raise_for_status()
-            return True, response.json()
-    except Exception as e:
-        return False, str(e)
+    parts = [re.sub(r"\s+", " ", part).strip() for part in clean_city_input(location).lower().split(",")]
+    parts = [part for part in parts if part]
+    if not parts:
+        return ""
 
-@app.tool()
-def get_current_weather(city: str) -> str:
-    """Get current weather conditions for the specified city."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
-    
-    # Clean up the city input
-    city = clean_city_input(city)
+    city, rest = parts[0], parts[1:]
+    followed_by_us = len(rest) > 1 and COUNTRY_CODES.get(rest[1], rest[1]) == "us"
+    if rest and rest[0] in US_STATES and (rest[0] not in AMBIGUOUS_STATE_NAMES or followed_by_us):
+        rest = [US_STATES[rest[0]]] + (rest[1:] or ["us"])
+    rest = [COUNTRY_CODES.get(part, part) for part in rest]
+    return ",".join([city] + rest)
 
-    # Make HTTP request
-    url = f"{BASE_URL}/weather?q={city}&appid={API_KEY}&units={UNITS}"
-    success, data = make_http_request(url, timeout=10)
+def canonical_location_key(location: str) -> str:
+    """Return the canonical cache key for a location, following learned aliases."""
+    key = normalize_location_key(location)
+    with _location_aliases_lock:
+        return _location_aliases.get(key, key)
 
-    if not success:
-        return f"Error fetching weather data: {data}"
+def response_location(data: any) -> Optional[Tuple[str, str]]:
+    """Return (name, country) from a /weather, /forecast or geocoding response."""
+    if isinstance(data, list):
+        data = data[0] if data and isinstance(data[0], dict) else {}
+        return (data["name"], data.get("country", "")) if "name" in data else None
+    if not isinstance(data, dict):
+        return None
+    if isinstance(data.get("city"), dict) and "name" in data["city"]:
+        return data["city"]["name"], data["city"].get("country", "")
+    if "name" in data and isinstance(data.get("sys"), dict):
+        return data["name"], data["sys"].get("country", "")
+    return None
 
-    try:
-        # Extract data
-        weather_desc = data["weather"][0]["description"].capitalize()
-        temp = data["main"]["temp"]
-        feels_like = data["main"]["feels_like"]
-        humidity = data["main"]["humidity"]
-        wind_speed = data["wind"]["speed"]
-        wind_deg = data["wind"].get("deg", 0)
-        pressure = data["main"]["pressure"]
-        visibility = data.get("visibility", 0) / 1000  # convert to km
-        sunrise = format_time(data["sys"]["sunrise"], data.get("timezone", 0))
-        sunset = format_time(data["sys"]["sunset"], data.get("timezone", 0))
-        
-        # Format response
-        unit_symbol = "°C" if UNITS == "metric" else "°F"
-        distance_unit = "km" if UNITS == "metric" else "mi"
-        
-        return f"""
-Current Weather for {data["name"]}, {data.get("sys", {}).get("country", "")}:
-🌡️ {weather_desc}, {temp}{unit_symbol} (Feels like: {feels_like}{unit_symbol})
-💧 Humidity: {humidity}%
-💨 Wind: {format_wind(wind_speed, wind_deg, UNITS)}
-🔍 Visibility: {visibility:.1f} {distance_unit}
-🌅 Sunrise: {sunrise}
-🌇 Sunset: {sunset}
-        """.strip()
+def remember_location_alias(location_key: str, data: any) -> Optional[str]:
+    """
+    Learn a more specific canonical key from an upstream answer, e.g.
+    "london" -> "london,gb" or "phoenix,az" -> "phoenix,az,us", so later
+    spellings of the same place share one cache entry.
+    Returns the canonical key learned, or None.
+    """
+    resolved = response_location(data)
+    if not location_key or not resolved or not resolved[1]:
+        return None
+    name, country = resolved[0].lower(), resolved[1].lower()
+    parts = location_key.split(",")
+    if parts[0] != name:
+        return None
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing weather data: {str(e)}"
+    if len(parts) == 1:
+        canonical = f"{name},{country}"
+    elif len(parts) == 2 and country == "us" and parts[1] in US_STATE_CODES:
+        canonical = f"{name},{parts[1]},us"
+    else:
+        return None
 
-@app.tool()
-def get_forecast(city: str, days: int = 5) -> str:
-    """Get weather forecast for the specified city for up to 5 days."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
-    
-    # Clean up the city input
-    city = clean_city_input(city)
-    
-    if days < 1:
-        days = 1
-    if days > 5:
-        days = 5
+    with _location_aliases_lock:
+        if location_key not in _location_aliases and len(_location_aliases) >= CACHE_MAX_ENTRIES:
+            del _location_aliases[next(iter(_location_aliases))]
+        _location_aliases[location_key] = canonical
+    return canonical
 
-    # Make HTTP request
-    url = f"{BASE_URL}/forecast?q={city}&appid={API_KEY}&units={UNITS}"
-    success, data = make_http_request(url, timeout=10)
+def canonical_url(url: str, location_key: str, canonical: str) -> Optional[str]:
+    """Rewrite the q= parameter of a name query from its alias to its canonical key, or None if url has none."""
+    rewritten = re.sub(rf"([?&]q=){re.escape(location_key)}(?=&|$)", lambda match: match.group(1) + canonical, url, count=1)
+    return rewritten if rewritten != url else None
 
-    if not success:
-        return f"Error fetching forecast data: {data}"
+class LocationInput(NamedTuple):
+    """A parsed location argument"""
+    kind: str                                # "name", "coords", "id" or "zip"
+    key: str                                 # cache and negative-cache key
+    query: str                               # location parameters for /weather and /forecast
+    coords: Optional[Tuple[float, float]]    # known coordinates, if given
 
-    try:
-        # Group forecast by day
-        forecasts_by_day = {}
-        timezone_offset = data.get("city", {}).get("timezone", 0)
-        
-        for item in data["list"]:
-            dt = datetime.utcfromtimestamp(item["dt"] + timezone_offset)
-            day_key = dt.strftime("%Y-%m-%d")
-            
-            if day_key not in forecasts_by_day:
-                forecasts_by_day[day_key] = []
-            
-            forecasts_by_day[day_key].append(item)
-        
-        # Format response
-        result = f"5-Day Forecast for {data['city']['name']}, {data['city']['country']}:\n\n"
-        
-        for i, (day, forecasts) in enumerate(list(forecasts_by_day.items())[:days]):
-            if i >= days:
-                break
-                
-            day_date = format_date(forecasts[0]["dt"], timezone_offset)
-            result += f"📅 {day_date}:\n"
-            
-            # Get min/max temps and most common weather condition for the day
-            temps = [f["main"]["temp"] for f in forecasts]
-            min_temp = min(temps)
-            max_temp = max(temps)
-            
-            # Count weather conditions to find the most common
-            conditions = {}
-            for f in forecasts:
-                cond = f["weather"][0]["description"].capitalize()
-                conditions[cond] = conditions.get(cond, 0) + 1
-            
-            most_common = max(conditions.items(), key=lambda x: x[1])[0]
-            
-            unit_symbol = "°C" if UNITS == "metric" else "°F"
-            result += f"   {most_common}, {min_temp:.1f}{unit_symbol} to {max_temp:.1f}{unit_symbol}\n"
-            
-            # Add some time-specific details
-            for f in forecasts[::2]:  # Take every other forecast to reduce verbosity
-                time = format_time(f["dt"], timezone_offset)
-                temp = f["main"]["temp"]
-                cond = f["weather"][0]["description"].capitalize()
-                result += f"   • {time}: {temp:.1f}{unit_symbol}, {cond}\n"
-            
-            result += "\n"
-        
-        return result.strip()
+CITY_ID_PATTERN = re.compile(r"^(?:id\s*[=:]\s*)?(\d+)$", re.IGNORECASE)
+ZIP_PATTERN = re.compile(r"^zip\s*[=:]\s*([a-z0-9 -]+?)\s*(?:,\s*([a-z]{2}))?$", re.IGNORECASE)
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing forecast data: {e}"
+@traced("parse_location")
+def parse_location(location: str) -> LocationInput:
+    """
+    Classify a location argument: a "lat,lon" pair, an OWM city ID
+    ("2643743" or "id=2643743"), a postal code ("zip=94040,us", country
+    defaulting to us) or a free-text city name.
+    """
+    location = location.strip()
+    coords = parse_coordinates(location)
+    if coords:
+        return LocationInput("coords", f"{coords[0]},{coords[1]}", f"lat={coords[0]}&lon={coords[1]}", coords)
 
-@app.tool()
-def check_openweather_status() -> str:
-    """Check the status of the OpenWeather tool and its dependencies."""
-    status_lines = []
-    status_lines.append("OpenWeather Tool Status:")
-    status_lines.append("=" * 30)
+    match = CITY_ID_PATTERN.match(location)
+    if match:
+        return LocationInput("id", f"id={match.group(1)}", f"id={match.group(1)}", None)
 
-    # Version information
-    status_lines.append(f"📦 Version: {__version__}")
-    status_lines.append(f"👤 Author: {__author__}")
-    status_lines.append(f"📄 License: {__license__}")
+    match = ZIP_PATTERN.match(location)
+    if match:
+        code = f"{match.group(1).replace(' ', '').lower()},{(match.group(2) or 'us').lower()}"
+        return LocationInput("zip", f"zip={code}", f"zip={code}", None)
 
-    # Check API key
-    if API_KEY:
-        status_lines.append("✅ API Key: Configured")
-    else:
-        status_lines.append("❌ API Key: Missing (set OPENWEATHER_API_KEY)")
+    key = canonical_location_key(location)
+    return LocationInput("name", key, f"q={key}", None)
 
-    # Check HTTP client availability
-    try:
-        import httpx
-        status_lines.append(f"✅ HTTP client: httpx {httpx.__version__} available")
-    except ImportError:
-        status_lines.append("❌ HTTP client: httpx not available")
+def place_name(name: str, country: str) -> str:
+    """Join a place name and country code, skipping an empty country."""
+    return f"{name}, {country}" if country else name
 
-    # Check units setting
-    status_lines.append(f"⚙️  Units: {UNITS}")
+# Shared HTTP client and response cache
+_http_client: Optional[httpx.Client] = None
+_http_client_lock = threading.Lock()
+_response_cache: Dict[str, Tuple[float, any, int]] = {}  # url -> (expires, data, version)
+_response_cache_lock = threading.Lock()
+_payload_versions = itertools.count(1)
 
-    # Check UV environment
-    status_lines.append("✅ Dependencies: Managed by UV")
+def get_http_client() -> httpx.Client:
+    """Return the shared, connection-pooled HTTP client (created on first use)."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        with _http_client_lock:
+            if _http_client is None or _http_client.is_closed:
+                _http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=max(BATCH_CONCURRENCY * 2, 10),
+                        max_keepalive_connections=max(BATCH_CONCURRENCY, 5),
+                    )
+                )
+    return _http_client
 
-    return "\n".join(status_lines)
+def _cache_entry(url: str) -> Optional[Tuple[float, any, int]]:
+    """Return the fresh cache entry for a URL, dropping it if expired. Caller holds the lock."""
+    entry = _response_cache.get(url)
+    if entry is not None and entry[0] < time.monotonic():
+        del _response_cache[url]
+        invalidate_renders(url)
+        return None
+    return entry
 
-@app.tool()
-def get_openweather_version() -> str:
-    """Get version information for the OpenWeather MCP server."""
-    return f"""
-OpenWeather MCP Server
-Version: {__version__}
-Author: {__author__}
-License: {__license__}
+def cache_get(url: str) -> Optional[any]:
+    """Return a cached response body if it is still fresh."""
+    with _response_cache_lock:
+        entry = _cache_entry(url)
+        return entry[1] if entry else None
 
-Features:
-• Current weather conditions
-• 5-day weather forecasts
-• Weather alerts and warnings
-• Air quality index and pollution data
-• Detailed astronomy data (sunrise, sunset, moon phases)
-• Multi-city weather comparison
-• Weather-based activity recommendations
-• Multiple unit systems (imperial/metric)
-• Comprehensive error handling
-• UV-based dependency management
+def cache_get_with_ttl(url: str) -> Optional[Tuple[any, float]]:
+    """Return a cached response body and its remaining lifetime in seconds, if it is still fresh."""
+    with _response_cache_lock:
+        entry = _cache_entry(url)
+        return (entry[1], entry[0] - time.monotonic()) if entry else None
 
-Last updated: 2024-12-08
-    """.strip()
+def payload_version(url: str) -> Optional[int]:
+    """Return the version of the cached payload for a URL, or None if it is not cached."""
+    with _response_cache_lock:
+        entry = _cache_entry(url)
+        return entry[2] if entry else None
 
-@app.tool()
-def get_weather_alerts(city: str) -> str:
-    """Get weather alerts and warnings for the specified city."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
+def cache_put(url: str, data: any, ttl: Optional[float] = None) -> None:
+    """
+    Store a response body under a new payload version for ttl seconds
+    (default CACHE_TTL), evicting the oldest entries when full.
+    """
+    if CACHE_TTL <= 0:
+        return
+    with _response_cache_lock:
+        _response_cache.pop(url, None)
+        while len(_response_cache) >= CACHE_MAX_ENTRIES:
+            oldest = next(iter(_response_cache))
+            del _response_cache[oldest]
+            invalidate_renders(oldest)
+        _response_cache[url] = (time.monotonic() + (CACHE_TTL if ttl is None else ttl), data, next(_payload_versions))
+    invalidate_renders(url)
 
-    # Clean up the city input
-    city = clean_city_input(city)
+# Rendered tool responses keyed on (tool, urls, payload versions, units, variant)
+_render_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_render_keys_by_url: Dict[str, set] = {}
+_render_cache_lock = threading.Lock()
+_render_stats = {"hits": 0, "misses": 0}
 
-    # First get coordinates for the city
-    geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={API_KEY}"
-    success, geo_data = make_http_request(geo_url, timeout=10)
+def invalidate_renders(url: str) -> None:
+    """Drop every rendered response built from the payload at this URL."""
+    with _render_cache_lock:
+        for key in _render_keys_by_url.pop(url, ()):
+            _render_cache.pop(key, None)
 
-    if not success or not geo_data:
-        return f"Error: Could not find coordinates for {city}"
+def cached_render(tool: str, urls: Tuple[str, ...], variant: tuple, build: Callable[[], str]) -> str:
+    """
+    Return a memoized rendering of a tool response.
+    Responses are only memoized while every source payload is cached;
+    refreshing any of them invalidates the rendering.
+    """
+    versions = tuple(payload_version(url) for url in urls)
+    if RENDER_CACHE_MAX_ENTRIES <= 0 or None in versions:
+        return build()
 
-    lat = geo_data[0]["lat"]
-    lon = geo_data[0]["lon"]
+    key = (tool, urls, versions, UNITS, variant)
+    with _render_cache_lock:
+        rendered = _render_cache.get(key)
+        if rendered is not None:
+            _render_cache.move_to_end(key)
+            _render_stats["hits"] += 1
+            return rendered
+        _render_stats["misses"] += 1
 
-    # Get weather alerts using One Call API
-    alerts_url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={API_KEY}&exclude=minutely,hourly,daily"
-    success, data = make_http_request(alerts_url, timeout=10)
+    rendered = build()
 
-    if not success:
-        return f"Error fetching weather alerts: {data}"
+    with _render_cache_lock:
+        _render_cache[key] = rendered
+        for url in urls:
+            _render_keys_by_url.setdefault(url, set()).add(key)
+        while len(_render_cache) > RENDER_CACHE_MAX_ENTRIES:
+            evicted, _ = _render_cache.popitem(last=False)
+            for url in evicted[1]:
+                keys = _render_keys_by_url.get(url)
+                if keys is not None:
+                    keys.discard(evicted)
+                    if not keys:
+                        del _render_keys_by_url[url]
+    return rendered
+
+# Negative cache for locations the API could not find
+_negative_cache: Dict[str, float] = {}  # location key -> expires
+_negative_cache_lock = threading.Lock()
+_negative_hits: Counter = Counter()      # retries answered from the negative cache
+_not_found_counts: Counter = Counter()   # not-found answers received from upstream
+NEGATIVE_COUNTER_LIMIT = 1000
+
+def negative_cache_remaining(location_key: str) -> Optional[int]:
+    """Seconds until a not-found location may be retried upstream, or None if not cached."""
+    with _negative_cache_lock:
+        expires = _negative_cache.get(location_key)
+        if expires is None:
+            return None
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            del _negative_cache[location_key]
+            return None
+        _negative_hits[location_key] += 1
+        return math.ceil(remaining)
 
+def negative_cache_put(location_key: str) -> None:
+    """Remember that the API could not find a location."""
+    with _negative_cache_lock:
+        _not_found_counts[location_key] += 1
+        if NEGATIVE_CACHE_TTL <= 0:
+            return
+        now = time.monotonic()
+        if len(_negative_cache) >= CACHE_MAX_ENTRIES:
+            for key in [key for key, expires in _negative_cache.items() if expires <= now]:
+                del _negative_cache[key]
+            while len(_negative_cache) >= CACHE_MAX_ENTRIES:
+                del _negative_cache[next(iter(_negative_cache))]
+        _negative_cache[location_key] = now + NEGATIVE_CACHE_TTL
+        # Keep the counters bounded to the worst offenders
+        for counter in (_negative_hits, _not_found_counts):
+            if len(counter) > NEGATIVE_COUNTER_LIMIT * 2:
+                kept = counter.most_common(NEGATIVE_COUNTER_LIMIT)
+                counter.clear()
+                counter.update(dict(kept))
+
+# Upstream quota accounting per API family, in one-minute buckets over a
+# rolling window that is persisted to QUOTA_PATH across restarts
+API_FAMILIES = (
+    ("tile.openweathermap.org", "tile"),
+    ("/data/3.0/onecall", "onecall"),
+    ("/geo/", "geo"),
+    ("/data/2.5/air_pollution", "air_pollution"),
+    ("/data/2.5/", "data"),
+)
+QUOTA_FLUSH_INTERVAL = 30  # seconds between writes of the usage file
+_quota_buckets: Dict[str, "OrderedDict[int, int]"] = {}  # family -> {minute: calls}
+_quota_totals: Counter = Counter()  # family -> calls inside the window
+_quota_lock = threading.Lock()
+_quota_state = {"loaded": False, "dirty": False, "saved_at": 0.0, "error": ""}
+
+def parse_family_limits(spec: str) -> Dict[str, int]:
+    """Parse "family=limit,..." into a dict, ignoring malformed entries."""
+    limits = {}
+    for item in spec.split(","):
+        family, _, limit = item.partition("=")
+        if family.strip() and limit.strip().isdigit():
+            limits[family.strip()] = int(limit)
+    return limits
+
+FAMILY_LIMITS = parse_family_limits(QUOTA_FAMILY_LIMITS)
+
+def api_family(url: str) -> str:
+    """Classify an upstream URL into the API family its quota is billed against."""
+    for marker, family in API_FAMILIES:
+        if marker in url:
+            return family
+    return "other"
+
+def _prune_quota(now_minute: int) -> None:
+    """Drop buckets that have left the rolling window. Caller holds the lock."""
+    oldest = now_minute - QUOTA_WINDOW_HOURS * 60
+    for family, buckets in _quota_buckets.items():
+        while buckets and next(iter(buckets)) <= oldest:
+            _, calls = buckets.popitem(last=False)
+            _quota_totals[family] -= calls
+
+def _load_quota() -> None:
+    """Load persisted usage on first use. Caller holds the lock."""
+    _quota_state["loaded"] = True
     try:
-        alerts = data.get("alerts", [])
+        with open(QUOTA_PATH) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        _quota_state["error"] = f"could not read {QUOTA_PATH}: {e}"
+        return
+    for family, buckets in saved.get("families", {}).items():
+        ordered = OrderedDict(sorted((int(minute), int(calls)) for minute, calls in buckets.items()))
+        _quota_buckets[family] = ordered
+        _quota_totals[family] = sum(ordered.values())
+    _prune_quota(int(time.time() // 60))
 
-        if not alerts:
-            return f"🟢 No weather alerts for {geo_data[0]['name']}, {geo_data[0].get('country', '')}"
+def _save_quota() -> None:
+    """Write usage to disk atomically. Caller holds the lock."""
+    snapshot = {"families": {family: {str(minute): calls for minute, calls in buckets.items()}
+                             for family, buckets in _quota_buckets.items() if buckets}}
+    try:
+        os.makedirs(os.path.dirname(QUOTA_PATH) or ".", exist_ok=True)
+        temp_path = f"{QUOTA_PATH}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, QUOTA_PATH)
+        _quota_state["error"] = ""
+    except OSError as e:
+        _quota_state["error"] = f"could not write {QUOTA_PATH}: {e}"
+    _quota_state["dirty"] = False
+    _quota_state["saved_at"] = time.monotonic()
 
-        result = f"⚠️ Weather Alerts for {geo_data[0]['name']}, {geo_data[0].get('country', '')}:\n\n"
+def flush_quota() -> None:
+    """Persist pending usage counts (also run at interpreter exit)."""
+    with _quota_lock:
+        if _quota_state["dirty"]:
+            _save_quota()
 
-        for i, alert in enumerate(alerts, 1):
-            sender = alert.get("sender_name", "Weather Service")
-            event = alert.get("event", "Weather Alert")
-            start = datetime.utcfromtimestamp(alert["start"]).strftime("%Y-%m-%d %H:%M UTC")
-            end = datetime.utcfromtimestamp(alert["end"]).strftime("%Y-%m-%d %H:%M UTC")
-            description = alert.get("description", "No description available")
+atexit.register(flush_quota)
 
-            # Determine alert emoji based on event type
-            alert_emoji = "🌪️" if "tornado" in event.lower() else \
-                         "⛈️" if any(word in event.lower() for word in ["storm", "thunder", "lightning"]) else \
-                         "🌨️" if any(word in event.lower() for word in ["snow", "blizzard", "ice"]) else \
-                         "🌊" if "flood" in event.lower() else \
-                         "🔥" if "fire" in event.lower() else \
-                         "💨" if "wind" in event.lower() else "⚠️"
+def quota_record(family: str) -> None:
+    """Count one upstream call against an API family."""
+    minute = int(time.time() // 60)
+    with _quota_lock:
+        if not _quota_state["loaded"]:
+            _load_quota()
+        buckets = _quota_buckets.setdefault(family, OrderedDict())
+        buckets[minute] = buckets.get(minute, 0) + 1
+        _quota_totals[family] += 1
+        _prune_quota(minute)
+        _quota_state["dirty"] = True
+        if time.monotonic() - _quota_state["saved_at"] >= QUOTA_FLUSH_INTERVAL:
+            _save_quota()
 
-            result += f"{alert_emoji} Alert #{i}: {event}\n"
-            result += f"📅 From: {start}\n"
-            result += f"📅 To: {end}\n"
-            result += f"📡 Source: {sender}\n"
-            result += f"📝 Details: {description[:200]}{'...' if len(description) > 200 else ''}\n\n"
+def quota_block_reason(family: str) -> Optional[str]:
+    """Return why upstream calls for a family are suspended, or None if they are allowed."""
+    if QUOTA_SOFT_LIMIT <= 0 and family not in FAMILY_LIMITS:
+        return None
+    with _quota_lock:
+        if not _quota_state["loaded"]:
+            _load_quota()
+        _prune_quota(int(time.time() // 60))
+        total = sum(_quota_totals.values())
+        if 0 < QUOTA_SOFT_LIMIT <= total:
+            return f"{total}/{QUOTA_SOFT_LIMIT} upstream calls in the last {QUOTA_WINDOW_HOURS}h"
+        limit = FAMILY_LIMITS.get(family, 0)
+        if 0 < limit <= _quota_totals[family]:
+            return f"{_quota_totals[family]}/{limit} {family} calls in the last {QUOTA_WINDOW_HOURS}h"
+    return None
 
-        return result.strip()
+class QuotaUsage(TypedDict):
+    family: str
+    calls: int
+    last_hour: int
+    projected: int
+    limit: int
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing weather alerts: {str(e)}"
+class QuotaReport(TypedDict):
+    window_hours: int
+    calls: int
+    last_hour: int
+    projected: int
+    soft_limit: int
+    hours_to_limit: Optional[float]
+    cache_only: bool
+    families: List[QuotaUsage]
+    keys: List["ApiKeyUsage"]
 
-@app.tool()
-def get_air_quality(city: str) -> str:
-    """Get air quality index and pollution data for the specified city."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
+def quota_report() -> QuotaReport:
+    """
+    Summarize usage in the rolling window. The burn rate is the number
+    of calls in the last hour; projections extrapolate it over the window.
+    """
+    minute = int(time.time() // 60)
+    with _quota_lock:
+        if not _quota_state["loaded"]:
+            _load_quota()
+        _prune_quota(minute)
+        families = []
+        for family in sorted(_quota_buckets):
+            buckets = _quota_buckets[family]
+            last_hour = 0
+            for bucket in reversed(buckets):
+                if bucket <= minute - 60:
+                    break
+                last_hour += buckets[bucket]
+            families.append(QuotaUsage(
+                family=family,
+                calls=_quota_totals[family],
+                last_hour=last_hour,
+                projected=last_hour * QUOTA_WINDOW_HOURS,
+                limit=FAMILY_LIMITS.get(family, 0),
+            ))
 
-    # Clean up the city input
-    city = clean_city_input(city)
+    calls = sum(usage["calls"] for usage in families)
+    last_hour = sum(usage["last_hour"] for usage in families)
+    hours_to_limit = None
+    if QUOTA_SOFT_LIMIT > 0 and last_hour:
+        hours_to_limit = round(max(0, QUOTA_SOFT_LIMIT - calls) / last_hour, 1)
+    cache_only = (0 < QUOTA_SOFT_LIMIT <= calls) or any(
+        0 < usage["limit"] <= usage["calls"] for usage in families)
+    return QuotaReport(
+        window_hours=QUOTA_WINDOW_HOURS,
+        calls=calls,
+        last_hour=last_hour,
+        projected=last_hour * QUOTA_WINDOW_HOURS,
+        soft_limit=QUOTA_SOFT_LIMIT,
+        hours_to_limit=hours_to_limit,
+        cache_only=cache_only,
+        families=families,
+        keys=api_key_usage(),
+    )
 
-    # First get coordinates for the city
-    geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={API_KEY}"
-    success, geo_data = make_http_request(geo_url, timeout=10)
+# Rolling latency samples and cache counters for live status diagnostics
+LATENCY_SAMPLES = 512  # most recent calls kept per tool / API family
+_tool_latencies: Dict[str, deque] = {}      # tool name -> seconds
+_upstream_latencies: Dict[str, deque] = {}  # API family -> seconds
+_upstream_errors: Counter = Counter()       # API family -> failed calls
+_response_cache_stats = {"hits": 0, "misses": 0}
+_latency_lock = threading.Lock()
 
-    if not success or not geo_data:
-        return f"Error: Could not find coordinates for {city}"
+def record_latency(samples: Dict[str, deque], name: str, seconds: float) -> None:
+    """Append a duration to a bounded per-name sample window."""
+    with _latency_lock:
+        window = samples.get(name)
+        if window is None:
+            window = samples[name] = deque(maxlen=LATENCY_SAMPLES)
+        window.append(seconds)
 
-    lat = geo_data[0]["lat"]
-    lon = geo_data[0]["lon"]
+def latency_percentiles(samples: Dict[str, deque]) -> Dict[str, Tuple[int, float, float, float]]:
+    """Return {name: (sample count, p50, p95, p99)} in milliseconds."""
+    with _latency_lock:
+        snapshot = {name: sorted(window) for name, window in samples.items() if window}
+    return {
+        name: (len(values), *(percentile(values, q) * 1000 for q in (50, 95, 99)))
+        for name, values in sorted(snapshot.items())
+    }
 
-    # Get air quality data
-    aqi_url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={API_KEY}"
-    success, data = make_http_request(aqi_url, timeout=10)
+def start_trace() -> Tuple[Optional[dict], Optional[contextvars.Token]]:
+    """Begin collecting spans for a tool call when tracing is enabled."""
+    if not tracing_enabled():
+        return None, None
+    trace = {"trace_id": os.urandom(16).hex(), "spans": []}
+    return trace, _active_trace.set(trace)
 
-    if not success:
-        return f"Error fetching air quality data: {data}"
+def finish_trace(trace: Optional[dict], token: Optional[contextvars.Token], result: any) -> any:
+    """Export a finished trace and, in DEBUG mode, add the timing trailer to the result."""
+    if trace is None:
+        return result
+    _active_trace.reset(token)
+    if TRACE_FILE:
+        export_trace(trace)
+    return append_timing(result, trace) if DEBUG else result
+
+def timed_tool(fn: Callable) -> Callable:
+    """
+    Record the wall-clock duration of every call to a tool and, when
+    tracing is enabled, wrap the call in a root span. Calls are also
+    appended to the traffic recording, if one is active.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if _recorder is not None:
+                _recorder.record_call(fn, args, kwargs)
+            trace, token = start_trace()
+            profiled = profile_sampled_call(fn.__name__, asyncio.current_task())
+            start = time.perf_counter()
+            try:
+                if trace is None:
+                    return await fn(*args, **kwargs)
+                with span(f"tool:{fn.__name__}"):
+                    result = await fn(*args, **kwargs)
+            finally:
+                record_latency(_tool_latencies, fn.__name__, time.perf_counter() - start)
+                if profiled is not None:
+                    end_sampled_call(profiled)
+            return finish_trace(trace, token, result)
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _recorder is not None:
+            _recorder.record_call(fn, args, kwargs)
+        trace, token = start_trace()
+        profiled = profile_sampled_call(fn.__name__)
+        start = time.perf_counter()
+        try:
+            if trace is None:
+                return fn(*args, **kwargs)
+            with span(f"tool:{fn.__name__}"):
+                result = fn(*args, **kwargs)
+        finally:
+            record_latency(_tool_latencies, fn.__name__, time.perf_counter() - start)
+            if profiled is not None:
+                end_sampled_call(profiled)
+        return finish_trace(trace, token, result)
+    return wrapper
 
+def connection_pool_state() -> Optional[Tuple[int, int]]:
+    """Return (open, idle) connections in the shared client's pool, if the transport exposes them."""
+    client = _http_client
+    if client is None or client.is_closed:
+        return 0, 0
     try:
-        aqi_data = data["list"][0]
-        aqi_index = aqi_data["main"]["aqi"]
-        components = aqi_data["components"]
-
-        # AQI level descriptions
-        aqi_levels = {
-            1: ("🟢 Good", "Air quality is satisfactory"),
-            2: ("🟡 Fair", "Air quality is acceptable for most people"),
-            3: ("🟠 Moderate", "Sensitive individuals may experience minor issues"),
-            4: ("🔴 Poor", "Everyone may experience health effects"),
-            5: ("🟣 Very Poor", "Health warnings of emergency conditions")
-        }
+        connections = client._transport._pool.connections
+        return len(connections), sum(1 for connection in connections if connection.is_idle())
+    except AttributeError:
+        return None
 
-        level, description = aqi_levels.get(aqi_index, ("❓ Unknown", "Unknown air quality level"))
-
-        result = f"🌬️ Air Quality for {geo_data[0]['name']}, {geo_data[0].get('country', '')}:\n\n"
-        result += f"📊 Overall AQI: {level} (Level {aqi_index}/5)\n"
-        result += f"📝 {description}\n\n"
-        result += "🧪 Pollutant Concentrations (μg/m³):\n"
-        result += f"• CO (Carbon Monoxide): {components.get('co', 'N/A')}\n"
-        result += f"• NO (Nitrogen Monoxide): {components.get('no', 'N/A')}\n"
-        result += f"• NO₂ (Nitrogen Dioxide): {components.get('no2', 'N/A')}\n"
-        result += f"• O₃ (Ozone): {components.get('o3', 'N/A')}\n"
-        result += f"• SO₂ (Sulfur Dioxide): {components.get('so2', 'N/A')}\n"
-        result += f"• PM2.5 (Fine Particles): {components.get('pm2_5', 'N/A')}\n"
-        result += f"• PM10 (Coarse Particles): {components.get('pm10', 'N/A')}\n"
-        result += f"• NH₃ (Ammonia): {components.get('nh3', 'N/A')}\n"
-
-        # Add health recommendations
-        if aqi_index >= 4:
-            result += "\n⚠️ Health Recommendations:\n"
-            result += "• Limit outdoor activities\n"
-            result += "• Wear a mask when outside\n"
-            result += "• Keep windows closed\n"
-            result += "• Use air purifiers indoors\n"
-        elif aqi_index == 3:
-            result += "\n💡 Recommendations:\n"
-            result += "• Sensitive individuals should limit outdoor activities\n"
-            result += "• Consider wearing a mask during exercise\n"
+def probe_upstream(timeout: float = 5) -> Tuple[Optional[float], str]:
+    """
+    Measure the round trip to the API with an unauthenticated request.
+    The API answers 401 without doing any work, and the call does not
+    count against the key's quota. Returns (milliseconds or None, outcome).
+    """
+    start = time.perf_counter()
+    try:
+        response = get_http_client().get(f"{BASE_URL}/weather", timeout=timeout)
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+    return (time.perf_counter() - start) * 1000, f"HTTP {response.status_code}"
 
-        return result
+# API key pool: requests go to the active key with the most per-minute
+# quota left; keys answering 429 are benched for a while, and keys
+# answering 401 only from the API family that refused them (a free key
+# is refused by One Call 3.0 but still serves current weather)
+ALL_FAMILIES = "*"
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing air quality data: {str(e)}"
+class ApiKeyState:
+    """Usage and health of one API key in the pool."""
 
-@app.tool()
-def get_astronomy_data(city: str) -> str:
-    """Get detailed astronomy data including sunrise, sunset, moon phase, and solar position."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
+    def __init__(self, key: str):
+        self.key = key
+        self.recent: deque = deque()  # monotonic times of calls in the last minute
+        self.calls = 0
+        self.rejections: Counter = Counter()  # status code -> count
+        self.benched_until: Dict[str, float] = {}  # API family (or ALL_FAMILIES) -> monotonic time
 
-    # Clean up the city input
-    city = clean_city_input(city)
+    @property
+    def label(self) -> str:
+        return f"…{self.key[-4:]}"
 
-    # Get current weather data for basic astronomy info
-    url = f"{BASE_URL}/weather?q={city}&appid={API_KEY}&units={UNITS}"
-    success, data = make_http_request(url, timeout=10)
+    def remaining(self, now: float) -> int:
+        """Calls left in the current one-minute window."""
+        while self.recent and self.recent[0] <= now - 60:
+            self.recent.popleft()
+        return KEY_CALLS_PER_MINUTE - len(self.recent)
 
-    if not success:
-        return f"Error fetching astronomy data: {data}"
+    def benched_for(self, family: str, now: float) -> float:
+        """Seconds until the key may serve the family again (0 when active)."""
+        until = max(self.benched_until.get(family, 0.0), self.benched_until.get(ALL_FAMILIES, 0.0))
+        return max(0.0, until - now)
 
-    try:
-        timezone_offset = data.get("timezone", 0)
-        sunrise_ts = data["sys"]["sunrise"]
-        sunset_ts = data["sys"]["sunset"]
-
-        # Calculate additional astronomy data
-        now = datetime.utcnow()
-        sunrise = datetime.utcfromtimestamp(sunrise_ts)
-        sunset = datetime.utcfromtimestamp(sunset_ts)
-
-        # Calculate day length
-        day_length = sunset - sunrise
-        hours = day_length.seconds // 3600
-        minutes = (day_length.seconds % 3600) // 60
-
-        # Calculate solar noon (midpoint between sunrise and sunset)
-        solar_noon = sunrise + (sunset - sunrise) / 2
-
-        # Simple moon phase calculation (approximate)
-        # This is a simplified calculation - for production, you'd want a more accurate algorithm
-        days_since_new_moon = (now - datetime(2000, 1, 6)).days % 29.53
-
-        if days_since_new_moon < 1:
-            moon_phase = "🌑 New Moon"
-        elif days_since_new_moon < 7.4:
-            moon_phase = "🌒 Waxing Crescent"
-        elif days_since_new_moon < 8.4:
-            moon_phase = "🌓 First Quarter"
-        elif days_since_new_moon < 14.8:
-            moon_phase = "🌔 Waxing Gibbous"
-        elif days_since_new_moon < 15.8:
-            moon_phase = "🌕 Full Moon"
-        elif days_since_new_moon < 22.1:
-            moon_phase = "🌖 Waning Gibbous"
-        elif days_since_new_moon < 23.1:
-            moon_phase = "🌗 Last Quarter"
-        else:
-            moon_phase = "🌘 Waning Crescent"
-
-        # Calculate illumination percentage (approximate)
-        illumination = abs(math.cos((days_since_new_moon / 29.53) * 2 * math.pi)) * 100
-
-        result = f"🌌 Astronomy Data for {data['name']}, {data.get('sys', {}).get('country', '')}:\n\n"
-        result += f"🌅 Sunrise: {format_time(sunrise_ts, timezone_offset)}\n"
-        result += f"🌇 Sunset: {format_time(sunset_ts, timezone_offset)}\n"
-        result += f"☀️ Solar Noon: {format_time(int(solar_noon.timestamp()), timezone_offset)}\n"
-        result += f"⏰ Day Length: {hours}h {minutes}m\n\n"
-        result += f"🌙 Moon Phase: {moon_phase}\n"
-        result += f"💡 Moon Illumination: {illumination:.1f}%\n\n"
-
-        # Calculate if it's currently day or night
-        current_time = datetime.utcnow()
-        if sunrise <= current_time <= sunset:
-            time_to_sunset = sunset - current_time
-            hours_to_sunset = time_to_sunset.seconds // 3600
-            minutes_to_sunset = (time_to_sunset.seconds % 3600) // 60
-            result += f"☀️ Currently: Daytime\n"
-            result += f"🌇 Sunset in: {hours_to_sunset}h {minutes_to_sunset}m\n"
-        else:
-            # Calculate time to next sunrise
-            if current_time > sunset:
-                next_sunrise = sunrise + timedelta(days=1)
-            else:
-                next_sunrise = sunrise
+_api_keys = [ApiKeyState(key) for key in API_KEYS]
+_api_keys_lock = threading.Lock()
 
-            time_to_sunrise = next_sunrise - current_time
-            hours_to_sunrise = time_to_sunrise.seconds // 3600
-            minutes_to_sunrise = (time_to_sunrise.seconds % 3600) // 60
-            result += f"🌙 Currently: Nighttime\n"
-            result += f"🌅 Sunrise in: {hours_to_sunrise}h {minutes_to_sunrise}m\n"
+def acquire_api_key(family: str, exclude: Tuple[ApiKeyState, ...] = ()) -> Optional[ApiKeyState]:
+    """Charge one call to the key with the most remaining quota that is active for the family, or return None."""
+    now = time.monotonic()
+    with _api_keys_lock:
+        candidates = [state for state in _api_keys if not state.benched_for(family, now) and state not in exclude]
+        if not candidates:
+            return None
+        state = max(candidates, key=lambda candidate: (candidate.remaining(now), -candidate.calls))
+        state.recent.append(now)
+        state.calls += 1
+        return state
 
-        return result
+def bench_api_key(state: ApiKeyState, response: httpx.Response, family: str) -> None:
+    """
+    Take a key out of rotation after a 429, or out of the family's rotation
+    after a 401, honoring Retry-After when given.
+    """
+    status = response.status_code
+    duration = KEY_BENCH_SECONDS * (10 if status == 401 else 1)
+    retry_after = str(getattr(response, "headers", {}).get("Retry-After", ""))
+    if retry_after.isdigit():
+        duration = int(retry_after)
+    scope = family if status == 401 else ALL_FAMILIES
+    with _api_keys_lock:
+        state.rejections[status] += 1
+        state.benched_until[scope] = max(state.benched_until.get(scope, 0.0), time.monotonic() + duration)
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing astronomy data: {str(e)}"
+def api_keys_retry_in(family: str) -> int:
+    """Seconds until the first key benched for the family returns to rotation."""
+    now = time.monotonic()
+    with _api_keys_lock:
+        return math.ceil(min((state.benched_for(family, now) for state in _api_keys), default=0))
 
-@app.tool()
-def compare_weather(cities: str) -> str:
-    """Compare current weather conditions between multiple cities (comma-separated)."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
+class ApiKeyUsage(TypedDict):
+    key: str
+    calls: int
+    last_minute: int
+    remaining: int
+    rejected: Dict[str, int]
+    benched_for: int  # seconds out of every family's rotation (429)
+    benched_families: Dict[str, int]  # API family -> seconds out of its rotation (401)
 
-    # Parse cities from comma-separated string
-    city_list = [city.strip() for city in cities.split(",") if city.strip()]
+def api_key_usage() -> List[ApiKeyUsage]:
+    """Per-key usage for reporting; keys are masked to their last four characters."""
+    now = time.monotonic()
+    with _api_keys_lock:
+        return [
+            ApiKeyUsage(
+                key=state.label,
+                calls=state.calls,
+                last_minute=KEY_CALLS_PER_MINUTE - state.remaining(now),
+                remaining=max(0, state.remaining(now)),
+                rejected={str(status): count for status, count in sorted(state.rejections.items())},
+                benched_for=math.ceil(state.benched_for(ALL_FAMILIES, now)),
+                benched_families={
+                    family: math.ceil(until - now)
+                    for family, until in sorted(state.benched_until.items())
+                    if family != ALL_FAMILIES and until > now
+                },
+            )
+            for state in _api_keys
+        ]
 
-    if len(city_list) < 2:
-        return "Error: Please provide at least 2 cities separated by commas (e.g., 'London, Paris, Tokyo')"
+# ---------------------------------------------------------------------------
+# Traffic recording and replay: a recorder appends anonymized tool calls
+# and the upstream responses they caused to a gzipped JSONL file; the
+# replayer re-issues the calls on their original schedule (or faster)
+# with upstream requests answered from the recording
+# ---------------------------------------------------------------------------
 
-    if len(city_list) > 5:
-        return "Error: Maximum 5 cities allowed for comparison"
+RECORD_FLUSH_EVERY = 50  # records between gzip sync flushes, so a crash loses little
+RECORD_SKIPPED_TOOLS = ("record_traffic", "profile_server", "shard_membership")  # admin tools are not part of the load
+REPLAY_SCALED_SETTINGS = ("CACHE_TTL", "NEGATIVE_CACHE_TTL", "KEY_BENCH_SECONDS", "ALERT_POLL_INTERVAL")
+PRECISE_NUMBER_PATTERN = re.compile(r"-?\d+\.\d{3,}")
+URL_COORDINATE_PATTERN = re.compile(r"\b(lat|lon)=(-?\d+(?:\.\d+)?)")
+BODY_COORDINATE_PATTERN = re.compile(r'"(lat|lon)":\s*(-?\d+(?:\.\d+)?)')
 
-    weather_data = []
+def round_coordinate(value: str) -> str:
+    """Round a coordinate to 2 decimals (about 1 km), the precision kept in recordings."""
+    return repr(round(float(value), 2))
 
-    # Fetch weather for each city
-    for city in city_list:
-        city = clean_city_input(city)
-        url = f"{BASE_URL}/weather?q={city}&appid={API_KEY}&units={UNITS}"
-        success, data = make_http_request(url, timeout=10)
+def anonymize_url(url: str) -> str:
+    """Round lat/lon query parameters; recorded and replayed URLs are matched in this form."""
+    return URL_COORDINATE_PATTERN.sub(lambda m: f"{m.group(1)}={round_coordinate(m.group(2))}", url)
 
-        if success:
-            try:
-                weather_info = {
-                    "name": f"{data['name']}, {data.get('sys', {}).get('country', '')}",
-                    "temp": data["main"]["temp"],
-                    "feels_like": data["main"]["feels_like"],
-                    "humidity": data["main"]["humidity"],
-                    "pressure": data["main"]["pressure"],
-                    "wind_speed": data["wind"]["speed"],
-                    "description": data["weather"][0]["description"].capitalize(),
-                    "visibility": data.get("visibility", 0) / 1000
-                }
-                weather_data.append(weather_info)
-            except (KeyError, ValueError):
-                weather_data.append({"name": city, "error": "Failed to parse weather data"})
-        else:
-            weather_data.append({"name": city, "error": f"Failed to fetch data: {data}"})
+class TrafficRecorder:
+    """
+    Appends one JSON object per line to a gzip file:
+      {"k": "call", "t": seconds since start, "tool": name, "args": {...}}
+      {"k": "body", "id": n, "body": text}     (each distinct body once;
+                                               binary bodies as "b64")
+      {"k": "upstream", "t": ..., "url": url, "status": code, "ms": latency, "body": n}
+    Session names become pseudonyms and coordinates are rounded to 2
+    decimals in arguments, URLs and bodies. URLs are recorded unsigned.
+    """
 
-    if not weather_data:
-        return "Error: Could not fetch weather data for any of the specified cities"
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.calls = 0
+        self.responses = 0
+        self._started = time.monotonic()
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._bodies: Dict[bytes, int] = {}
+        self._sessions: Dict[str, str] = {}
+        self._unflushed = 0
 
-    # Format comparison
-    unit_symbol = "°C" if UNITS == "metric" else "°F"
-    speed_unit = "m/s" if UNITS == "metric" else "mph"
+    def _write(self, record: dict) -> None:
+        """Write one record. Caller holds the lock."""
+        self._file.write(json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n")
+        self._unflushed += 1
+        if self._unflushed >= RECORD_FLUSH_EVERY:
+            self._file.flush()
+            self._unflushed = 0
 
-    result = f"🌍 Weather Comparison for {len(weather_data)} Cities:\n\n"
+    def _anonymize(self, name: str, value: any) -> any:
+        if name == "session" and value:
+            with self._lock:
+                return self._sessions.setdefault(value, f"session-{len(self._sessions) + 1}")
+        if isinstance(value, str):
+            return PRECISE_NUMBER_PATTERN.sub(lambda m: round_coordinate(m.group()), value)
+        if isinstance(value, (list, tuple)):
+            return [self._anonymize(name, item) for item in value]
+        return value
 
-    # Create a formatted table
-    for i, data in enumerate(weather_data, 1):
-        if "error" in data:
-            result += f"{i}. ❌ {data['name']}: {data['error']}\n\n"
-            continue
+    def record_call(self, fn: Callable, args: tuple, kwargs: dict) -> None:
+        if fn.__name__ in RECORD_SKIPPED_TOOLS:
+            return
+        try:
+            bound = inspect.signature(fn).bind_partial(*args, **kwargs).arguments
+        except TypeError:
+            return  # the call itself will fail with a clearer error
+        record = {
+            "k": "call",
+            "t": round(time.monotonic() - self._started, 3),
+            "tool": fn.__name__,
+            "args": {name: self._anonymize(name, value) for name, value in bound.items() if name != "ctx"},
+        }
+        with self._lock:
+            if not self._file.closed:
+                self._write(record)
+                self.calls += 1
 
-        result += f"{i}. 📍 {data['name']}:\n"
-        result += f"   🌡️ {data['temp']:.1f}{unit_symbol} (feels like {data['feels_like']:.1f}{unit_symbol})\n"
-        result += f"   🌤️ {data['description']}\n"
-        result += f"   💧 Humidity: {data['humidity']}%\n"
-        result += f"   💨 Wind: {data['wind_speed']:.1f} {speed_unit}\n"
-        result += f"   👁️ Visibility: {data['visibility']:.1f} km\n"
-        result += f"   🔍 Pressure: {data['pressure']} hPa\n\n"
+    def record_upstream(self, url: str, status: int, content: bytes, seconds: float) -> None:
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        with self._lock:
+            if self._file.closed:
+                return
+            body_id = self._bodies.get(digest)
+            if body_id is None:
+                body_id = self._bodies[digest] = len(self._bodies)
+                try:
+                    text = content.decode("utf-8")
+                except UnicodeDecodeError:  # map tiles
+                    self._write({"k": "body", "id": body_id, "b64": base64.b64encode(content).decode("ascii")})
+                else:
+                    self._write({"k": "body", "id": body_id,
+                                 "body": BODY_COORDINATE_PATTERN.sub(lambda m: f'"{m.group(1)}":{round_coordinate(m.group(2))}', text)})
+            self._write({"k": "upstream", "t": round(time.monotonic() - self._started, 3), "url": anonymize_url(url),
+                         "status": status, "ms": round(seconds * 1000, 1), "body": body_id})
+            self.responses += 1
 
-    # Add some comparison insights
-    valid_data = [d for d in weather_data if "error" not in d]
-    if len(valid_data) >= 2:
-        temps = [d["temp"] for d in valid_data]
-        humidities = [d["humidity"] for d in valid_data]
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
 
-        hottest = max(valid_data, key=lambda x: x["temp"])
-        coldest = min(valid_data, key=lambda x: x["temp"])
-        most_humid = max(valid_data, key=lambda x: x["humidity"])
+_recorder: Optional[TrafficRecorder] = TrafficRecorder(RECORD_FILE) if RECORD_FILE else None
+_recorder_lock = threading.Lock()
 
-        result += "📊 Comparison Highlights:\n"
-        result += f"🔥 Hottest: {hottest['name']} ({hottest['temp']:.1f}{unit_symbol})\n"
-        result += f"🧊 Coldest: {coldest['name']} ({coldest['temp']:.1f}{unit_symbol})\n"
-        result += f"💧 Most Humid: {most_humid['name']} ({most_humid['humidity']}%)\n"
-        result += f"📈 Temperature Range: {max(temps) - min(temps):.1f}{unit_symbol}\n"
+def stop_recording() -> Optional[TrafficRecorder]:
+    """Stop the active recorder (also run at interpreter exit) and return it."""
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+    return recorder
 
-    return result
+atexit.register(stop_recording)
 
-@app.tool()
-def get_weather_recommendations(city: str) -> str:
-    """Get activity recommendations based on current weather conditions."""
-    if not API_KEY:
-        return "Error: OpenWeatherMap API key not configured. Set OPENWEATHER_API_KEY environment variable."
+class RecordedCall(NamedTuple):
+    """One tool call from a recording"""
+    t: float
+    tool: str
+    args: dict
 
-    # Clean up the city input
-    city = clean_city_input(city)
+class ReplaySource:
+    """Answers upstream requests from a recording, in recorded order per URL."""
 
-    # Get current weather data
-    url = f"{BASE_URL}/weather?q={city}&appid={API_KEY}&units={UNITS}"
-    success, data = make_http_request(url, timeout=10)
+    def __init__(self, responses: Dict[str, deque], speed: float):
+        self.responses = responses
+        self.speed = speed
+        self.served = 0
+        self.missing: Counter = Counter()
+        self._lock = threading.Lock()
 
-    if not success:
-        return f"Error fetching weather data: {data}"
+    def fetch(self, url: str) -> httpx.Response:
+        key = anonymize_url(url)
+        with self._lock:
+            queue = self.responses.get(key)
+            if not queue:
+                self.missing[api_family(url)] += 1
+                raise LookupError(f"no recorded response for {key}")
+            status, body, latency_ms = queue.popleft() if len(queue) > 1 else queue[0]  # the last answer repeats
+            self.served += 1
+        time.sleep(latency_ms / 1000 / self.speed)
+        return httpx.Response(status, content=body, request=httpx.Request("GET", url))
+
+_replay: Optional[ReplaySource] = None
+
+def fetch_upstream(url: str, key: str, timeout: int) -> httpx.Response:
+    """Send one signed upstream request, or answer it from the replayed recording."""
+    if _replay is not None:
+        return _replay.fetch(url)
+    separator = "&" if "?" in url else "?"
+    return get_http_client().get(f"{url}{separator}appid={key}", timeout=timeout)
+
+def load_recording(path: str) -> Tuple[List[RecordedCall], Dict[str, deque]]:
+    """
+    Read a recording into (calls in time order, {url: deque of (status,
+    body bytes, latency ms)}). A recording cut off mid-write, e.g. by a
+    crash, is read up to the last complete record.
+    """
+    calls: List[RecordedCall] = []
+    bodies: Dict[int, bytes] = {}
+    responses: Dict[str, deque] = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                kind = record.get("k")
+                if kind == "call":
+                    calls.append(RecordedCall(record["t"], record["tool"], record["args"]))
+                elif kind == "body":
+                    bodies[record["id"]] = (
+                        base64.b64decode(record["b64"]) if "b64" in record else record["body"].encode("utf-8")
+                    )
+                elif kind == "upstream":
+                    responses.setdefault(record["url"], deque()).append(
+                        (record["status"], bodies.get(record["body"], b""), record.get("ms", 0.0))
+                    )
+        except EOFError:
+            pass
+    calls.sort(key=lambda call: call.t)
+    return calls, responses
+
+async def replay_calls(calls: List[RecordedCall], speed: float) -> Counter:
+    """Issue calls on their recorded schedule divided by speed; returns outcome counts per tool."""
+    outcomes: Counter = Counter()
+    loop_start = time.monotonic()
+
+    async def issue(call: RecordedCall) -> None:
+        tool = globals().get(call.tool)
+        if not callable(tool):
+            outcomes[f"{call.tool} (unknown tool)"] += 1
+            return
+        try:
+            if asyncio.iscoroutinefunction(tool):
+                result = await tool(**call.args)
+            else:
+                result = await asyncio.to_thread(tool, **call.args)
+        except Exception as e:
+            result = f"Error: {e}"
+        failed = isinstance(result, str) and (result.startswith("Error") or '"error"' in result[:200])
+        outcomes[f"{call.tool} {'error' if failed else 'ok'}"] += 1
+
+    tasks = []
+    for call in calls:
+        delay = call.t / speed - (time.monotonic() - loop_start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(issue(call)))
+    await asyncio.gather(*tasks)
+    return outcomes
+
+def replay_traffic(path: str, speed: float = 1.0) -> str:
+    """
+    Replay a recording in this process against its recorded upstream
+    responses and report latency and cache behaviour. Time-based
+    settings (REPLAY_SCALED_SETTINGS) are divided by speed so cache
+    expiry keeps its relation to the traffic; quota usage, history, map
+    tiles and the city index go to a scratch directory, and an active
+    traffic recorder is suspended until the replay ends.
+    """
+    global _replay, _recorder, _tile_cache, QUOTA_PATH, HISTORY_PATH, TILE_DIR, CITY_INDEX_PATH, API_KEY
+    speed = max(speed, 0.001)
+    try:
+        calls, responses = load_recording(path)
+    except OSError as e:
+        return f"Error: could not read {path}: {e}"
+    if not calls:
+        return f"Error: {path} contains no tool calls"
+
+    _replay = ReplaySource(responses, speed)
+    scratch = tempfile.mkdtemp(prefix="openweather-replay-")
+    QUOTA_PATH = os.path.join(scratch, "quota.json")
+    HISTORY_PATH = os.path.join(scratch, "history.sqlite") if HISTORY_PATH else ""
+    TILE_DIR = os.path.join(scratch, "tiles")
+    _tile_cache = TileCache(TILE_DIR, TILE_CACHE_MB * 1024 * 1024)
+    CITY_INDEX_PATH = os.path.join(scratch, "city_index.bin")  # built from a local CITY_LIST_PATH, never downloaded
+    if not API_KEYS:
+        API_KEYS.append("replay")
+        API_KEY = "replay"
+        _api_keys.append(ApiKeyState("replay"))
+    for name in REPLAY_SCALED_SETTINGS:
+        globals()[name] = globals()[name] / speed
 
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    start = time.perf_counter()
     try:
-        temp = data["main"]["temp"]
-        humidity = data["main"]["humidity"]
-        wind_speed = data["wind"]["speed"]
-        weather_main = data["weather"][0]["main"].lower()
-        weather_desc = data["weather"][0]["description"].lower()
-        visibility = data.get("visibility", 10000) / 1000  # convert to km
-
-        unit_symbol = "°C" if UNITS == "metric" else "°F"
-        temp_threshold_hot = 25 if UNITS == "metric" else 77
-        temp_threshold_cold = 10 if UNITS == "metric" else 50
-        wind_threshold = 5 if UNITS == "metric" else 11  # m/s vs mph
-
-        result = f"🎯 Activity Recommendations for {data['name']}, {data.get('sys', {}).get('country', '')}:\n"
-        result += f"Current: {temp:.1f}{unit_symbol}, {data['weather'][0]['description'].capitalize()}\n\n"
-
-        recommendations = []
-        warnings = []
-
-        # Temperature-based recommendations
-        if temp >= temp_threshold_hot:
-            recommendations.extend([
-                "🏊‍♀️ Swimming or water activities",
-                "🍦 Enjoy ice cream or cold drinks",
-                "🌳 Seek shade in parks or gardens",
-                "🏠 Indoor activities during peak heat"
-            ])
-            if temp > (35 if UNITS == "metric" else 95):
-                warnings.append("🔥 Extreme heat - limit outdoor exposure")
-        elif temp <= temp_threshold_cold:
-            recommendations.extend([
-                "☕ Hot drinks and cozy indoor activities",
-                "🧥 Layer up for outdoor activities",
-                "🔥 Fireplace or heating activities",
-                "🏠 Indoor sports and entertainment"
-            ])
-            if temp < (0 if UNITS == "metric" else 32):
-                warnings.append("🧊 Freezing conditions - dress warmly")
-        else:
-            recommendations.extend([
-                "🚶‍♀️ Perfect for walking or hiking",
-                "🚴‍♂️ Great cycling weather",
-                "🏃‍♀️ Ideal for outdoor exercise"
-            ])
-
-        # Weather condition-based recommendations
-        if "rain" in weather_main or "drizzle" in weather_main:
-            recommendations.extend([
-                "☔ Bring an umbrella",
-                "🏛️ Visit museums or indoor attractions",
-                "📚 Perfect reading weather",
-                "🎬 Movie theater or indoor entertainment"
-            ])
-            warnings.append("🌧️ Wet conditions - drive carefully")
-        elif "snow" in weather_main:
-            recommendations.extend([
-                "⛷️ Skiing or snowboarding",
-                "⛄ Build a snowman",
-                "🛷 Sledding activities",
-                "❄️ Winter photography"
-            ])
-            warnings.append("🌨️ Snowy conditions - check road conditions")
-        elif "clear" in weather_main or "sun" in weather_desc:
-            recommendations.extend([
-                "📸 Perfect for photography",
-                "🌻 Outdoor picnics",
-                "🏖️ Beach or outdoor activities",
-                "🌅 Sunrise/sunset viewing"
-            ])
-        elif "cloud" in weather_main:
-            recommendations.extend([
-                "🚶‍♀️ Comfortable for walking",
-                "🏃‍♀️ Good for outdoor exercise",
-                "📸 Great for landscape photography"
-            ])
-        elif "storm" in weather_main or "thunder" in weather_desc:
-            recommendations.extend([
-                "🏠 Stay indoors",
-                "📱 Charge devices in case of power outage",
-                "🎮 Indoor games and entertainment"
-            ])
-            warnings.append("⛈️ Severe weather - avoid outdoor activities")
-
-        # Wind-based recommendations
-        if wind_speed > wind_threshold:
-            recommendations.append("🪁 Great for kite flying")
-            if wind_speed > wind_threshold * 2:
-                warnings.append("💨 Strong winds - secure loose objects")
-
-        # Humidity-based recommendations
-        if humidity > 80:
-            recommendations.append("💧 High humidity - stay hydrated")
-            warnings.append("🌫️ Muggy conditions - take breaks in AC")
-        elif humidity < 30:
-            recommendations.append("🧴 Low humidity - use moisturizer")
-
-        # Visibility-based recommendations
-        if visibility < 1:
-            warnings.append("🌫️ Poor visibility - drive with caution")
-        elif visibility > 10:
-            recommendations.append("👁️ Excellent visibility for sightseeing")
-
-        # Format output
-        if recommendations:
-            result += "✅ Recommended Activities:\n"
-            for rec in recommendations[:8]:  # Limit to top 8 recommendations
-                result += f"• {rec}\n"
-            result += "\n"
+        outcomes = asyncio.run(replay_calls(calls, speed))
+    finally:
+        with _recorder_lock:
+            _recorder = recorder
+    elapsed = time.perf_counter() - start
 
-        if warnings:
-            result += "⚠️ Weather Warnings:\n"
-            for warning in warnings:
-                result += f"• {warning}\n"
-            result += "\n"
+    hits, misses = _response_cache_stats["hits"], _response_cache_stats["misses"]
+    lines = [
+        f"🔁 Replayed {len(calls)} calls from {path} at {speed:g}x in {elapsed:.1f}s "
+        f"(recorded span {calls[-1].t:.1f}s)",
+        f"🗄️  Response cache: {hits} hits, {misses} misses ({hits / max(1, hits + misses):.0%} hit ratio)",
+        f"🌐 Upstream: {_replay.served} answered from the recording, {sum(_replay.missing.values())} not recorded"
+        + (f" ({', '.join(f'{family} {count}' for family, count in _replay.missing.most_common())})" if _replay.missing else ""),
+        "⏱️  Tool latency (ms, most recent 512 calls per tool):",
+    ]
+    for name, (count, p50, p95, p99) in latency_percentiles(_tool_latencies).items():
+        lines.append(f"   {name}: p50 {p50:.2f} · p95 {p95:.2f} · p99 {p99:.2f} ({count} samples)")
+    lines.append("📋 Outcomes: " + ", ".join(f"{name} {count}" for name, count in sorted(outcomes.items())))
+    return "\n".join(lines)
 
-        # Add clothing suggestions
-        result += "👕 Clothing Suggestions:\n"
-        if temp >= temp_threshold_hot:
-            result += "• Light, breathable clothing\n• Sun hat and sunglasses\n• Sunscreen\n"
-        elif temp <= temp_threshold_cold:
-            result += "• Warm layers\n• Jacket or coat\n• Gloves and hat\n"
-        else:
-            result += "• Comfortable casual clothing\n• Light jacket if needed\n"
+def signed_get(url: str, family: str, timeout: int) -> Tuple[Optional[httpx.Response], str]:
+    """
+    Send one upstream request signed with a key from the pool. A key
+    answering 429 is benched (after a 401, only from this family) and the
+    request retried on the next key.
+    Every attempt is counted against the family's quota; past the soft
+    limit nothing is sent. Returns (response, "") on success, otherwise
+    (the failing response or None, error message with keys masked).
+    """
+    blocked = quota_block_reason(family)
+    if blocked:
+        return None, f"Upstream quota soft limit reached ({blocked}); serving cached data only"
 
-        if "rain" in weather_main:
-            result += "• Waterproof jacket\n• Umbrella\n"
+    tried: Tuple[ApiKeyState, ...] = ()
+    error, failed = "", None
+    while True:
+        key_state = acquire_api_key(family, tried)
+        if key_state is None:
+            if tried:
+                return failed, error
+            return None, f"All API keys are benched for {family} after 401/429 responses (retry in {api_keys_retry_in(family)}s)"
+        tried += (key_state,)
+        quota_record(family)
 
-        return result.strip()
+        start = time.perf_counter()
+        try:
+            with span("fetch", family=family, key=key_state.label) as attributes:
+                response = fetch_upstream(url, key_state.key, timeout)
+                attributes["status"] = response.status_code
+            elapsed = time.perf_counter() - start
+            record_latency(_upstream_latencies, family, elapsed)
+            if _recorder is not None:
+                _recorder.record_upstream(url, response.status_code, response.content, elapsed)
+            response.raise_for_status()
+            return response, ""
+        except httpx.HTTPStatusError as e:
+            _upstream_errors[family] += 1
+            error, failed = str(e).replace(key_state.key, "***"), e.response
+            if e.response.status_code in KEY_REJECTED_STATUSES:
+                bench_api_key(key_state, e.response, family)
+                continue  # retry once per remaining key
+            return failed, error
+        except Exception as e:
+            _upstream_errors[family] += 1
+            return None, str(e).replace(key_state.key, "***")
 
-    except (KeyError, ValueError) as e:
-        return f"Error parsing weather data for recommendations: {str(e)}"
+# ---------------------------------------------------------------------------
+# Micro-batching: concurrent /weather fetches for cities with a known OWM ID
+# are collected for GROUP_BATCH_WINDOW_MS and sent as one /group request
+# ---------------------------------------------------------------------------
 
-if __name__ == "__main__":
-    app.run()
+GROUP_MAX_IDS = 20  # city IDs accepted by one /group call
+
+# Location key -> OWM city ID learned from /weather answers, so later
+# fetches of a named city can join a /group batch
+_location_ids: Dict[str, int] = {}
+_location_ids_lock = threading.Lock()
+
+def remember_location_id(location_key: str, url: str, data: any) -> None:
+    """Learn the city ID behind a name or postal-code /weather query."""
+    if not location_key or not ("/weather?q=" in url or "/weather?zip=" in url) or not isinstance(data, dict):
+        return
+    city_id = data.get("id")
+    if not isinstance(city_id, int) or city_id <= 0:
+        return
+    with _location_ids_lock:
+        for key in {location_key, canonical_location_key(location_key)}:
+            if key not in _location_ids and len(_location_ids) >= CACHE_MAX_ENTRIES:
+                del _location_ids[next(iter(_location_ids))]
+            _location_ids[key] = city_id
+
+def batchable_city_id(url: str, location_key: Optional[str]) -> Optional[int]:
+    """The city ID a /weather fetch can be batched under, if it is known."""
+    if GROUP_BATCH_WINDOW_MS <= 0 or f"{BASE_URL}/weather?" not in url or not location_key:
+        return None
+    if location_key.startswith("id="):
+        return int(location_key[3:])
+    with _location_ids_lock:
+        return _location_ids.get(location_key)
+
+def on_event_loop() -> bool:
+    """True when called from a thread running an asyncio event loop."""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+class GroupBatch:
+    """City IDs collected during one window, and the results fanned back out"""
+
+    def __init__(self):
+        self.ids: Dict[int, int] = {}  # city ID -> waiting callers
+        self.items: Dict[int, dict] = {}
+        self.error = ""
+        self.done = threading.Event()
+
+class GroupBatcher:
+    """
+    Collects single-city /weather fetches into /group requests. The first
+    caller of a window becomes its leader: it waits out the window (or
+    until GROUP_MAX_IDS cities are pending), sends one request and hands
+    every waiting caller its own list item.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending: Optional[GroupBatch] = None
+        self.stats: Counter = Counter()
+
+    def fetch(self, city_id: int, timeout: int) -> Tuple[Optional[dict], str]:
+        """Return (/weather-shaped payload or None if the ID is unknown, error message)."""
+        with self._condition:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = GroupBatch()
+            batch.ids[city_id] = batch.ids.get(city_id, 0) + 1
+            if len(batch.ids) >= GROUP_MAX_IDS:
+                self._pending = None  # full: later callers start a new batch
+                self._condition.notify_all()
+
+        if leader:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not batch, GROUP_BATCH_WINDOW_MS / 1000)
+                if self._pending is batch:
+                    self._pending = None
+            self._send(batch, timeout)
+        elif not batch.done.wait(timeout + GROUP_BATCH_WINDOW_MS / 1000):
+            return None, "Timed out waiting for a batched /group request"
+        return batch.items.get(city_id), batch.error
+
+    def _send(self, batch: GroupBatch, timeout: int) -> None:
+        url = f"{BASE_URL}/group?id={','.join(str(city_id) for city_id in sorted(batch.ids))}&units={UNITS}"
+        try:
+            response, batch.error = signed_get(url, api_family(url), timeout)
+            if not batch.error:
+                with span("decode", bytes=len(response.content)):
+                    data = decode_payload(url, response.content)
+                for item in data.get("list", []):
+                    # /group items carry the zone offset under sys; /weather has it at the top level
+                    batch.items[item.get("id")] = dict(item, timezone=item.get("sys", {}).get("timezone", 0))
+                precompute_recommendations(list(batch.items.values()))
+        except Exception as e:
+            batch.error = str(e)
+        finally:
+            self.stats["batches"] += 1
+            self.stats["cities"] += len(batch.ids)
+            self.stats["callers"] += sum(batch.ids.values())
+            batch.done.set()
+
+_group_batcher = GroupBatcher()
+_batch_fetcher: Optional[ThreadPoolExecutor] = None
+_batch_fetcher_lock = threading.Lock()
+
+async def fetch_batchable(url: str, location_key: Optional[str]) -> Tuple[bool, any]:
+    """
+    Run make_http_request on a dedicated pool sized for two full /group
+    batches, so callers waiting out a window do not starve the default
+    executor or cap the batch size.
+    """
+    global _batch_fetcher
+    with _batch_fetcher_lock:
+        if _batch_fetcher is None:
+            _batch_fetcher = ThreadPoolExecutor(max_workers=2 * GROUP_MAX_IDS, thread_name_prefix="group-batch")
+    context = contextvars.copy_context()  # keep the caller's trace and profiler label
+    return await asyncio.get_running_loop().run_in_executor(
+        _batch_fetcher, context.run, profiled_call, make_http_request, url, 10, location_key)
+
+# ---------------------------------------------------------------------------
+# Sharding: with SHARD_PEERS set, replicas own location keys by consistent
+# hashing. Cache misses for keys owned elsewhere are forwarded to the owner
+# over a small peer HTTP endpoint, so each payload is fetched and cached once
+# ---------------------------------------------------------------------------
+
+SHARD_VNODES = 64          # virtual nodes per replica on the hash ring
+SHARD_RETRY_SECONDS = 30   # how long an unreachable peer is skipped
+SHARD_PATH = "/shard/fetch"
+SHARD_UPSTREAM_PREFIXES = ("https://api.openweathermap.org/", "http://api.openweathermap.org/")
+_RING_SIZE = 1 << 64
+
+def ring_hash(value: str) -> int:
+    """Position of a key or virtual node on the 64-bit ring."""
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HashRing:
+    """
+    Consistent-hash ring over replica URLs. Each replica owns the arcs
+    ending at its virtual nodes, so adding or removing one replica only
+    moves the keys on its own arcs.
+    """
+
+    def __init__(self, nodes: List[str], vnodes: int = SHARD_VNODES):
+        self.nodes = tuple(dict.fromkeys(nodes))
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def successors(self, key: str) -> Iterator[str]:
+        """Distinct replicas clockwise from a key: its owner first, then the replicas that take over if it is down."""
+        seen = set()
+        start = bisect.bisect(self._hashes, ring_hash(key))
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def shares(self) -> Dict[str, float]:
+        """Fraction of the key space each replica owns."""
+        shares = dict.fromkeys(self.nodes, 0.0)
+        for i, point in enumerate(self._hashes):
+            shares[self._owners[i]] += ((point - self._hashes[i - 1]) % _RING_SIZE or _RING_SIZE) / _RING_SIZE
+        return shares
+
+_shard_ring: Optional[HashRing] = None
+_shard_server: Optional[ThreadingHTTPServer] = None
+_peer_down_until: Dict[str, float] = {}  # peer -> monotonic time it is retried
+_shard_stats: Counter = Counter()
+_shard_state_lock = threading.Lock()  # guards _peer_down_until and _shard_stats across request threads
+_serving_peer: contextvars.ContextVar = contextvars.ContextVar("serving_peer", default=False)
+
+def to_wire(value: any) -> any:
+    """Make a cached payload JSON-safe: columnar series and arrays become tagged objects."""
+    if isinstance(value, (ForecastSeries, PollutionSeries)):
+        return {"__series__": type(value).__name__, "fields": {name: to_wire(field) for name, field in value._asdict().items()}}
+    if isinstance(value, array):
+        return {"__array__": value.typecode, "items": value.tolist()}
+    if isinstance(value, dict):
+        return {key: to_wire(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_wire(item) for item in value]
+    return value
+
+def from_wire(value: any) -> any:
+    """Rebuild a payload encoded by to_wire."""
+    if isinstance(value, dict):
+        if "__array__" in value:
+            return array(value["__array__"], value["items"])
+        if "__series__" in value:
+            series = {"ForecastSeries": ForecastSeries, "PollutionSeries": PollutionSeries}[value["__series__"]]
+            return series(**{name: from_wire(field) for name, field in value["fields"].items()})
+        return {key: from_wire(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_wire(item) for item in value]
+    return value
+
+def peer_request(peer: str, url: str, timeout: int, location_key: Optional[str], peek: bool) -> Optional[dict]:
+    """
+    Ask a peer for a payload: its cached copy only (peek) or a full fetch
+    through its cache. Returns the decoded reply, or None after marking an
+    unreachable peer down for SHARD_RETRY_SECONDS.
+    """
+    params = {"url": url}
+    if location_key:
+        params["key"] = location_key
+    if peek:
+        params["peek"] = "1"
+    try:
+        with span("shard", peer=peer, peek=peek):
+            response = get_http_client().get(
+                f"{peer}{SHARD_PATH}", params=params, timeout=timeout + 2,
+                headers={"X-Shard-Token": SHARD_SECRET} if SHARD_SECRET else None,
+            )
+            response.raise_for_status()
+            reply = orjson.loads(response.content) if orjson is not None else json.loads(response.content)
+            if "data" in reply:
+                reply["data"] = from_wire(reply["data"])
+    except Exception:
+        with _shard_state_lock:
+            _shard_stats["peer errors"] += 1
+            _peer_down_until[peer] = time.monotonic() + SHARD_RETRY_SECONDS
+        return None
+    with _shard_state_lock:
+        _peer_down_until.pop(peer, None)
+    return reply
+
+def peer_retry_in(peer: str) -> float:
+    """Seconds until an unreachable peer is tried again (0 when it is considered alive)."""
+    now = time.monotonic()
+    with _shard_state_lock:
+        return max(0.0, _peer_down_until.get(peer, now) - now)
+
+def peer_alive(peer: str) -> bool:
+    return peer_retry_in(peer) == 0
+
+def shard_count(stat: str) -> None:
+    with _shard_state_lock:
+        _shard_stats[stat] += 1
+
+def shard_stats() -> Counter:
+    """A consistent copy of the sharding counters."""
+    with _shard_state_lock:
+        return _shard_stats.copy()
+
+def shard_fetch(url: str, timeout: int, location_key: Optional[str]) -> Optional[Tuple[bool, any]]:
+    """
+    Serve a cache miss through the replica that owns its key. A key owned
+    by a live peer is forwarded to it, and the answer is not cached here.
+    A key this replica owns is first looked up in the cache of the next
+    live replica on the ring, which is where it lived before this replica
+    joined or restarted. Returns None when the caller should fetch upstream.
+    """
+    successors = _shard_ring.successors(location_key or url)
+    for peer in successors:
+        if peer == SHARD_SELF:
+            break
+        if not peer_alive(peer):
+            continue
+        reply = peer_request(peer, url, timeout, location_key, peek=False)
+        if reply is not None:
+            shard_count("forwarded")
+            if reply["success"] and location_key:
+                remember_location_alias(location_key, reply["data"])
+                remember_location_id(location_key, url, reply["data"])
+            return reply["success"], reply["data"]
+
+    for peer in successors:
+        if not peer_alive(peer):
+            continue
+        reply = peer_request(peer, url, timeout, location_key, peek=True)
+        if reply is not None and "data" in reply:
+            cache_put(url, reply["data"], reply["ttl"])
+            shard_count("adopted")
+            return True, reply["data"]
+        break
+    return None
+
+class ShardRequestHandler(BaseHTTPRequestHandler):
+    """Answers peer replicas: GET /shard/fetch?url=...&key=...[&peek=1]"""
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path != SHARD_PATH:
+            return self.reply(404, {"error": "not found"})
+        if SHARD_SECRET and not hmac.compare_digest(self.headers.get("X-Shard-Token", ""), SHARD_SECRET):
+            return self.reply(403, {"error": "bad shard token"})
+        params = parse_qs(parts.query)
+        url, location_key = params.get("url", [""])[0], params.get("key", [None])[0]
+        if not url.startswith(SHARD_UPSTREAM_PREFIXES) or "appid=" in url:
+            return self.reply(400, {"error": "not an unsigned OpenWeatherMap URL"})
+
+        if "peek" in params:
+            cached = cache_get_with_ttl(url)
+            return self.reply(200, {"data": to_wire(cached[0]), "ttl": cached[1]} if cached else {})
+
+        token = _serving_peer.set(True)  # never forward a forwarded request again
+        try:
+            success, data = make_http_request(url, timeout=10, location_key=location_key)
+        finally:
+            _serving_peer.reset(token)
+        shard_count("served")
+        self.reply(200, {"success": success, "data": to_wire(data)})
+
+    def reply(self, status: int, body: dict) -> None:
+        payload = to_json(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # stdout and stderr belong to the MCP transport
+
+def shard_peer_list(peers: str) -> List[str]:
+    """Parse a comma-separated replica list, always including this replica."""
+    return list(dict.fromkeys([peer.strip().rstrip("/") for peer in peers.split(",") if peer.strip()] + [SHARD_SELF]))
+
+def is_loopback_host(host: Optional[str]) -> bool:
+    """True for localhost and loopback IP addresses."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host or "").is_loopback
+    except ValueError:
+        return False
+
+def start_sharding() -> None:
+    """
+    Join the ring described by SHARD_PEERS and serve peer requests on the
+    port of SHARD_SELF. The peer endpoint fetches upstream on a caller's
+    behalf, so it only runs without SHARD_SECRET when bound to loopback.
+    """
+    global _shard_ring, _shard_server
+    if not SHARD_PEERS.strip():
+        return
+    if not SHARD_SELF:
+        raise SystemExit("SHARD_SELF must be set to this replica's URL when SHARD_PEERS is set")
+    address = urlsplit(SHARD_SELF)
+    if not SHARD_SECRET and not is_loopback_host(address.hostname):
+        raise SystemExit(f"SHARD_SECRET must be set when SHARD_SELF ({SHARD_SELF}) is not a loopback address")
+    _shard_server = ThreadingHTTPServer((address.hostname, address.port or 80), ShardRequestHandler)
+    _shard_server.daemon_threads = True
+    threading.Thread(target=_shard_server.serve_forever, name="shard-server", daemon=True).start()
+    _shard_ring = HashRing(shard_peer_list(SHARD_PEERS))
+
+@traced("http_request")
+def make_http_request(url: str, timeout: int = 10, location_key: Optional[str] = None, fresh: bool = False) -> tuple[bool, any]:
+    """
+    Make HTTP request using the shared httpx client.
+    The URL is built without an appid and signed by signed_get.
+    Successful responses are cached for CACHE_TTL seconds; past the
+    quota soft limit only cached responses are served.
+    When a location_key is given, not-found answers (HTTP 400/404 or an
+    empty geocoding result) are remembered for NEGATIVE_CACHE_TTL seconds
+    and found locations teach the alias table their canonical key.
+    fresh=True skips the cache and peer replicas and always asks upstream;
+    the answer still replaces the cached one.
+    Returns (success: bool, response_data_or_error: any)
+    """
+    if location_key:
+        remaining = negative_cache_remaining(location_key)
+        if remaining is not None:
+            return False, f"Location not found: '{location_key}' (cached result, retry in {remaining}s)"
+
+    if not fresh:
+        data = cache_get(url)
+        if data is not None:
+            _response_cache_stats["hits"] += 1
+            return True, data
+        _response_cache_stats["misses"] += 1
+
+    if _shard_ring is not None and not _serving_peer.get() and not fresh:
+        served = shard_fetch(url, timeout, location_key)
+        if served is not None:
+            return served
+
+    family = api_family(url)
+    city_id = batchable_city_id(url, location_key)
+    if city_id is not None and not on_event_loop():
+        data, error = _group_batcher.fetch(city_id, timeout)
+        if error:
+            return False, error
+        if data is None:  # /group leaves unknown IDs out of its list
+            negative_cache_put(location_key)
+            return False, f"Location not found: '{location_key}'"
+    else:
+        response, error = signed_get(url, family, timeout)
+        if error:
+            if location_key and response is not None and response.status_code in NOT_FOUND_STATUSES:
+                negative_cache_put(location_key)
+            return False, error
+        try:
+            with span("decode", bytes=len(response.content)):
+                data = decode_payload(url, response.content)
+        except Exception as e:
+            _upstream_errors[family] += 1
+            return False, str(e)
+
+    if location_key and data == []:
+        negative_cache_put(location_key)
+        return True, data
+
+    canonical = None
+    if location_key:
+        canonical = remember_location_alias(location_key, data)
+        remember_location_id(location_key, url, data)
+    history_record(url, location_key, data)
+    if "/group?" in url and isinstance(data, dict):
+        precompute_recommendations(data.get("list", []))
+    cache_put(url, data)
+    if canonical:
+        # Spellings that normalize straight to the canonical key hit this entry
+        alias_target = canonical_url(url, location_key, canonical)
+        if alias_target:
+            cache_put(alias_target, data)
+    return True, data
+
+async def report_partial(ctx: Optional[Context], done: int, total: int, message: str) -> None:
+    """
+    Stream a partial result to the client: a progress notification plus
+    a log message carrying the rendered block for one location.
+    """
+    if ctx is None:
+        return
+    try:
+        await ctx.report_progress(done, total, f"{done}/{total} locations ready")
+    except TypeError:  # SDKs without progress messages
+        await ctx.report_progress(done, total)
+    await ctx.info(message)
+
+async def fetch_progressively(
+    urls: List[str],
+    ctx: Optional[Context],
+    describe: Callable[[int, bool, any], str],
+    location_keys: Optional[List[Optional[str]]] = None,
+) -> List[Tuple[bool, any]]:
+    """
+    Fetch URLs concurrently (at most BATCH_CONCURRENCY at a time) and
+    report each result through the MCP context as soon as it arrives.
+    Results are returned in input order.
+    """
+    location_keys = location_keys or [None] * len(urls)
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+    results: List[Tuple[bool, any]] = [(False, "not fetched")] * len(urls)
+
+    async def fetch(index: int) -> Tuple[int, Tuple[bool, any]]:
+        async with semaphore:
+            return index, await asyncio.to_thread(profiled_call, make_http_request, urls[index], 10, location_keys[index])
+
+    for done, next_result in enumerate(asyncio.as_completed([fetch(i) for i in range(len(urls))]), 1):
+        index, result = await next_result
+        results[index] = result
+        await report_partial(ctx, done, len(urls), describe(index, *result))
+
+    return results
+
+# ---------------------------------------------------------------------------
+# Forecast time-series engine
+# ---------------------------------------------------------------------------
+
+SECONDS_PER_DAY = 86400
+SECONDS_PER_HOUR = 3600
+
+class ForecastSeries(NamedTuple):
+    """Columnar view of a /forecast payload (one entry per 3-hour point)"""
+    timestamps: array      # 'q' - UTC unix seconds, ascending
+    temps: array           # 'd'
+    humidity: array        # 'd'
+    wind: array            # 'd' - wind speed in the configured units
+    conditions: array      # 'H' - index into descriptions
+    descriptions: List[str]
+    timezone_offset: int
+
+class DailyAggregate(NamedTuple):
+    """Aggregates for one local calendar day of a ForecastSeries"""
+    start: int             # first index into the series (inclusive)
+    end: int               # last index into the series (exclusive)
+    first_ts: int
+    min_temp: float
+    max_temp: float
+    mean_temp: float
+    p10_temp: float
+    p90_temp: float
+    mean_humidity: float
+    max_wind: float
+    condition: str
+
+def build_forecast_series(data: dict) -> ForecastSeries:
+    """
+    Convert a /forecast response into columnar arrays.
+    Condition descriptions are interned so each point stores a small code.
+    """
+    timestamps = array("q")
+    temps = array("d")
+    humidity = array("d")
+    wind = array("d")
+    conditions = array("H")
+    descriptions: List[str] = []
+    codes: Dict[str, int] = {}
+
+    for item in data["list"]:
+        main = item["main"]
+        description = item["weather"][0]["description"]
+        code = codes.get(description)
+        if code is None:
+            code = codes[description] = len(descriptions)
+            descriptions.append(description.capitalize())
+
+        timestamps.append(item["dt"])
+        temps.append(main["temp"])
+        humidity.append(main.get("humidity", 0))
+        wind.append(item.get("wind", {}).get("speed", 0.0))
+        conditions.append(code)
+
+    return ForecastSeries(
+        timestamps, temps, humidity, wind, conditions, descriptions,
+        data.get("city", {}).get("timezone", 0),
+    )
+
+def forecast_series(data: dict) -> ForecastSeries:
+    """Return the columnar series of a /forecast payload, compacted at decode time or raw."""
+    series = data.get("series")
+    return series if isinstance(series, ForecastSeries) else build_forecast_series(data)
+
+# ---------------------------------------------------------------------------
+# Air quality time-series engine
+# ---------------------------------------------------------------------------
+
+POLLUTANTS = ("co", "no", "no2", "o3", "so2", "pm2_5", "pm10", "nh3")
+
+# Pollutant -> (WHO 2021 air quality guideline in µg/m³, averaging window in hours)
+POLLUTANT_GUIDELINES = {
+    "pm2_5": (15.0, 24),
+    "pm10": (45.0, 24),
+    "no2": (25.0, 24),
+    "so2": (40.0, 24),
+    "o3": (100.0, 8),
+    "co": (4000.0, 24),
+}
+
+class PollutionSeries(NamedTuple):
+    """Columnar view of an air_pollution forecast or history payload (hourly points)"""
+    timestamps: array               # 'q' - UTC unix seconds, ascending
+    aqi: array                      # 'B' - OWM index 1-5
+    components: Dict[str, array]    # pollutant -> 'd' concentrations in µg/m³
+
+def build_pollution_series(data: dict) -> PollutionSeries:
+    """Convert an air_pollution payload into one array per pollutant."""
+    points = sorted(data["list"], key=lambda item: item["dt"])
+    return PollutionSeries(
+        array("q", [item["dt"] for item in points]),
+        array("B", [item["main"]["aqi"] for item in points]),
+        {key: array("d", [item["components"].get(key, 0.0) for item in points]) for key in POLLUTANTS},
+    )
+
+def pollution_series(data: dict) -> PollutionSeries:
+    """Return the columnar series of an air_pollution payload, compacted at decode time or raw."""
+    series = data.get("series")
+    return series if isinstance(series, PollutionSeries) else build_pollution_series(data)
+
+def slice_pollution(series: PollutionSeries, start: int, end: int) -> PollutionSeries:
+    """Points with start <= timestamp < end."""
+    lo = bisect.bisect_left(series.timestamps, start)
+    hi = bisect.bisect_left(series.timestamps, end, lo)
+    return PollutionSeries(
+        series.timestamps[lo:hi], series.aqi[lo:hi],
+        {key: values[lo:hi] for key, values in series.components.items()},
+    )
+
+def rolling_means(values: array, window: int) -> array:
+    """Trailing means over each full window of points (the whole series if shorter), from one prefix-sum pass."""
+    window = max(1, min(window, len(values)))
+    sums = array("d", itertools.accumulate(values, initial=0.0))
+    return array("d", map((1 / window).__mul__, map(operator.sub, sums[window:], sums[:len(sums) - window])))
+
+# ---------------------------------------------------------------------------
+# Upstream payload decoding: JSON is decoded straight from the response
+# bytes (with orjson when installed), then large payloads are compacted to
+# the fields their parsers read before they are cached
+# ---------------------------------------------------------------------------
+
+def compact_forecast(data: any) -> any:
+    """
+    Replace the 40-point "list" of a /forecast payload with its columnar
+    ForecastSeries, keeping "city". Malformed payloads are returned as is
+    so parse_forecast reports the error.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("list"), list):
+        return data
+    try:
+        return {"city": data.get("city", {}), "series": build_forecast_series(data)}
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError):
+        return data
+
+def compact_pollution(data: any) -> any:
+    """Replace the hourly "list" of an air_pollution forecast/history payload with its PollutionSeries."""
+    if not isinstance(data, dict) or not isinstance(data.get("list"), list):
+        return data
+    try:
+        return {"coord": data.get("coord", {}), "series": build_pollution_series(data)}
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError):
+        return data
+
+# (URL marker, compactor) for upstream payloads worth compacting before caching
+PAYLOAD_COMPACTORS: Tuple[Tuple[str, Callable[[any], any]], ...] = (
+    ("/data/2.5/forecast?", compact_forecast),
+    ("/air_pollution/forecast?", compact_pollution),
+    ("/air_pollution/history?", compact_pollution),
+)
+
+def decode_payload(url: str, raw: bytes) -> any:
+    """Decode an upstream response body and compact it for the endpoint it came from."""
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    for marker, compact in PAYLOAD_COMPACTORS:
+        if marker in url:
+            return compact(data)
+    return data
+
+def percentile(sorted_values, q: float) -> float:
+    """Linear-interpolated percentile (0-100) of an already sorted sequence."""
+    if not sorted_values:
+        return float("nan")
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+
+def day_ranges(timestamps: array, timezone_offset: int) -> List[Tuple[int, int]]:
+    """
+    Split ascending timestamps into (start, end) index ranges per local calendar day.
+    Day numbers are computed with integer arithmetic instead of datetime objects.
+    """
+    ranges = []
+    start = 0
+    current_day = None
+    for index, ts in enumerate(timestamps):
+        day = (ts + timezone_offset) // SECONDS_PER_DAY
+        if day != current_day:
+            if current_day is not None:
+                ranges.append((start, index))
+            start = index
+            current_day = day
+    if current_day is not None:
+        ranges.append((start, len(timestamps)))
+    return ranges
+
+def dominant_condition(series: ForecastSeries, start: int, end: int) -> str:
+    """Most frequent condition in a range; ties go to the earliest one seen."""
+    window = series.conditions[start:end]
+    counts = [0] * len(series.descriptions)
+    for code in window:
+        counts[code] += 1
+    top = max(counts)
+    for code in window:
+        if counts[code] == top:
+            return series.descriptions[code]
+    return ""
+
+def daily_aggregates(series: ForecastSeries, days: Optional[int] = None) -> List[DailyAggregate]:
+    """Compute per-day temperature, humidity, wind and condition aggregates."""
+    aggregates = []
+    for start, end in day_ranges(series.timestamps, series.timezone_offset)[:days]:
+        temps = series.temps[start:end]
+        ordered = sorted(temps)
+        count = end - start
+        aggregates.append(DailyAggregate(
+            start=start,
+            end=end,
+            first_ts=series.timestamps[start],
+            min_temp=ordered[0],
+            max_temp=ordered[-1],
+            mean_temp=sum(temps) / count,
+            p10_temp=percentile(ordered, 10),
+            p90_temp=percentile(ordered, 90),
+            mean_humidity=sum(series.humidity[start:end]) / count,
+            max_wind=max(series.wind[start:end]),
+            condition=dominant_condition(series, start, end),
+        ))
+    return aggregates
+
+def resample_hourly(series: ForecastSeries, column: str = "temps") -> Tuple[array, array]:
+    """
+    Linearly interpolate one numeric column onto an hourly grid.
+    Returns (timestamps, values) arrays covering the whole series.
+    """
+    source_ts = series.timestamps
+    source = getattr(series, column)
+    out_ts = array("q")
+    out_values = array("d")
+    if not source_ts:
+        return out_ts, out_values
+
+    segment = 0
+    last = len(source_ts) - 1
+    for ts in range(source_ts[0], source_ts[last] + 1, SECONDS_PER_HOUR):
+        while segment < last - 1 and ts > source_ts[segment + 1]:
+            segment += 1
+        if segment == last:
+            value = source[last]
+        else:
+            left_ts, right_ts = source_ts[segment], source_ts[segment + 1]
+            fraction = (ts - left_ts) / (right_ts - left_ts) if right_ts != left_ts else 0.0
+            value = source[segment] + (source[segment + 1] - source[segment]) * fraction
+        out_ts.append(ts)
+        out_values.append(value)
+    return out_ts, out_values
+
+# ---------------------------------------------------------------------------
+# Response models and structured output
+# ---------------------------------------------------------------------------
+
+class CurrentWeather(TypedDict):
+    """Parsed /weather payload"""
+    name: str
+    country: str
+    description: str
+    temp: float
+    feels_like: float
+    humidity: int
+    pressure: int
+    wind_speed: float
+    wind_deg: float
+    visibility: float      # km
+    sunrise: int
+    sunset: int
+    timezone: int
+    units: str
+
+class ForecastPoint(TypedDict):
+    """One 3-hour forecast point"""
+    dt: int
+    temp: float
+    humidity: float
+    wind_speed: float
+    condition: str
+
+class HourlyTemp(TypedDict):
+    """One temperature interpolated onto the hourly grid"""
+    dt: int
+    temp: float
+
+class ForecastDay(TypedDict, total=False):
+    """Aggregates for one local day, optionally with its forecast points"""
+    date: str
+    first_dt: int
+    condition: str
+    min_temp: float
+    max_temp: float
+    mean_temp: float
+    p10_temp: float
+    p90_temp: float
+    mean_humidity: float
+    max_wind: float
+    points: List[ForecastPoint]
+    hourly: List[HourlyTemp]
+
+class Forecast(TypedDict):
+    """Parsed /forecast payload grouped by local day"""
+    name: str
+    country: str
+    timezone: int
+    units: str
+    days: List[ForecastDay]
+
+class WeatherAlert(TypedDict):
+    """One alert from the One Call API"""
+    event: str
+    sender: str
+    start: int
+    end: int
+    description: str
+
+class AlertReport(TypedDict):
+    """Alerts currently active for a location"""
+    name: str
+    country: str
+    alerts: List[WeatherAlert]
+
+class AirQuality(TypedDict):
+    """Parsed air_pollution payload"""
+    name: str
+    country: str
+    aqi: int
+    level: str
+    summary: str
+    components: Dict[str, float]
+
+class AirQualityDay(TypedDict):
+    """Peak and mean AQI and per-pollutant maxima for one local day"""
+    date: str
+    first_dt: int
+    max_aqi: int
+    mean_aqi: float
+    maxima: Dict[str, float]
+
+class PollutantTrend(TypedDict):
+    """Statistics of one pollutant over an air quality series"""
+    pollutant: str
+    mean: float
+    max: float
+    max_dt: int
+    guideline: Optional[float]           # WHO 2021 guideline, if one exists
+    window_hours: Optional[int]          # averaging window of the guideline
+    max_rolling_mean: Optional[float]
+    exceedance_hours: Optional[int]      # hours whose rolling mean is above the guideline
+
+class AirQualityTrend(TypedDict):
+    """Analysis of an air_pollution forecast or history series"""
+    name: str
+    country: str
+    lat: float                           # coordinate cell the data was fetched for
+    lon: float
+    period: str                          # "forecast" or "history"
+    timezone: int                        # offset used for days (from longitude)
+    points: int
+    days: List[AirQualityDay]
+    pollutants: List[PollutantTrend]
+
+class NearbyPlace(TypedDict):
+    """Current conditions of one place picked from the city index"""
+    id: int
+    name: str
+    state: str
+    country: str
+    lat: float
+    lon: float
+    distance_km: float                   # from the center point or the middle of the box
+    description: str
+    temp: float
+    feels_like: float
+    humidity: int
+    wind_speed: float
+
+class NearbyWeather(TypedDict):
+    """Current conditions across a radius or bounding box"""
+    name: str                            # center place, or "" for a bounding box
+    country: str
+    lat: float
+    lon: float
+    radius_km: Optional[float]
+    bbox: Optional[List[float]]          # [west, south, east, north]
+    candidates: int                      # indexed places inside the region
+    requests: int                        # bulk /group calls made
+    units: str
+    places: List[NearbyPlace]
+    missing: List[str]                   # picked places the bulk response left out
+
+class AstronomyData(TypedDict):
+    """Sun and moon data derived from a /weather payload"""
+    name: str
+    country: str
+    timezone: int
+    sunrise: int
+    sunset: int
+    solar_noon: int
+    day_length: int        # seconds
+    moon_phase: str
+    moon_illumination: float
+    is_daytime: bool
+    next_event: str        # "sunset" or "sunrise"
+    next_event_in: int     # seconds
+
+class WeatherRecommendations(TypedDict):
+    """Evaluated recommendations for a location"""
+    name: str
+    country: str
+    temp: float
+    description: str
+    units: str
+    recommendations: List[str]
+    warnings: List[str]
+    clothing: List[str]
+
+def resolve_output_format(output_format: str = "") -> str:
+    """Return "json" or "text" for a per-call value, falling back to OUTPUT_FORMAT."""
+    fmt = (output_format or OUTPUT_FORMAT).strip().lower()
+    return "json" if fmt == "json" else "text"
+
+def to_json(model: any) -> str:
+    """Serialize a model as compact JSON."""
+    return json.dumps(model, separators=(",", ":"), ensure_ascii=False)
+
+@traced("render")
+def respond(model: any, render: Callable[[any], str], output_format: str = "") -> str:
+    """Return the model as compact JSON or render it as text, per the requested format."""
+    if resolve_output_format(output_format) == "json":
+        return to_json(model)
+    return render(model)
+
+def error_response(message: str, output_format: str = "") -> str:
+    """Return an error message in the requested output format."""
+    if resolve_output_format(output_format) == "json":
+        return to_json({"error": message})
+    return message
+
+# ---------------------------------------------------------------------------
+# Delta mode: per session, remember what was last served for a location
+# and return only the fields that moved past a threshold since then
+# ---------------------------------------------------------------------------
+
+# Smallest change worth reporting per numeric field (units follow UNITS)
+DEFAULT_DELTA_THRESHOLDS = {
+    "temp": 1.0,
+    "feels_like": 1.0,
+    "humidity": 5,
+    "pressure": 2,
+    "wind_speed": 2.0,
+    "wind_deg": 45,
+    "visibility": 1.0,
+}
+CURRENT_DELTA_FIELDS = ("description", "temp", "feels_like", "humidity", "pressure", "wind_speed", "wind_deg", "visibility")
+FORECAST_DELTA_FIELDS = ("temp", "humidity", "wind_speed", "condition")
+
+def parse_thresholds(spec: str) -> Dict[str, float]:
+    """Parse "field=value,..." into a dict of floats, ignoring malformed entries."""
+    thresholds = {}
+    for item in spec.split(","):
+        field, _, value = item.partition("=")
+        try:
+            thresholds[field.strip()] = float(value)
+        except ValueError:
+            continue
+    return thresholds
+
+DELTA_FIELD_THRESHOLDS = {**DEFAULT_DELTA_THRESHOLDS, **parse_thresholds(DELTA_THRESHOLDS)}
+
+class PointDelta(TypedDict):
+    """Fields that changed for one forecast point (dt 0 for current conditions)"""
+    dt: int
+    new: bool
+    changes: Dict[str, list]  # field -> [previous, current]
+
+class WeatherDelta(TypedDict):
+    """Changes since the last response served to a session"""
+    name: str
+    country: str
+    units: str
+    timezone: int
+    unchanged: bool
+    points: List[PointDelta]
+
+# (tool, session, canonical location, variant) -> (payload version, baseline snapshot)
+_delta_baselines: "OrderedDict[tuple, Tuple[Optional[int], Dict[int, dict]]]" = OrderedDict()
+_delta_lock = threading.Lock()
+
+def changed_fields(previous: dict, current: dict, fields: Tuple[str, ...]) -> Dict[str, list]:
+    """Return {field: [previous, current]} for fields that moved by at least their threshold."""
+    changes = {}
+    for field in fields:
+        old, new = previous.get(field), current.get(field)
+        threshold = DELTA_FIELD_THRESHOLDS.get(field, 0)
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)) and threshold:
+            if abs(new - old) >= threshold:
+                changes[field] = [old, new]
+        elif old != new:
+            changes[field] = [old, new]
+    return changes
+
+def diff_snapshot(
+    baseline: Dict[int, dict], snapshot: Dict[int, dict], fields: Tuple[str, ...],
+) -> Tuple[List[PointDelta], Dict[int, dict]]:
+    """
+    Compare a snapshot ({dt: fields}) with the session's baseline.
+    Returns the point deltas and the next baseline, in which only the
+    reported fields advance so that slow drift is reported once it adds
+    up to a threshold.
+    """
+    deltas = []
+    next_baseline = {}
+    for dt, point in snapshot.items():
+        previous = baseline.get(dt)
+        if previous is None:
+            deltas.append(PointDelta(dt=dt, new=True, changes={field: [None, point.get(field)] for field in fields}))
+            next_baseline[dt] = point
+            continue
+        changes = changed_fields(previous, point, fields)
+        if changes:
+            deltas.append(PointDelta(dt=dt, new=False, changes=changes))
+            next_baseline[dt] = {**previous, **{field: values[1] for field, values in changes.items()}}
+        else:
+            next_baseline[dt] = previous
+    return deltas, next_baseline
+
+def serve_delta(
+    key: tuple, url: str, model: dict, snapshot: Dict[int, dict], fields: Tuple[str, ...],
+) -> Optional[WeatherDelta]:
+    """
+    Record what a session is being served and return the delta against
+    its previous response, or None when the session has no baseline yet
+    (the caller then serves the full response).
+    """
+    version = payload_version(url)
+    with _delta_lock:
+        previous = _delta_baselines.get(key)
+        if previous is not None:
+            _delta_baselines.move_to_end(key)
+        if previous is not None and version is not None and previous[0] == version:
+            deltas = []
+        elif previous is not None:
+            deltas, next_baseline = diff_snapshot(previous[1], snapshot, fields)
+            _delta_baselines[key] = (version, next_baseline)
+        else:
+            _delta_baselines[key] = (version, snapshot)
+            while len(_delta_baselines) > CACHE_MAX_ENTRIES:
+                _delta_baselines.popitem(last=False)
+            return None
+
+    return WeatherDelta(
+        name=model["name"],
+        country=model["country"],
+        units=model["units"],
+        timezone=model["timezone"],
+        unchanged=not deltas,
+        points=deltas,
+    )
+
+def format_delta_value(field: str, value: any, units: str) -> str:
+    """Format one field value for a delta line."""
+    if value is None:
+        return "n/a"
+    if field in ("temp", "feels_like"):
+        return f"{value:.1f}{'°C' if units == 'metric' else '°F'}"
+    if field == "humidity":
+        return f"{value:.0f}%"
+    if field == "wind_speed":
+        return f"{value:.1f} {'m/s' if units == 'metric' else 'mph'}"
+    if field == "pressure":
+        return f"{value} hPa"
+    if field == "visibility":
+        return f"{value:.1f} {'km' if units == 'metric' else 'mi'}"
+    if field == "wind_deg":
+        return f"{value:.0f}°"
+    return str(value)
+
+def render_delta(model: WeatherDelta, title: str) -> str:
+    """Render a delta as one line per changed field or forecast point."""
+    place = place_name(model["name"], model["country"])
+    if model["unchanged"]:
+        return f"✅ No {title.lower()} changes beyond thresholds for {place} since your last check"
+
+    result = f"🔁 {title} changes for {place} since your last check:\n"
+    for point in model["points"]:
+        changes = point["changes"]
+        if point["dt"]:
+            when = f"{format_date(point['dt'], model['timezone'])} {format_time(point['dt'], model['timezone'])}"
+            if point["new"]:
+                values = ", ".join(format_delta_value(field, values[1], model["units"]) for field, values in changes.items())
+                result += f"• {when} (new): {values}\n"
+                continue
+            result += f"• {when}: " + ", ".join(
+                f"{field} {format_delta_value(field, old, model['units'])} → {format_delta_value(field, new, model['units'])}"
+                for field, (old, new) in changes.items()
+            ) + "\n"
+        else:
+            for field, (old, new) in changes.items():
+                result += f"• {field}: {format_delta_value(field, old, model['units'])} → {format_delta_value(field, new, model['units'])}\n"
+    return result.strip()
+
+@traced("parse")
+def parse_current_weather(data: dict) -> CurrentWeather:
+    """Extract the current-conditions model from a /weather payload."""
+    return {
+        "name": data["name"],
+        "country": data.get("sys", {}).get("country", ""),
+        "description": data["weather"][0]["description"].capitalize(),
+        "temp": data["main"]["temp"],
+        "feels_like": data["main"]["feels_like"],
+        "humidity": data["main"]["humidity"],
+        "pressure": data["main"]["pressure"],
+        "wind_speed": data["wind"]["speed"],
+        "wind_deg": data["wind"].get("deg", 0),
+        "visibility": data.get("visibility", 0) / 1000,  # convert to km
+        "sunrise": data["sys"]["sunrise"],
+        "sunset": data["sys"]["sunset"],
+        "timezone": data.get("timezone", 0),
+        "units": UNITS,
+    }
+
+def render_current_weather(model: CurrentWeather) -> str:
+    """Render current conditions as text."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    distance_unit = "km" if model["units"] == "metric" else "mi"
+    sunrise = format_time(model["sunrise"], model["timezone"])
+    sunset = format_time(model["sunset"], model["timezone"])
+
+    return f"""
+Current Weather for {model["name"]}, {model["country"]}:
+🌡️ {model["description"]}, {model["temp"]}{unit_symbol} (Feels like: {model["feels_like"]}{unit_symbol})
+💧 Humidity: {model["humidity"]}%
+💨 Wind: {format_wind(model["wind_speed"], model["wind_deg"], model["units"])}
+🔍 Visibility: {model["visibility"]:.1f} {distance_unit}
+🌅 Sunrise: {sunrise}
+🌇 Sunset: {sunset}
+    """.strip()
+
+@app.tool()
+@timed_tool
+async def get_current_weather(city: str, output_format: str = "", session: str = "") -> str:
+    """
+    Get current weather conditions for the specified city. Set output_format="json" for structured output.
+    The city may also be "lat,lon", a city ID or "zip=94040,us".
+    Pass a session key to get only the fields that changed since that session's last call.
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    # Make HTTP request
+    location = parse_location(city)
+    url = f"{BASE_URL}/weather?{location.query}&units={UNITS}"
+    data = cache_get(url)  # one lookup, so an entry expiring now cannot send a fetch onto the loop
+    if data is not None:
+        success = True
+        _response_cache_stats["hits"] += 1
+    elif GROUP_BATCH_WINDOW_MS > 0:
+        # Fetch off the event loop so concurrent calls can share one /group request
+        success, data = await fetch_batchable(url, location.key)
+    else:
+        success, data = await asyncio.to_thread(profiled_call, make_http_request, url, 10, location.key)
+
+    if not success:
+        return error_response(f"Error fetching weather data: {data}", output_format)
+
+    if session:
+        try:
+            model = parse_current_weather(data)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing weather data: {str(e)}", output_format)
+        delta = serve_delta(("get_current_weather", session, parse_location(city).key), url, model, {0: model}, CURRENT_DELTA_FIELDS)
+        if delta is not None:
+            return respond(delta, lambda model: render_delta(model, "Weather"), output_format)
+
+    def build() -> str:
+        try:
+            return respond(parse_current_weather(data), render_current_weather, output_format)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing weather data: {str(e)}", output_format)
+
+    return cached_render("get_current_weather", (url,), (resolve_output_format(output_format),), build)
+
+@traced("parse")
+def parse_forecast(data: dict, days: Optional[int] = None, include_points: bool = True, hourly: bool = False) -> Forecast:
+    """
+    Group a /forecast payload into per-day aggregates using the columnar engine.
+    With hourly=True each day also gets its temperatures interpolated onto an hourly grid.
+    """
+    series = forecast_series(data)
+    timezone_offset = series.timezone_offset
+    if hourly:
+        hourly_ts, hourly_temps = resample_hourly(series)
+
+    forecast_days = []
+    for day in daily_aggregates(series, days):
+        forecast_day: ForecastDay = {
+            "date": datetime.utcfromtimestamp(day.first_ts + timezone_offset).strftime("%Y-%m-%d"),
+            "first_dt": day.first_ts,
+            "condition": day.condition,
+            "min_temp": day.min_temp,
+            "max_temp": day.max_temp,
+            "mean_temp": round(day.mean_temp, 2),
+            "p10_temp": round(day.p10_temp, 2),
+            "p90_temp": round(day.p90_temp, 2),
+            "mean_humidity": round(day.mean_humidity, 1),
+            "max_wind": day.max_wind,
+        }
+        if include_points:
+            forecast_day["points"] = [
+                {
+                    "dt": series.timestamps[index],
+                    "temp": series.temps[index],
+                    "humidity": series.humidity[index],
+                    "wind_speed": series.wind[index],
+                    "condition": series.descriptions[series.conditions[index]],
+                }
+                for index in range(day.start, day.end)
+            ]
+        if hourly:
+            midnight = (day.first_ts + timezone_offset) // SECONDS_PER_DAY * SECONDS_PER_DAY - timezone_offset
+            lo = bisect.bisect_left(hourly_ts, midnight)
+            hi = bisect.bisect_left(hourly_ts, midnight + SECONDS_PER_DAY, lo)
+            forecast_day["hourly"] = [
+                {"dt": hourly_ts[index], "temp": round(hourly_temps[index], 2)}
+                for index in range(lo, hi)
+            ]
+        forecast_days.append(forecast_day)
+
+    return {
+        "name": data["city"]["name"],
+        "country": data["city"].get("country", ""),
+        "timezone": timezone_offset,
+        "units": UNITS,
+        "days": forecast_days,
+    }
+
+def render_forecast(model: Forecast) -> str:
+    """Render a detailed multi-day forecast as text."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    timezone_offset = model["timezone"]
+
+    result = f"5-Day Forecast for {model['name']}, {model['country']}:\n\n"
+
+    for day in model["days"]:
+        day_date = format_date(day["first_dt"], timezone_offset)
+        result += f"📅 {day_date}:\n"
+        result += f"   {day['condition']}, {day['min_temp']:.1f}{unit_symbol} to {day['max_temp']:.1f}{unit_symbol}\n"
+
+        # Add some time-specific details
+        for point in day["points"][::2]:  # Take every other forecast to reduce verbosity
+            time = format_time(point["dt"], timezone_offset)
+            result += f"   • {time}: {point['temp']:.1f}{unit_symbol}, {point['condition']}\n"
+
+        if day.get("hourly"):
+            hours = ", ".join(
+                f"{datetime.utcfromtimestamp(hour['dt'] + timezone_offset):%H}h {hour['temp']:.1f}°"
+                for hour in day["hourly"]
+            )
+            result += f"   🕐 Hourly: {hours}\n"
+
+        result += "\n"
+
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def get_forecast(city: str, days: int = 5, output_format: str = "", session: str = "", hourly: bool = False) -> str:
+    """
+    Get weather forecast for the specified city for up to 5 days. Set output_format="json" for structured output.
+    The city may also be "lat,lon", a city ID or "zip=94040,us".
+    Pass a session key to get only the forecast points that changed since that session's last call.
+    Set hourly=True to add temperatures interpolated to every hour between the 3-hour points.
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    if days < 1:
+        days = 1
+    if days > 5:
+        days = 5
+
+    # Make HTTP request
+    location = parse_location(city)
+    url = f"{BASE_URL}/forecast?{location.query}&units={UNITS}"
+    success, data = make_http_request(url, timeout=10, location_key=location.key)
+
+    if not success:
+        return error_response(f"Error fetching forecast data: {data}", output_format)
+
+    if session:
+        try:
+            model = parse_forecast(data, days)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing forecast data: {e}", output_format)
+        snapshot = {point["dt"]: point for day in model["days"] for point in day["points"]}
+        delta = serve_delta(("get_forecast", session, parse_location(city).key, days), url, model, snapshot, FORECAST_DELTA_FIELDS)
+        if delta is not None:
+            return respond(delta, lambda model: render_delta(model, "Forecast"), output_format)
+
+    def build() -> str:
+        try:
+            return respond(parse_forecast(data, days, hourly=hourly), render_forecast, output_format)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing forecast data: {e}", output_format)
+
+    return cached_render("get_forecast", (url,), (resolve_output_format(output_format), days, hourly), build)
+
+def render_forecast_summary(model: Forecast) -> str:
+    """Render a compact per-day summary block for one city's forecast."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    speed_unit = "m/s" if model["units"] == "metric" else "mph"
+
+    result = f"📍 {model['name']}, {model['country']}:\n"
+    for day in model["days"]:
+        day_date = format_date(day["first_dt"], model["timezone"])
+        result += (
+            f"   📅 {day_date}: {day['condition']}, "
+            f"{day['min_temp']:.1f}{unit_symbol} to {day['max_temp']:.1f}{unit_symbol} "
+            f"(avg {day['mean_temp']:.1f}{unit_symbol}), "
+            f"💧 {day['mean_humidity']:.0f}%, 💨 max {day['max_wind']:.1f} {speed_unit}\n"
+        )
+    return result
+
+def render_forecasts_batch(model: dict) -> str:
+    """Render batch forecast summaries as text."""
+    result = f"📅 {model['days']}-Day Forecast Summary for {len(model['locations'])} Locations:\n\n"
+    for entry in model["locations"]:
+        if "error" in entry:
+            result += f"❌ {entry['query']}: {entry['error']}\n\n"
+        else:
+            result += render_forecast_summary(entry) + "\n"
+    return result.strip()
+
+@app.tool()
+@timed_tool
+async def get_forecasts_batch(locations: List[str], days: int = 3, output_format: str = "", ctx: Context = None) -> str:
+    """Get forecast summaries for several cities, "lat,lon" coordinates, city IDs or "zip=" codes in one call (up to 20)."""
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Drop blanks and duplicates while keeping the caller's order
+    unique_locations = []
+    seen = set()
+    for location in locations:
+        location = location.strip()
+        key = parse_location(location).key if location else ""
+        if location and key not in seen:
+            seen.add(key)
+            unique_locations.append(location)
+
+    if not unique_locations:
+        return error_response("Error: Please provide at least one city or coordinate pair", output_format)
+
+    if len(unique_locations) > MAX_BATCH_LOCATIONS:
+        return error_response(f"Error: Maximum {MAX_BATCH_LOCATIONS} locations allowed per batch", output_format)
+
+    days = max(1, min(days, 5))
+
+    parsed = [parse_location(location) for location in unique_locations]
+    urls = [f"{BASE_URL}/forecast?{location.query}&units={UNITS}" for location in parsed]
+
+    def parse_entry(location: str, success: bool, data: any) -> dict:
+        if not success:
+            return {"query": location, "error": f"Failed to fetch data: {data}"}
+        try:
+            return parse_forecast(data, days, include_points=False)
+        except (KeyError, ValueError) as e:
+            return {"query": location, "error": f"Error parsing forecast data: {e}"}
+
+    # Fetch concurrently, streaming each location's summary as it arrives
+    def describe(index: int, success: bool, data: any) -> str:
+        entry = parse_entry(unique_locations[index], success, data)
+        if resolve_output_format(output_format) == "json":
+            return to_json(entry)
+        if "error" in entry:
+            return f"❌ {entry['query']}: {entry['error']}"
+        return render_forecast_summary(entry).strip()
+
+    responses = await fetch_progressively(urls, ctx, describe, [location.key for location in parsed])
+
+    entries = [
+        parse_entry(location, success, data)
+        for location, (success, data) in zip(unique_locations, responses)
+    ]
+
+    return respond({"days": days, "locations": entries}, render_forecasts_batch, output_format)
+
+# ---------------------------------------------------------------------------
+# Offline city index
+# ---------------------------------------------------------------------------
+
+class CityRecord(NamedTuple):
+    """One entry of the OpenWeatherMap city list"""
+    id: int
+    name: str
+    state: str
+    country: str
+    lat: float
+    lon: float
+    population: int
+
+CITY_INDEX_MAGIC = b"OWCI"
+CITY_INDEX_VERSION = 3
+_CITY_INDEX_HEADER = struct.Struct("<4sIIII")  # magic, version, city count, node count, label bytes
+# Trie node: label offset, label length, first child, child count, first city, end city
+_TRIE_NODE = struct.Struct("<IHIHII")
+# Spatial grid over the cities: fixed-size cells, stored as per-cell start
+# offsets into a table of city indices ordered by cell
+CITY_GRID_DEGREES = 0.5
+_CITY_GRID_ROWS = int(180 / CITY_GRID_DEGREES)
+_CITY_GRID_COLS = int(360 / CITY_GRID_DEGREES)
+_CITY_COORD_SCALE = 10000  # coordinates are stored as int32 ten-thousandths of a degree
+EARTH_RADIUS_KM = 6371.0
+
+def city_grid_cell(lat: float, lon: float) -> Tuple[int, int]:
+    """Grid (row, column) of a coordinate; longitudes wrap around the antimeridian."""
+    row = min(max(math.floor((lat + 90) / CITY_GRID_DEGREES), 0), _CITY_GRID_ROWS - 1)
+    return row, math.floor((lon + 180) / CITY_GRID_DEGREES) % _CITY_GRID_COLS
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two coordinates in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def bbox_center(west: float, south: float, east: float, north: float) -> Tuple[float, float]:
+    """Middle (lat, lon) of a box; west > east crosses the antimeridian."""
+    return (south + north) / 2, (west + (east - west) % 360 / 2 + 180) % 360 - 180
+
+def search_key(text: str) -> str:
+    """Fold a place name for matching: lowercase, strip accents, collapse whitespace."""
+    folded = unicodedata.normalize("NFKD", text.lower())
+    folded = "".join(ch for ch in folded if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", folded).strip()
+
+def build_city_trie(keys: List[bytes]) -> Tuple[List[tuple], bytes]:
+    """
+    Build a path-compressed trie over sorted keys.
+    Nodes are laid out breadth-first so each node's children are
+    contiguous; every node covers the run of keys sharing its prefix.
+    Returns (nodes, label blob) ready for _TRIE_NODE packing.
+    """
+    labels = bytearray()
+    nodes = [[0, 0, 0, 0, 0, len(keys)]]
+    queue = [(0, 0)]  # (node index, depth)
+    while queue:
+        next_queue = []
+        for node_index, depth in queue:
+            node = nodes[node_index]
+            low, high = node[4], node[5]
+            while low < high and len(keys[low]) == depth:  # names ending at this node
+                low += 1
+            node[2] = len(nodes)
+            while low < high:
+                first = keys[low]
+                child_end = bisect.bisect_left(keys, first[:depth + 1] + b"\xff", low, high)
+                last = keys[child_end - 1]
+                # Extend the edge over the prefix shared by the whole child run
+                edge_end = depth + 1
+                limit = min(len(first), len(last), depth + 0xFFFF)
+                while edge_end < limit and first[edge_end] == last[edge_end]:
+                    edge_end += 1
+                nodes.append([len(labels), edge_end - depth, 0, 0, low, child_end])
+                labels += first[depth:edge_end]
+                next_queue.append((len(nodes) - 1, edge_end))
+                low = child_end
+            node[3] = len(nodes) - node[2]
+        queue = next_queue
+    return [tuple(node) for node in nodes], bytes(labels)
+
+def build_city_index(source_path: str, index_path: str) -> int:
+    """
+    Build the on-disk city index from an OWM city list (JSON or JSON.gz).
+
+    Layout: header, a uint32 offset table for the city lines, the trie
+    node table, int32 latitude and longitude and uint32 population
+    columns, the spatial grid (uint32 cell starts, then city indices
+    ordered by cell), the trie edge labels, then one tab-separated line
+    per city sorted by folded name. Returns the number of indexed cities.
+    """
+    opener = gzip.open if source_path.endswith(".gz") else open
+    with opener(source_path, "rt", encoding="utf-8") as f:
+        cities = json.load(f)
+
+    entries = []
+    for city in cities:
+        name = city.get("name", "").strip()
+        if not name:
+            continue
+        coord = city.get("coord", {})
+        population = city.get("population") or city.get("stat", {}).get("population") or 0
+        fields = (
+            search_key(name), str(city.get("id", 0)), name, city.get("state", "") or "",
+            city.get("country", "") or "", f"{coord.get('lat', 0):.4f}", f"{coord.get('lon', 0):.4f}",
+            str(int(population)),
+        )
+        line = "\t".join(field.replace("\t", " ").replace("\n", " ") for field in fields).encode("utf-8") + b"\n"
+        entries.append((line, round(float(fields[5]) * _CITY_COORD_SCALE),
+                        round(float(fields[6]) * _CITY_COORD_SCALE), min(int(population), 0xFFFFFFFF)))
+    entries.sort()
+    lines = [entry[0] for entry in entries]
+    keys = [line[:line.index(b"\t")] for line in lines]
+    nodes, labels = build_city_trie(keys)
+
+    cells = []
+    for _, lat, lon, _ in entries:
+        row, col = city_grid_cell(lat / _CITY_COORD_SCALE, lon / _CITY_COORD_SCALE)
+        cells.append(row * _CITY_GRID_COLS + col)
+    cell_counts = [0] * (_CITY_GRID_ROWS * _CITY_GRID_COLS + 1)
+    for cell in cells:
+        cell_counts[cell + 1] += 1
+    cell_starts = array("I", itertools.accumulate(cell_counts))
+    by_cell = array("I", sorted(range(len(cells)), key=cells.__getitem__))
+
+    offsets = array("I")
+    position = 0
+    for line in lines:
+        offsets.append(position)
+        position += len(line)
+
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_CITY_INDEX_HEADER.pack(CITY_INDEX_MAGIC, CITY_INDEX_VERSION, len(lines), len(nodes), len(labels)))
+        f.write(offsets.tobytes())
+        f.write(b"".join(_TRIE_NODE.pack(*node) for node in nodes))
+        for column in (1, 2):
+            f.write(array("i", (entry[column] for entry in entries)).tobytes())
+        f.write(array("I", (entry[3] for entry in entries)).tobytes())
+        f.write(cell_starts.tobytes())
+        f.write(by_cell.tobytes())
+        f.write(labels)
+        f.writelines(lines)
+    os.replace(temp_path, index_path)
+    return len(lines)
+
+class CityIndex:
+    """Memory-mapped, read-only view of a city index file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.node_count, label_size = _CITY_INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != CITY_INDEX_MAGIC or version != CITY_INDEX_VERSION:
+            raise ValueError(f"Unsupported city index format in {path}")
+        offsets_start = _CITY_INDEX_HEADER.size
+        self._nodes_start = offsets_start + self.count * 4
+        view = memoryview(self._map)
+        sections = []
+        position = self._nodes_start + self.node_count * _TRIE_NODE.size
+        for code, length in (("i", self.count), ("i", self.count), ("I", self.count),
+                             ("I", _CITY_GRID_ROWS * _CITY_GRID_COLS + 1), ("I", self.count)):
+            sections.append(view[position:position + length * 4].cast(code))
+            position += length * 4
+        self._lats, self._lons, self._populations, self._cell_starts, self._by_cell = sections
+        self._labels_start = position
+        self._blob_start = self._labels_start + label_size
+        self._offsets = view[offsets_start:self._nodes_start].cast("I")
+
+    def node(self, index: int) -> Tuple[bytes, int, int, int, int]:
+        """Return (edge label, first child, child count, first city, end city) for a trie node."""
+        label_offset, label_length, first_child, child_count, start, end = _TRIE_NODE.unpack_from(
+            self._map, self._nodes_start + index * _TRIE_NODE.size)
+        label_start = self._labels_start + label_offset
+        return self._map[label_start:label_start + label_length], first_child, child_count, start, end
+
+    def key(self, index: int) -> bytes:
+        start = self._blob_start + self._offsets[index]
+        return self._map[start:self._map.find(b"\t", start)]
+
+    def record(self, index: int) -> CityRecord:
+        start = self._blob_start + self._offsets[index]
+        line = self._map[start:self._map.find(b"\n", start)]
+        _, city_id, name, state, country, lat, lon, population = line.decode("utf-8").split("\t")
+        return CityRecord(int(city_id), name, state, country, float(lat), float(lon), int(population))
+
+    def prefix_range(self, prefix: bytes) -> Tuple[int, int]:
+        """Index range of all cities whose folded name starts with prefix."""
+        _, first_child, child_count, start, end = self.node(0)
+        depth = 0
+        while depth < len(prefix):
+            for child in range(first_child, first_child + child_count):
+                label, child_first, child_children, child_start, child_end = self.node(child)
+                if label[0] == prefix[depth]:
+                    overlap = min(len(label), len(prefix) - depth)
+                    if label[:overlap] != prefix[depth:depth + overlap]:
+                        return 0, 0
+                    depth += overlap
+                    first_child, child_count, start, end = child_first, child_children, child_start, child_end
+                    break
+            else:
+                return 0, 0
+        return start, end
+
+    def fuzzy_ranges(self, target: bytes, max_distance: int) -> List[Tuple[int, int, int]]:
+        """
+        Walk the trie with one edit-distance row per character (insertions,
+        deletions, substitutions and transpositions) and return
+        (start, end, distance) for every subtree whose prefix is within
+        max_distance of target. Branches are pruned as soon as no
+        extension can get back under the limit.
+        """
+        size = len(target)
+        over = max_distance + 1  # stands in for every distance past the limit
+        ranges = []
+        _, first_child, child_count, _, _ = self.node(0)
+        first_row = [j if j <= max_distance else over for j in range(size + 1)]
+        stack = [(first_child, child_count, 0, first_row, None, -1)]
+        while stack:
+            first_child, child_count, parent_depth, parent_row, grandparent_row, parent_char = stack.pop()
+            for child in range(first_child, first_child + child_count):
+                label, child_first, child_children, start, end = self.node(child)
+                depth, row, previous_row, previous_char = parent_depth, parent_row, grandparent_row, parent_char
+                best = over
+                alive = True
+                for char in label:
+                    depth += 1
+                    # Only the diagonal band |depth - j| <= max_distance can stay under the limit
+                    low, high = max(1, depth - max_distance), min(size, depth + max_distance)
+                    current = [over] * (size + 1)
+                    current[0] = depth if depth <= max_distance else over
+                    row_min = current[0]
+                    for j in range(low, high + 1):
+                        cost = row[j - 1] + (target[j - 1] != char)
+                        if row[j] + 1 < cost:
+                            cost = row[j] + 1
+                        if current[j - 1] + 1 < cost:
+                            cost = current[j - 1] + 1
+                        if (j > 1 and previous_row is not None and char == target[j - 2]
+                                and previous_char == target[j - 1] and previous_row[j - 2] + 1 < cost):
+                            cost = previous_row[j - 2] + 1
+                        if cost > over:
+                            cost = over
+                        current[j] = cost
+                        if cost < row_min:
+                            row_min = cost
+                    previous_row, row, previous_char = row, current, char
+                    if current[size] < best:
+                        best = current[size]
+                    if row_min > max_distance or depth >= size + max_distance:
+                        alive = False
+                        break
+                if best <= max_distance:
+                    ranges.append((start, end, best))
+                if alive:
+                    stack.append((child_first, child_children, depth, row, previous_row, previous_char))
+        return ranges
+
+    def search(self, query: str, limit: int = 10, country: str = "", max_scan: int = 2000) -> List[Tuple[CityRecord, int]]:
+        """
+        Return up to limit (record, edit distance) matches for a query.
+        Prefix matches come first (distance 0), ranked by exact match and
+        population; approximate prefix matches fill the remaining slots.
+        """
+        key = search_key(query)
+        if not key:
+            return []
+        encoded = key.encode("utf-8")
+        country = country.upper()
+
+        start, end = self.prefix_range(encoded)
+        matches = []
+        for index in range(start, min(end, start + max_scan)):
+            record = self.record(index)
+            if not country or record.country == country:
+                matches.append((record, 0, self.key(index) != encoded))
+        matches.sort(key=lambda match: (match[2], -match[0].population, len(match[0].name)))
+        results = [(record, distance) for record, distance, _ in matches[:limit]]
+
+        if len(results) < limit and len(key) >= 3:
+            seen = {record.id for record, _ in results}
+            best: Dict[int, int] = {}
+            for range_start, range_end, distance in self.fuzzy_ranges(encoded, 1):
+                for index in range(range_start, min(range_end, range_start + max_scan)):
+                    if distance < best.get(index, distance + 1):
+                        best[index] = distance
+            fuzzy = []
+            for index, distance in best.items():
+                record = self.record(index)
+                if distance and record.id not in seen and (not country or record.country == country):
+                    fuzzy.append((record, distance))
+            fuzzy.sort(key=lambda match: (match[1], -match[0].population, len(match[0].name)))
+            results.extend(fuzzy[:limit - len(results)])
+
+        return results
+
+    def grid_cities(self, south: float, west: float, north: float, east: float) -> Iterator[int]:
+        """Yield the indices of all cities in grid cells overlapping a box; west > east crosses the antimeridian."""
+        first_row, first_col = city_grid_cell(south, west)
+        last_row, last_col = city_grid_cell(north, east)
+        if east - west >= 360:
+            columns = range(_CITY_GRID_COLS)
+        elif west <= east and first_col <= last_col:
+            columns = range(first_col, last_col + 1)
+        else:
+            columns = list(itertools.chain(range(first_col, _CITY_GRID_COLS), range(0, last_col + 1)))
+        for row in range(first_row, last_row + 1):
+            base = row * _CITY_GRID_COLS
+            for col in columns:
+                cell = base + col
+                yield from self._by_cell[self._cell_starts[cell]:self._cell_starts[cell + 1]]
+
+    def within_radius(self, lat: float, lon: float, radius_km: float) -> List[Tuple[int, float]]:
+        """(city index, distance in km) of every city within radius_km of a point."""
+        lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+        south, north = max(lat - lat_delta, -90.0), min(lat + lat_delta, 90.0)
+        widest = max(abs(south), abs(north))
+        lon_delta = 180.0 if widest >= 89.9 else min(180.0, lat_delta / math.cos(math.radians(widest)))
+        lats, lons, scale = self._lats, self._lons, _CITY_COORD_SCALE
+        matches = []
+        for index in self.grid_cities(south, lon - lon_delta, north, lon + lon_delta):
+            distance = haversine_km(lat, lon, lats[index] / scale, lons[index] / scale)
+            if distance <= radius_km:
+                matches.append((index, distance))
+        return matches
+
+    def within_box(self, south: float, west: float, north: float, east: float) -> List[Tuple[int, float]]:
+        """(city index, distance in km from the box center) of every city inside a box."""
+        center_lat, center_lon = bbox_center(west, south, east, north)
+        lats, lons, scale = self._lats, self._lons, _CITY_COORD_SCALE
+        wraps = west > east
+        matches = []
+        for index in self.grid_cities(south, west, north, east):
+            lat, lon = lats[index] / scale, lons[index] / scale
+            if south <= lat <= north and ((lon >= west or lon <= east) if wraps else west <= lon <= east):
+                matches.append((index, haversine_km(center_lat, center_lon, lat, lon)))
+        return matches
+
+    def spread(self, candidates: List[Tuple[int, float]], limit: int, spacing_km: float) -> List[Tuple[CityRecord, float]]:
+        """
+        Pick up to limit distinct places from (city index, distance)
+        candidates, most populous and then closest first. A first pass
+        keeps picks at least spacing_km apart so they cover the region
+        (neighbours are found through spacing-sized squares); a second
+        pass fills any remaining slots.
+        """
+        ranked = sorted(candidates, key=lambda candidate: (-self._populations[candidate[0]], candidate[1]))
+        spacing = max(spacing_km, 1.0) / (math.pi * EARTH_RADIUS_KM / 180)  # in degrees of latitude
+        picked, taken, names = [], set(), set()
+        squares: Dict[Tuple[int, int], List[Tuple[float, float]]] = {}
+        for spaced in (True, False):
+            for index, distance in ranked:
+                if len(picked) >= limit:
+                    break
+                if index in taken:
+                    continue
+                if spaced:
+                    lat, lon = self._lats[index] / _CITY_COORD_SCALE, self._lons[index] / _CITY_COORD_SCALE
+                    scale = max(math.cos(math.radians(lat)), 0.01)
+                    row, col = math.floor(lat / spacing), math.floor(lon * scale / spacing)
+                    if any((lat - other_lat) ** 2 + ((lon - other_lon) * scale) ** 2 < spacing ** 2
+                           for d_row in (-1, 0, 1) for d_col in (-1, 0, 1)
+                           for other_lat, other_lon in squares.get((row + d_row, col + d_col), ())):
+                        continue
+                record = self.record(index)
+                name = (self.key(index), record.country)
+                if name in names:  # the city list repeats places under several IDs
+                    continue
+                if spaced:
+                    squares.setdefault((row, col), []).append((lat, lon))
+                picked.append((record, distance))
+                taken.add(index)
+                names.add(name)
+        picked.sort(key=lambda pick: pick[1])
+        return picked
+
+_city_index: Optional[CityIndex] = None
+_city_index_lock = threading.Lock()
+
+def get_city_index() -> CityIndex:
+    """
+    Open the city index, building it on first use (or after a format
+    change) from CITY_LIST_PATH or, if that file does not exist, from
+    the OWM bulk download (except during a replay, which stays offline).
+    """
+    global _city_index
+    if _city_index is not None:
+        return _city_index
+    with _city_index_lock:
+        if _city_index is None:
+            index_path = CITY_INDEX_PATH
+            if os.path.exists(index_path):
+                with open(index_path, "rb") as f:
+                    header = f.read(_CITY_INDEX_HEADER.size)
+                if header[:8] != _CITY_INDEX_HEADER.pack(CITY_INDEX_MAGIC, CITY_INDEX_VERSION, 0, 0, 0)[:8]:
+                    os.remove(index_path)  # Written by an older format; rebuild
+            if not os.path.exists(index_path):
+                source_path = CITY_LIST_PATH
+                if not os.path.exists(source_path):
+                    if _replay is not None:
+                        raise FileNotFoundError(f"{source_path} does not exist and the city list is not downloaded during a replay")
+                    os.makedirs(os.path.dirname(source_path) or ".", exist_ok=True)
+                    response = get_http_client().get(CITY_LIST_URL, timeout=60)
+                    response.raise_for_status()
+                    with open(source_path, "wb") as f:
+                        f.write(response.content)
+                build_city_index(source_path, index_path)
+            _city_index = CityIndex(index_path)
+    return _city_index
+
+def render_location_matches(model: dict) -> str:
+    """Render location search results as text."""
+    if not model["matches"]:
+        return f"🔎 No locations found matching '{model['query']}'"
+
+    result = f"🔎 Locations matching '{model['query']}':\n\n"
+    for i, match in enumerate(model["matches"], 1):
+        place = ", ".join(part for part in (match["name"], match["state"], match["country"]) if part)
+        result += f"{i}. 📍 {place} ({match['lat']:.2f}, {match['lon']:.2f})"
+        if match["population"]:
+            result += f" · pop. {match['population']:,}"
+        if match["distance"]:
+            result += " · similar spelling"
+        result += "\n"
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def search_locations(query: str, limit: int = 10, country: str = "", output_format: str = "") -> str:
+    """Find cities by name prefix or approximate spelling from a local index, without calling the weather API."""
+    query = query.strip()
+    if not query:
+        return error_response("Error: Please provide a location name to search for", output_format)
+
+    try:
+        index = get_city_index()
+    except Exception as e:
+        return error_response(f"Error loading city index: {e}", output_format)
+
+    country_code = COUNTRY_CODES.get(country.strip().lower(), country.strip())
+    matches = index.search(query, max(1, min(limit, 50)), country_code)
+    model = {
+        "query": query,
+        "matches": [dict(record._asdict(), distance=distance) for record, distance in matches],
+    }
+    return respond(model, render_location_matches, output_format)
+
+NEARBY_MAX_PLACES = 60
+NEARBY_MAX_RADIUS_KM = 500
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """Parse "west,south,east,north" in degrees; west > east crosses the antimeridian."""
+    try:
+        west, south, east, north = (float(part) for part in bbox.split(","))
+    except ValueError:
+        raise ValueError('bbox must be "west,south,east,north" in degrees')
+    if not (-90 <= south < north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox latitudes must satisfy -90 <= south < north <= 90 and longitudes lie in -180..180")
+    return west, south, east, north
+
+def group_urls(ids: List[int]) -> List[str]:
+    """Bulk current-weather URLs covering the given city IDs, 20 per call."""
+    ids = sorted(ids)  # a stable order keeps the URLs cacheable
+    return [
+        f"{BASE_URL}/group?id={','.join(str(city_id) for city_id in ids[i:i + GROUP_MAX_IDS])}&units={UNITS}"
+        for i in range(0, len(ids), GROUP_MAX_IDS)
+    ]
+
+@traced("parse")
+def parse_nearby_weather(center: dict, radius_km: Optional[float], bbox: Optional[List[float]], candidates: int,
+                         picks: List[Tuple[CityRecord, float]], payloads: List[dict]) -> NearbyWeather:
+    """Join the picked places with their entries in the /group payloads."""
+    observed = {item.get("id"): item for data in payloads for item in data.get("list", [])}
+    places, missing = [], []
+    for record, distance in picks:
+        item = observed.get(record.id)
+        if item is None:
+            missing.append(place_name(record.name, record.country))
+            continue
+        places.append({
+            "id": record.id,
+            "name": record.name,
+            "state": record.state,
+            "country": record.country,
+            "lat": record.lat,
+            "lon": record.lon,
+            "distance_km": round(distance, 1),
+            "description": item["weather"][0]["description"].capitalize(),
+            "temp": item["main"]["temp"],
+            "feels_like": item["main"]["feels_like"],
+            "humidity": item["main"]["humidity"],
+            "wind_speed": item["wind"]["speed"],
+        })
+    return {
+        "name": center.get("name", ""),
+        "country": center.get("country", ""),
+        "lat": center["lat"],
+        "lon": center["lon"],
+        "radius_km": radius_km,
+        "bbox": bbox,
+        "candidates": candidates,
+        "requests": len(payloads),
+        "units": UNITS,
+        "places": places,
+        "missing": missing,
+    }
+
+def render_nearby_weather(model: NearbyWeather) -> str:
+    """Render weather across a region as text."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    speed_unit = "m/s" if model["units"] == "metric" else "mph"
+    if model["bbox"]:
+        west, south, east, north = model["bbox"]
+        region = f"in {south:.2f},{west:.2f} to {north:.2f},{east:.2f}"
+    else:
+        region = f"within {model['radius_km']:g} km of {place_name(model['name'], model['country'])}"
+    if not model["places"] and not model["missing"]:
+        return f"🗺️ No indexed places {region}"
+
+    requests = model["requests"]
+    result = (
+        f"🗺️ Weather {region} ({len(model['places'])} of {model['candidates']:,} places, "
+        f"{requests} bulk request{'s' if requests != 1 else ''}):\n\n"
+    )
+    for i, place in enumerate(model["places"], 1):
+        result += (
+            f"{i}. 📍 {place_name(place['name'], place['country'])} · {place['distance_km']:.0f} km: "
+            f"{place['description']}, {place['temp']:.1f}{unit_symbol} (feels like {place['feels_like']:.1f}{unit_symbol}), "
+            f"💧 {place['humidity']}%, 💨 {place['wind_speed']:.1f} {speed_unit}\n"
+        )
+    if model["places"]:
+        temps = [place["temp"] for place in model["places"]]
+        warmest = max(model["places"], key=lambda place: place["temp"])
+        coldest = min(model["places"], key=lambda place: place["temp"])
+        result += (
+            f"\n📊 Average {sum(temps) / len(temps):.1f}{unit_symbol} · warmest {warmest['name']} "
+            f"({warmest['temp']:.1f}{unit_symbol}) · coldest {coldest['name']} ({coldest['temp']:.1f}{unit_symbol})\n"
+        )
+    if model["missing"]:
+        result += f"⚠️ No data returned for: {', '.join(model['missing'])}\n"
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def get_weather_nearby(location: str = "", radius_km: float = 50, bbox: str = "", limit: int = 10,
+                       output_format: str = "") -> str:
+    """
+    Current weather for the main places within radius_km of a location, or inside a bounding box given as
+    bbox="west,south,east,north". Places come from the local city index and are fetched with bulk requests of
+    up to 20 cities each. The location may also be "lat,lon", a city ID or "zip=94040,us".
+    Set output_format="json" for structured output.
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+    if bool(location.strip()) == bool(bbox.strip()):
+        return error_response("Error: Please provide either a location (with radius_km) or a bbox", output_format)
+    limit = max(1, min(limit, NEARBY_MAX_PLACES))
+
+    try:
+        index = get_city_index()
+    except Exception as e:
+        return error_response(f"Error loading city index: {e}", output_format)
+
+    sources: Tuple[str, ...] = ()
+    box = None
+    if bbox.strip():
+        try:
+            west, south, east, north = parse_bbox(bbox)
+        except ValueError as e:
+            return error_response(f"Error: {e}", output_format)
+        box = [west, south, east, north]
+        center_lat, center_lon = bbox_center(west, south, east, north)
+        center = {"name": "", "country": "", "lat": center_lat, "lon": center_lon}
+        candidates = index.within_box(south, west, north, east)
+        degree_km = math.pi * EARTH_RADIUS_KM / 180
+        area = ((east - west) % 360 * math.cos(math.radians(center_lat)) * degree_km) * ((north - south) * degree_km)
+        radius_km = None
+    else:
+        city = clean_city_input(location)
+        success, center, sources = resolve_coordinates(parse_location(city))
+        if not success:
+            return error_response(f"Error: Could not find coordinates for {city}", output_format)
+        radius_km = max(1.0, min(float(radius_km), NEARBY_MAX_RADIUS_KM))
+        candidates = index.within_radius(center["lat"], center["lon"], radius_km)
+        area = math.pi * radius_km ** 2
+
+    picks = index.spread(candidates, limit, 0.7 * math.sqrt(area / limit))
+    urls = group_urls([record.id for record, _ in picks])
+    payloads = []
+    for url in urls:
+        success, data = make_http_request(url, timeout=10)
+        if not success:
+            return error_response(f"Error fetching weather data: {data}", output_format)
+        payloads.append(data)
+
+    def build() -> str:
+        try:
+            model = parse_nearby_weather(center, radius_km, box, len(candidates), picks, payloads)
+            return respond(model, render_nearby_weather, output_format)
+        except (KeyError, IndexError, TypeError) as e:
+            return error_response(f"Error parsing weather data: {e}", output_format)
+
+    variant = (resolve_output_format(output_format), radius_km, tuple(box or ()), limit)
+    return cached_render("get_weather_nearby", sources + tuple(urls), variant, build)
+
+@app.tool()
+@timed_tool
+def check_openweather_status(deep: bool = False) -> str:
+    """
+    Check the status of the OpenWeather tool and its dependencies, with
+    live cache, connection pool and latency figures. Set deep=True to
+    also probe the upstream round-trip time.
+    """
+    status_lines = []
+    status_lines.append("OpenWeather Tool Status:")
+    status_lines.append("=" * 30)
+
+    # Version information
+    status_lines.append(f"📦 Version: {__version__}")
+    status_lines.append(f"👤 Author: {__author__}")
+    status_lines.append(f"📄 License: {__license__}")
+
+    # Check API key
+    if len(API_KEYS) > 1:
+        benched = sum(1 for usage in api_key_usage() if usage["benched_for"])
+        status_lines.append(f"✅ API Keys: {len(API_KEYS)} configured ({len(API_KEYS) - benched} active, {benched} benched)")
+    elif API_KEY:
+        status_lines.append("✅ API Key: Configured")
+    else:
+        status_lines.append("❌ API Key: Missing (set OPENWEATHER_API_KEY)")
+
+    # Check HTTP client availability
+    try:
+        import httpx
+        status_lines.append(f"✅ HTTP client: httpx {httpx.__version__} available")
+    except ImportError:
+        status_lines.append("❌ HTTP client: httpx not available")
+
+    if orjson is not None:
+        status_lines.append(f"✅ JSON decoder: orjson {orjson.__version__}")
+    else:
+        status_lines.append("⚙️  JSON decoder: stdlib json (install orjson for faster decoding)")
+
+    # Check units setting
+    status_lines.append(f"⚙️  Units: {UNITS}")
+
+    # Negative cache for unknown locations
+    with _negative_cache_lock:
+        now = time.monotonic()
+        active = sum(1 for expires in _negative_cache.values() if expires > now)
+        blocked = sum(_negative_hits.values())
+        offenders = _not_found_counts.most_common(5)
+    status_lines.append(f"🔤 Location aliases: {len(_location_aliases)} learned")
+    status_lines.append(f"🚫 Negative cache: {active} unknown locations, {blocked} retries blocked (TTL {NEGATIVE_CACHE_TTL}s)")
+    for location_key, count in offenders:
+        status_lines.append(f"   • '{location_key}': {count} not found, {_negative_hits[location_key]} retries blocked")
+
+    # Background alert watcher
+    with _alert_watch_lock:
+        watching = len(_alert_watches)
+        failing = sum(1 for watch in _alert_watches.values() if watch.error)
+        changes = _alert_changes[-1]["seq"] if _alert_changes else 0
+    if watching:
+        status_lines.append(f"🔭 Alert watcher: {watching} locations every {ALERT_POLL_INTERVAL}s, {changes} changes detected, {failing} failing")
+
+    tile_stats = _tile_cache.stats
+    if tile_stats["hits"] or tile_stats["misses"]:
+        status_lines.append(
+            f"🗺️  Map tiles: {len(_tile_cache.entries)} cached, {_tile_cache.size / 1048576:.1f}/{TILE_CACHE_MB} MB, "
+            f"{tile_stats['hits']} hits, {tile_stats['misses']} misses, {tile_stats['prefetched']} prefetched, "
+            f"{tile_stats['stale']} served stale, {tile_stats['evicted']} evicted"
+        )
+
+    history = history_summary()
+    if history is not None:
+        status_lines.append(f"🗃️  History: {history[0]} observations for {history[1]} locations (kept {HISTORY_DAYS} days)")
+    elif _history_state["error"]:
+        status_lines.append(f"⚠️  History: {_history_state['error']}")
+
+    recorder = _recorder
+    if recorder is not None:
+        status_lines.append(f"⏺️ Recording traffic: {recorder.calls} calls, {recorder.responses} upstream responses → {recorder.path}")
+
+    # Profilers
+    with _profilers_lock:
+        profilers = list(_profilers.items())
+    for mode, sampler in profilers:
+        state = "running" if sampler.running else "finished"
+        status_lines.append(f"🔬 Profiler ({mode}): {state}, {sampler.ticks} ticks → {sampler.path}"
+                            + (f" (write failed: {sampler.error})" if sampler.error else ""))
+
+    # Upstream quota usage
+    usage = quota_report()
+    limit = f" of {usage['soft_limit']}" if usage["soft_limit"] else ""
+    status_lines.append(
+        f"📊 Upstream calls: {usage['calls']}{limit} in the last {usage['window_hours']}h "
+        f"({usage['last_hour']} in the last hour, projected {usage['projected']})"
+    )
+    if usage["cache_only"]:
+        status_lines.append("⛔ Quota soft limit reached: serving cached data only")
+    if _quota_state["error"]:
+        status_lines.append(f"⚠️  Quota persistence: {_quota_state['error']}")
+
+    # Live performance figures
+    problems = []
+    if usage["cache_only"]:
+        problems.append("quota soft limit reached")
+    status_lines.append("⚡ Performance:")
+    if deep:
+        rtt, outcome = probe_upstream()
+        if rtt is None:
+            problems.append("upstream unreachable")
+            status_lines.append(f"   • Upstream probe: failed ({outcome})")
+        else:
+            status_lines.append(f"   • Upstream probe: {rtt:.0f} ms ({outcome})")
+
+    hits, misses = _response_cache_stats["hits"], _response_cache_stats["misses"]
+    with _response_cache_lock:
+        cached = len(_response_cache)
+    ratio = f"{hits / (hits + misses):.0%}" if hits + misses else "n/a"
+    status_lines.append(f"   • Response cache: {cached}/{CACHE_MAX_ENTRIES} entries, hit ratio {ratio} ({hits} hits, {misses} misses)")
+    render_hits, render_misses = _render_stats["hits"], _render_stats["misses"]
+    render_ratio = f"{render_hits / (render_hits + render_misses):.0%}" if render_hits + render_misses else "n/a"
+    status_lines.append(f"   • Render cache: {len(_render_cache)}/{RENDER_CACHE_MAX_ENTRIES} entries, hit ratio {render_ratio}")
+    if _shard_ring is not None:
+        down = sum(1 for node in _shard_ring.nodes if node != SHARD_SELF and not peer_alive(node))
+        stats = shard_stats()
+        status_lines.append(
+            f"   • Sharding: {len(_shard_ring.nodes)} replicas ({down} unreachable), {stats['forwarded']} forwarded, "
+            f"{stats['served']} served for peers, {stats['adopted']} adopted"
+        )
+    if GROUP_BATCH_WINDOW_MS > 0:
+        batches, callers = _group_batcher.stats["batches"], _group_batcher.stats["callers"]
+        status_lines.append(
+            f"   • Group batching: {GROUP_BATCH_WINDOW_MS:g} ms window, {callers} fetches in {batches} /group requests "
+            f"({callers - batches} upstream calls saved), {len(_location_ids)} city IDs learned"
+        )
+    if _recommendation_stats["precomputed"]:
+        status_lines.append(
+            f"   • Recommendations: {_recommendation_stats['precomputed']} precomputed from /group answers, "
+            f"{_recommendation_stats['served']} served precomputed"
+        )
+
+    pool = connection_pool_state()
+    pool_limit = max(BATCH_CONCURRENCY * 2, 10)
+    if pool is None:
+        status_lines.append(f"   • Connection pool: state unavailable (limit {pool_limit})")
+    else:
+        status_lines.append(f"   • Connection pool: {pool[0]} open, {pool[1]} idle (limit {pool_limit})")
+
+    upstream = latency_percentiles(_upstream_latencies)
+    for family, (count, p50, p95, p99) in upstream.items():
+        errors = _upstream_errors[family]
+        status_lines.append(
+            f"   • Upstream {family}: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms "
+            f"(n={count}, {errors} errors)"
+        )
+    failed_families = [family for family, errors in _upstream_errors.items()
+                       if errors and errors >= len(_upstream_latencies.get(family, ())) / 2]
+    if failed_families:
+        problems.append(f"upstream errors on {', '.join(sorted(failed_families))}")
+    for tool, (count, p50, p95, p99) in latency_percentiles(_tool_latencies).items():
+        status_lines.append(f"   • {tool}: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms (n={count})")
+
+    if problems:
+        status_lines.append(f"⚠️  Health: degraded ({'; '.join(problems)})")
+    else:
+        status_lines.append("✅ Health: OK")
+
+    # Check UV environment
+    status_lines.append("✅ Dependencies: Managed by UV")
+
+    return "\n".join(status_lines)
+
+def render_quota_report(model: QuotaReport) -> str:
+    """Render upstream quota usage as text."""
+    result = f"📊 Upstream API usage (last {model['window_hours']}h):\n\n"
+    for usage in model["families"]:
+        limit = f" / {usage['limit']}" if usage["limit"] else ""
+        result += (f"• {usage['family']}: {usage['calls']}{limit} calls, "
+                   f"{usage['last_hour']} in the last hour (projected {usage['projected']})\n")
+    if not model["families"]:
+        result += "• No upstream calls recorded\n"
+
+    result += f"\n🔥 Burn rate: {model['last_hour']} calls/hour, projected {model['projected']} per {model['window_hours']}h\n"
+    if model["soft_limit"]:
+        result += f"🎯 Soft limit: {model['calls']}/{model['soft_limit']} calls used"
+        if model["hours_to_limit"] is not None and not model["cache_only"]:
+            result += f", reached in ~{model['hours_to_limit']}h at the current rate"
+        result += "\n"
+    if model["cache_only"]:
+        result += "⛔ Cache-only mode: upstream calls are suspended until usage drops below the limit\n"
+
+    if model["keys"]:
+        result += "\n🔑 API keys:\n"
+        for usage in model["keys"]:
+            result += (f"• {usage['key']}: {usage['calls']} calls, {usage['last_minute']} in the last minute "
+                       f"({usage['remaining']} left)")
+            if usage["rejected"]:
+                result += ", rejected " + ", ".join(f"{count}× HTTP {status}" for status, count in usage["rejected"].items())
+            if usage["benched_for"]:
+                result += f", benched for {usage['benched_for']}s"
+            if usage["benched_families"]:
+                result += ", benched from " + ", ".join(
+                    f"{family} for {seconds}s" for family, seconds in usage["benched_families"].items())
+            result += "\n"
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def get_api_usage(output_format: str = "") -> str:
+    """Report upstream OpenWeatherMap calls per API family and per API key, with a burn-rate projection against the soft limit."""
+    return respond(quota_report(), render_quota_report, output_format)
+
+@app.tool()
+@timed_tool
+def profile_server(seconds: int = 10, interval_ms: float = PROFILE_INTERVAL_MS) -> str:
+    """
+    Sample the server's Python stacks for a time window and write a
+    collapsed-stack profile (for flamegraph.pl or speedscope) to the data directory.
+    """
+    seconds = max(1, min(seconds, 300))
+    interval_ms = max(1.0, min(interval_ms, 1000.0))
+    try:
+        sampler = start_window_profile(seconds, interval_ms)
+    except RuntimeError as e:
+        return f"Error: {e}"
+    return (
+        f"🔬 Profiling all threads for {seconds}s every {interval_ms:g} ms\n"
+        f"📄 Collapsed stacks will be written to {sampler.path}\n"
+        f"🔥 Open the file in https://www.speedscope.app or pipe it through flamegraph.pl"
+    )
+
+@app.tool()
+@timed_tool
+def record_traffic(enabled: bool = True) -> str:
+    """
+    Start or stop recording anonymized tool calls and upstream responses
+    to a replayable file in the data directory.
+    """
+    global _recorder
+    if not enabled:
+        recorder = stop_recording()
+        if recorder is None:
+            return "ℹ️ No traffic recording is active"
+        return f"⏹️ Recorded {recorder.calls} calls and {recorder.responses} upstream responses to {recorder.path}"
+
+    with _recorder_lock:
+        if _recorder is not None:
+            return f"ℹ️ Already recording to {_recorder.path} ({_recorder.calls} calls so far)"
+        path = os.path.join(RECORDING_DIR, f"traffic-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl.gz")
+        try:
+            _recorder = TrafficRecorder(path)
+        except OSError as e:
+            return f"Error: could not create {path}: {e}"
+    return (
+        f"⏺️ Recording tool calls and upstream responses to {path}\n"
+        f"▶️ Replay with: python openweather.py replay {path} --speed 10"
+    )
+
+@app.tool()
+@timed_tool
+def shard_membership(peers: str = "") -> str:
+    """
+    Show the replica ring used for location sharding: each replica's share
+    of the key space and whether it is reachable. Pass a comma-separated
+    list of replica URLs to replace the ring when a replica joins or leaves.
+    Only this replica's ring changes; send the same list to every replica.
+    """
+    global _shard_ring
+    if _shard_ring is None:
+        return "ℹ️ Sharding is disabled (set SHARD_PEERS and SHARD_SELF)"
+
+    lines = []
+    if peers.strip():
+        ring = HashRing(shard_peer_list(peers))
+        samples = 4096
+        moved = sum(
+            next(_shard_ring.successors(f"sample-{i}")) != next(ring.successors(f"sample-{i}"))
+            for i in range(samples)
+        )
+        _shard_ring = ring
+        lines.append(f"🔁 Ring updated on this replica: about {moved / samples:.0%} of location keys changed owner")
+        lines.append("⚠️ Other replicas keep their own ring; send them the same peer list")
+
+    count = len(_shard_ring.nodes)
+    lines.append(f"🧭 Shard ring: {count} replica{'s' if count != 1 else ''}, {SHARD_VNODES} virtual nodes each")
+    for node, share in sorted(_shard_ring.shares().items()):
+        retry_in = peer_retry_in(node)  # one read, so a peer recovering meanwhile cannot vanish mid-report
+        if node == SHARD_SELF:
+            state = "this replica"
+        elif not retry_in:
+            state = "reachable"
+        else:
+            state = f"unreachable, retry in {retry_in:.0f}s"
+        lines.append(f"   • {node}: {share:.1%} of keys ({state})")
+    stats = shard_stats()
+    lines.append(
+        f"📨 Forwarded {stats['forwarded']} · served for peers {stats['served']} · "
+        f"adopted from peers {stats['adopted']} · peer errors {stats['peer errors']}"
+    )
+    return "\n".join(lines)
+
+@app.tool()
+@timed_tool
+def get_openweather_version() -> str:
+    """Get version information for the OpenWeather MCP server."""
+    return f"""
+OpenWeather MCP Server
+Version: {__version__}
+Author: {__author__}
+License: {__license__}
+
+Features:
+• Current weather conditions
+• 5-day weather forecasts
+• Multi-city batch forecast summaries
+• Offline location search and autocomplete
+• Weather alerts and warnings
+• Background alert watcher with change feed
+• Air quality index and pollution data
+• Air quality forecast and history analysis
+• Nearby and bounding-box weather from a spatial city index
+• Micro-batching of concurrent current-weather fetches
+• Consistent-hash sharding across replicas
+• Detailed astronomy data (sunrise, sunset, moon phases)
+• Multi-city weather comparison
+• Weather-based activity recommendations
+• Multiple unit systems (imperial/metric)
+• Structured JSON output mode
+• Delta mode for polling clients
+• Upstream quota accounting and cache-only mode
+• API key pool with load balancing
+• Comprehensive error handling
+• Tracing and sampling profiler
+• Traffic recording and offline replay
+• Local weather history with hourly and daily rollups
+• Weather map tile proxy with disk cache
+• UV-based dependency management
+
+Last updated: 2024-12-08
+    """.strip()
+
+def alert_emoji(event: str) -> str:
+    """Pick an emoji for an alert based on its event type."""
+    event = event.lower()
+    return "🌪️" if "tornado" in event else \
+           "⛈️" if any(word in event for word in ["storm", "thunder", "lightning"]) else \
+           "🌨️" if any(word in event for word in ["snow", "blizzard", "ice"]) else \
+           "🌊" if "flood" in event else \
+           "🔥" if "fire" in event else \
+           "💨" if "wind" in event else "⚠️"
+
+@traced("parse")
+def parse_alerts(location: dict, data: dict) -> AlertReport:
+    """Extract active alerts from a One Call payload."""
+    return {
+        "name": location["name"],
+        "country": location.get("country", ""),
+        "alerts": [
+            {
+                "event": alert.get("event", "Weather Alert"),
+                "sender": alert.get("sender_name", "Weather Service"),
+                "start": alert["start"],
+                "end": alert["end"],
+                "description": alert.get("description", "No description available"),
+            }
+            for alert in data.get("alerts", [])
+        ],
+    }
+
+def render_alerts(model: AlertReport) -> str:
+    """Render active alerts as text."""
+    if not model["alerts"]:
+        return f"🟢 No weather alerts for {place_name(model['name'], model['country'])}"
+
+    result = f"⚠️ Weather Alerts for {place_name(model['name'], model['country'])}:\n\n"
+
+    for i, alert in enumerate(model["alerts"], 1):
+        start = datetime.utcfromtimestamp(alert["start"]).strftime("%Y-%m-%d %H:%M UTC")
+        end = datetime.utcfromtimestamp(alert["end"]).strftime("%Y-%m-%d %H:%M UTC")
+        description = alert["description"]
+
+        result += f"{alert_emoji(alert['event'])} Alert #{i}: {alert['event']}\n"
+        result += f"📅 From: {start}\n"
+        result += f"📅 To: {end}\n"
+        result += f"📡 Source: {alert['sender']}\n"
+        result += f"📝 Details: {description[:200]}{'...' if len(description) > 200 else ''}\n\n"
+
+    return result.strip()
+
+@traced("geocode")
+def resolve_coordinates(location: LocationInput) -> Tuple[bool, any, Tuple[str, ...]]:
+    """
+    Find the coordinates for a location as (success, {"name", "country",
+    "lat", "lon"} or error, source URLs). Coordinates are used as given
+    without any upstream call; postal codes, city IDs and names need one
+    cached lookup.
+    """
+    if location.coords:
+        lat, lon = location.coords
+        return True, {"name": f"{lat:.2f}, {lon:.2f}", "country": "", "lat": lat, "lon": lon}, ()
+
+    if location.kind == "zip":
+        url = f"http://api.openweathermap.org/geo/1.0/zip?{location.query}"
+        success, data = make_http_request(url, timeout=10, location_key=location.key)
+        found = success and isinstance(data, dict) and "lat" in data
+        return found, data if found else None, (url,)
+
+    if location.kind == "id":
+        url = f"{BASE_URL}/weather?{location.query}&units={UNITS}"
+        success, data = make_http_request(url, timeout=10, location_key=location.key)
+        if not success or not isinstance(data, dict) or "coord" not in data:
+            return False, None, (url,)
+        place = {
+            "name": data.get("name", ""),
+            "country": data.get("sys", {}).get("country", ""),
+            "lat": data["coord"]["lat"],
+            "lon": data["coord"]["lon"],
+        }
+        return True, place, (url,)
+
+    url = f"http://api.openweathermap.org/geo/1.0/direct?q={location.key}&limit=1"
+    success, data = make_http_request(url, timeout=10, location_key=location.key)
+    found = success and bool(data)
+    return found, data[0] if found else None, (url,)
+
+# ---------------------------------------------------------------------------
+# Weather history: every fresh /weather observation (and every city of a
+# bulk /group response) is appended to a SQLite store, and hourly and daily
+# rollups are updated in the same transaction, so history queries never
+# need an upstream call
+# ---------------------------------------------------------------------------
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, name TEXT, country TEXT,
+    owm_id INTEGER, lat REAL, lon REAL, timezone INTEGER
+);
+CREATE TABLE IF NOT EXISTS location_queries (query TEXT PRIMARY KEY, location INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS observations (
+    location INTEGER NOT NULL, dt INTEGER NOT NULL, temp REAL, humidity REAL,
+    pressure REAL, wind REAL, condition TEXT, PRIMARY KEY (location, dt)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    location INTEGER NOT NULL, period TEXT NOT NULL, start INTEGER NOT NULL, n INTEGER NOT NULL,
+    temp_sum REAL, temp_min REAL, temp_max REAL, humidity_sum REAL, pressure_sum REAL,
+    wind_sum REAL, wind_max REAL, PRIMARY KEY (location, period, start)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_conditions (
+    location INTEGER NOT NULL, period TEXT NOT NULL, start INTEGER NOT NULL, condition TEXT NOT NULL,
+    n INTEGER NOT NULL, PRIMARY KEY (location, period, start, condition)
+) WITHOUT ROWID;
+"""
+
+ROLLUP_UPSERT = """
+INSERT INTO rollups VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (location, period, start) DO UPDATE SET
+    n = n + 1, temp_sum = temp_sum + excluded.temp_sum,
+    temp_min = min(temp_min, excluded.temp_min), temp_max = max(temp_max, excluded.temp_max),
+    humidity_sum = humidity_sum + excluded.humidity_sum, pressure_sum = pressure_sum + excluded.pressure_sum,
+    wind_sum = wind_sum + excluded.wind_sum, wind_max = max(wind_max, excluded.wind_max)
+"""
+
+CONDITION_UPSERT = """
+INSERT INTO rollup_conditions VALUES (?, ?, ?, ?, 1)
+ON CONFLICT (location, period, start, condition) DO UPDATE SET n = n + 1
+"""
+
+HISTORY_PRUNE_INTERVAL = 3600  # seconds between retention sweeps
+HISTORY_NEARBY_DEGREES = 0.25  # coordinate queries match stored locations this close
+HISTORY_RESOLUTIONS = {"hourly": "hour", "daily": "day"}
+
+_history_db: Optional[sqlite3.Connection] = None
+_history_lock = threading.Lock()
+_history_state = {"error": "", "pruned_at": float("-inf")}
+
+class HistoryBucket(TypedDict):
+    """Rollup of the observations in one hour or local day"""
+    start: int
+    observations: int
+    min_temp: float
+    max_temp: float
+    mean_temp: float
+    mean_humidity: float
+    mean_pressure: float
+    mean_wind: float
+    max_wind: float
+    condition: str
+
+class WeatherHistory(TypedDict):
+    """Stored observations for one location, rolled up by hour or day"""
+    name: str
+    country: str
+    timezone: int
+    units: str
+    resolution: str
+    days: int
+    observations: int
+    buckets: List[HistoryBucket]
+
+def history_connection() -> Optional[sqlite3.Connection]:
+    """Open the history store on first use. Caller holds the lock."""
+    global _history_db
+    if _history_db is None and HISTORY_PATH:
+        try:
+            os.makedirs(os.path.dirname(HISTORY_PATH) or ".", exist_ok=True)
+            db = sqlite3.connect(HISTORY_PATH, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(HISTORY_SCHEMA)
+            _history_db = db
+        except sqlite3.Error as e:
+            _history_state["error"] = f"could not open {HISTORY_PATH}: {e}"
+    return _history_db
+
+def to_metric(temp: float, wind: float) -> Tuple[float, float]:
+    """Convert a temperature and wind speed in UNITS to °C and m/s (the stored units)."""
+    if UNITS == "imperial":
+        return (temp - 32) * 5 / 9, wind * 0.44704
+    return temp, wind
+
+def from_metric(temp: float, wind: float) -> Tuple[float, float]:
+    """Convert a stored temperature and wind speed back to UNITS."""
+    if UNITS == "imperial":
+        return temp * 9 / 5 + 32, wind / 0.44704
+    return temp, wind
+
+def history_observation(data: any) -> Optional[tuple]:
+    """
+    Extract (location key, name, country, OWM id, lat, lon, timezone, dt,
+    temp, humidity, pressure, wind, condition) from a /weather payload or
+    one /group list item, with temperature and wind in metric units.
+    """
+    if not isinstance(data, dict) or "main" not in data:
+        return None
+    try:
+        dt = int(data["dt"])
+        timezone_offset = int(data.get("timezone", data.get("sys", {}).get("timezone", 0)))
+        temp, wind = to_metric(data["main"]["temp"], data.get("wind", {}).get("speed", 0.0))
+        humidity = data["main"].get("humidity", 0)
+        pressure = data["main"].get("pressure", 0)
+        condition = data["weather"][0]["description"].capitalize() if data.get("weather") else ""
+        name, country = data.get("name", ""), data.get("sys", {}).get("country", "")
+        owm_id = data.get("id") or None
+        lat, lon = data["coord"]["lat"], data["coord"]["lon"]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    key = f"id={owm_id}" if owm_id else normalize_location_key(f"{name},{country}" if name else f"{lat:.2f},{lon:.2f}")
+    return key, name, country, owm_id, lat, lon, timezone_offset, dt, temp, humidity, pressure, wind, condition
+
+def history_record(url: str, location_key: Optional[str], data: any) -> None:
+    """
+    Store fresh observations from a /weather payload (or every city of a
+    /group payload) and fold them into their hourly and daily rollups.
+    """
+    if not HISTORY_PATH:
+        return
+    if "/weather?" in url:
+        observations = [history_observation(data)]
+    elif "/group?" in url and isinstance(data, dict):
+        observations = [history_observation(item) for item in data.get("list", [])]
+        location_key = None  # the query names several places
+    else:
+        return
+    observations = [observation for observation in observations if observation is not None]
+    if not observations:
+        return
+
+    with _history_lock:
+        db = history_connection()
+        if db is None:
+            return
+        try:
+            with db:
+                for key, name, country, owm_id, lat, lon, timezone_offset, dt, temp, humidity, pressure, wind, condition in observations:
+                    day_start = (dt + timezone_offset) // SECONDS_PER_DAY * SECONDS_PER_DAY - timezone_offset
+                    db.execute(
+                        "INSERT INTO locations (key, name, country, owm_id, lat, lon, timezone) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET name = excluded.name, country = excluded.country, timezone = excluded.timezone",
+                        (key, name, country, owm_id, lat, lon, timezone_offset),
+                    )
+                    location = db.execute("SELECT id FROM locations WHERE key = ?", (key,)).fetchone()[0]
+                    if location_key:
+                        db.execute("INSERT OR REPLACE INTO location_queries VALUES (?, ?)", (location_key, location))
+                    inserted = db.execute(
+                        "INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (location, dt, temp, humidity, pressure, wind, condition),
+                    ).rowcount
+                    if inserted:  # the same upstream observation can be fetched twice
+                        for period, start in (("hour", dt // SECONDS_PER_HOUR * SECONDS_PER_HOUR), ("day", day_start)):
+                            db.execute(ROLLUP_UPSERT, (location, period, start, temp, temp, temp, humidity, pressure, wind, wind))
+                            db.execute(CONDITION_UPSERT, (location, period, start, condition))
+                if HISTORY_DAYS > 0 and time.monotonic() - _history_state["pruned_at"] >= HISTORY_PRUNE_INTERVAL:
+                    cutoff = int(time.time()) - HISTORY_DAYS * SECONDS_PER_DAY
+                    db.execute("DELETE FROM observations WHERE dt < ?", (cutoff,))
+                    db.execute("DELETE FROM rollups WHERE period = 'hour' AND start < ?", (cutoff,))
+                    db.execute("DELETE FROM rollup_conditions WHERE period = 'hour' AND start < ?", (cutoff,))
+                    _history_state["pruned_at"] = time.monotonic()
+            _history_state["error"] = ""
+        except sqlite3.Error as e:
+            _history_state["error"] = f"could not write {HISTORY_PATH}: {e}"
+
+def history_location(db: sqlite3.Connection, location: LocationInput) -> Optional[tuple]:
+    """
+    Find the stored location for a query: the exact query key seen at
+    fetch time, then its learned alias, the city ID, the nearest stored
+    point for coordinates, or the best-covered city of that name.
+    """
+    columns = "SELECT l.id, l.name, l.country, l.timezone FROM locations l"
+    for key in dict.fromkeys((location.key, canonical_location_key(location.key))):
+        row = db.execute(f"{columns} JOIN location_queries q ON q.location = l.id WHERE q.query = ?", (key,)).fetchone()
+        if row:
+            return row
+    if location.kind == "id":
+        return db.execute(f"{columns} WHERE l.owm_id = ?", (int(location.key[3:]),)).fetchone()
+    if location.coords:
+        lat, lon = location.coords
+        return db.execute(
+            f"{columns} WHERE abs(l.lat - ?) <= ? AND abs(l.lon - ?) <= ? "
+            "ORDER BY (l.lat - ?) * (l.lat - ?) + (l.lon - ?) * (l.lon - ?) LIMIT 1",
+            (lat, HISTORY_NEARBY_DEGREES, lon, HISTORY_NEARBY_DEGREES, lat, lat, lon, lon),
+        ).fetchone()
+    if location.kind == "name":
+        parts = canonical_location_key(location.key).split(",")
+        country = parts[-1] if len(parts) > 1 else None
+        return db.execute(
+            f"{columns} LEFT JOIN rollups r ON r.location = l.id AND r.period = 'day' "
+            "WHERE lower(l.name) = ? AND (? IS NULL OR lower(l.country) = ?) GROUP BY l.id ORDER BY sum(r.n) DESC LIMIT 1",
+            (parts[0], country, country),
+        ).fetchone()
+    return None
+
+def query_history(location: LocationInput, days: int, resolution: str) -> Tuple[bool, any]:
+    """Return (success, WeatherHistory or error) from the store alone."""
+    with _history_lock:
+        db = history_connection()
+        if db is None:
+            return False, _history_state["error"] or "weather history is disabled (HISTORY_PATH is empty)"
+        try:
+            found = history_location(db, location)
+            if found is None:
+                return False, "no observations stored for this location yet; they are recorded whenever its current weather is fetched"
+            location_id, name, country, timezone_offset = found
+            period = HISTORY_RESOLUTIONS[resolution]
+            now = int(time.time())
+            if period == "day":  # today and the days - 1 local days before it
+                today = (now + timezone_offset) // SECONDS_PER_DAY * SECONDS_PER_DAY - timezone_offset
+                since = today - (days - 1) * SECONDS_PER_DAY
+            else:
+                since = now - days * SECONDS_PER_DAY
+            rows = db.execute(
+                "SELECT start, n, temp_min, temp_max, temp_sum, humidity_sum, pressure_sum, wind_sum, wind_max, "
+                "(SELECT condition FROM rollup_conditions c WHERE c.location = r.location AND c.period = r.period "
+                " AND c.start = r.start ORDER BY c.n DESC, c.condition LIMIT 1) "
+                "FROM rollups r WHERE location = ? AND period = ? AND start >= ? ORDER BY start",
+                (location_id, period, since),
+            ).fetchall()
+        except sqlite3.Error as e:
+            return False, f"could not read {HISTORY_PATH}: {e}"
+
+    buckets: List[HistoryBucket] = []
+    for start, n, temp_min, temp_max, temp_sum, humidity_sum, pressure_sum, wind_sum, wind_max, condition in rows:
+        min_temp, mean_wind = from_metric(temp_min, wind_sum / n)
+        max_temp, max_wind = from_metric(temp_max, wind_max)
+        mean_temp, _ = from_metric(temp_sum / n, 0.0)
+        buckets.append({
+            "start": start,
+            "observations": n,
+            "min_temp": round(min_temp, 2),
+            "max_temp": round(max_temp, 2),
+            "mean_temp": round(mean_temp, 2),
+            "mean_humidity": round(humidity_sum / n, 1),
+            "mean_pressure": round(pressure_sum / n, 1),
+            "mean_wind": round(mean_wind, 2),
+            "max_wind": round(max_wind, 2),
+            "condition": condition or "",
+        })
+    return True, WeatherHistory(
+        name=name, country=country, timezone=timezone_offset, units=UNITS, resolution=resolution,
+        days=days, observations=sum(bucket["observations"] for bucket in buckets), buckets=buckets,
+    )
+
+def history_summary() -> Optional[Tuple[int, int]]:
+    """Return (observations, locations) in the store, or None when it is unavailable."""
+    with _history_lock:
+        db = history_connection()
+        if db is None:
+            return None
+        try:
+            return (
+                db.execute("SELECT count(*) FROM observations").fetchone()[0],
+                db.execute("SELECT count(*) FROM locations").fetchone()[0],
+            )
+        except sqlite3.Error:
+            return None
+
+def render_history(model: WeatherHistory) -> str:
+    """Render stored history as one line per hour or day plus a period summary."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    speed_unit = "m/s" if model["units"] == "metric" else "mph"
+    timezone_offset = model["timezone"]
+    place = place_name(model["name"], model["country"])
+    buckets = model["buckets"]
+
+    period = "day" if model["days"] == 1 else f"{model['days']} days"
+    result = f"📈 Weather history for {place} (last {period}, {model['resolution']}):\n\n"
+    if not buckets:
+        return result + "No observations stored in this period."
+
+    if model["resolution"] == "daily":
+        icon, label = "📅", lambda bucket: format_date(bucket["start"], timezone_offset)
+    else:
+        icon, label = "🕐", lambda bucket: datetime.utcfromtimestamp(bucket["start"] + timezone_offset).strftime("%a %H:00")
+
+    for bucket in buckets:
+        result += (
+            f"{icon} {label(bucket)}: {bucket['condition']}, "
+            f"{bucket['min_temp']:.1f}{unit_symbol} to {bucket['max_temp']:.1f}{unit_symbol} "
+            f"(avg {bucket['mean_temp']:.1f}{unit_symbol}), 💧 {bucket['mean_humidity']:.0f}%, "
+            f"💨 max {bucket['max_wind']:.1f} {speed_unit} · {bucket['observations']} obs\n"
+        )
+
+    warmest = max(buckets, key=lambda bucket: bucket["max_temp"])
+    coldest = min(buckets, key=lambda bucket: bucket["min_temp"])
+    mean = sum(bucket["mean_temp"] * bucket["observations"] for bucket in buckets) / model["observations"]
+    result += (
+        f"\n📊 Average {mean:.1f}{unit_symbol} · warmest {warmest['max_temp']:.1f}{unit_symbol} ({label(warmest)}) · "
+        f"coldest {coldest['min_temp']:.1f}{unit_symbol} ({label(coldest)}) · {model['observations']} observations"
+    )
+    return result
+
+@app.tool()
+@timed_tool
+def get_weather_history(city: str, days: int = 7, resolution: str = "daily", output_format: str = "") -> str:
+    """
+    Summarize how the weather has been at a location over the last days, from observations this server stored
+    (no upstream call). resolution is "daily" or "hourly". Accepts the same location forms as get_current_weather.
+    """
+    resolution = resolution.strip().lower()
+    if resolution not in HISTORY_RESOLUTIONS:
+        return error_response("Error: resolution must be \"daily\" or \"hourly\"", output_format)
+    days = max(1, min(days, 366))
+
+    city = clean_city_input(city)
+    success, result = query_history(parse_location(city), days, resolution)
+    if not success:
+        return error_response(f"Error: No weather history for {city}: {result}", output_format)
+    return respond(result, render_history, output_format)
+
+# ---------------------------------------------------------------------------
+# Map tiles: z/x/y PNG layers fetched through the pooled client and kept in
+# a size-bounded LRU cache on disk, with a lifetime per layer and
+# background prefetch of the neighboring tiles
+# ---------------------------------------------------------------------------
+
+TILE_URL = "https://tile.openweathermap.org/map/{layer}/{z}/{x}/{y}.png"
+TILE_MAX_ZOOM = 18
+TILE_PREFETCH_WORKERS = 2
+
+# Layer name -> (OWM layer, default lifetime in seconds)
+TILE_LAYERS = {
+    "clouds": ("clouds_new", 600),
+    "precipitation": ("precipitation_new", 600),
+    "wind": ("wind_new", 900),
+    "temp": ("temp_new", 1800),
+    "pressure": ("pressure_new", 1800),
+}
+TILE_LAYER_TTLS = {layer: parse_family_limits(TILE_TTLS).get(layer, ttl) for layer, (_, ttl) in TILE_LAYERS.items()}
+
+class TileCache:
+    """
+    LRU of tile files under a directory, bounded by total bytes. The index
+    is rebuilt from the directory on first use (oldest file first), and a
+    tile's age is its file's modification time.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # relative path -> (bytes, fetched at)
+        self.size = 0
+        self.stats: Counter = Counter()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        """Index the files already on disk. Caller holds the lock."""
+        self._loaded = True
+        found = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if name.endswith(".tmp"):
+                        os.remove(path)  # left over from an interrupted write
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, os.path.relpath(path, self.root), stat.st_size))
+        for fetched_at, relative, size in sorted(found):
+            self.entries[relative] = (size, fetched_at)
+            self.size += size
+        self._evict()
+
+    def _evict(self) -> None:
+        """Drop least recently used tiles until the cache fits. Caller holds the lock."""
+        while self.size > self.max_bytes and self.entries:
+            relative, (size, _) = self.entries.popitem(last=False)
+            self.size -= size
+            self.stats["evicted"] += 1
+            try:
+                os.remove(os.path.join(self.root, relative))
+            except OSError:
+                pass
+
+    def get(self, relative: str) -> Optional[Tuple[str, float]]:
+        """Return (path, age in seconds) of a cached tile and mark it recently used."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self.entries.get(relative)
+            if entry is None:
+                return None
+            self.entries.move_to_end(relative)
+        return os.path.join(self.root, relative), time.time() - entry[1]
+
+    def read(self, relative: str) -> Optional[Tuple[bytes, float]]:
+        """
+        Return (content, age in seconds) of a cached tile, or None. A tile
+        evicted between the lookup and the read, or an empty file, is a miss
+        and leaves the index.
+        """
+        cached = self.get(relative)
+        if cached is None:
+            return None
+        try:
+            with open(cached[0], "rb") as f:
+                content = f.read()
+        except OSError:
+            content = b""
+        if not content:
+            self.stats["read_errors"] += 1
+            self.discard(relative)
+            return None
+        return content, cached[1]
+
+    def discard(self, relative: str) -> None:
+        """Forget a tile and delete its file."""
+        with self._lock:
+            entry = self.entries.pop(relative, None)
+            if entry is not None:
+                self.size -= entry[0]
+        try:
+            os.remove(os.path.join(self.root, relative))
+        except OSError:
+            pass
+
+    def put(self, relative: str, content: bytes) -> None:
+        if not content:
+            return  # an empty body is not a tile
+        path = os.path.join(self.root, relative)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except OSError:
+            self.stats["write_errors"] += 1
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            previous = self.entries.pop(relative, None)
+            if previous is not None:
+                self.size -= previous[0]
+            self.entries[relative] = (len(content), time.time())
+            self.size += len(content)
+            self._evict()
+
+_tile_cache = TileCache(TILE_DIR, TILE_CACHE_MB * 1024 * 1024)
+_tile_prefetcher: Optional[ThreadPoolExecutor] = None
+_tile_prefetching: set = set()  # relative paths queued or in flight
+_tile_prefetch_lock = threading.Lock()
+
+def tile_path(layer: str, z: int, x: int, y: int) -> str:
+    """Cache path of a tile relative to TILE_DIR."""
+    return os.path.join(TILE_LAYERS[layer][0], str(z), str(x), f"{y}.png")
+
+def fetch_tile(layer: str, z: int, x: int, y: int) -> Tuple[bytes, str]:
+    """Fetch one tile upstream; returns (PNG bytes, "") or (b"", error)."""
+    url = TILE_URL.format(layer=TILE_LAYERS[layer][0], z=z, x=x, y=y)
+    response, error = signed_get(url, "tile", 10)
+    if error:
+        return b"", error
+    if not response.content:
+        return b"", f"Empty response for tile {layer}/{z}/{x}/{y}"
+    return response.content, ""
+
+def load_tile(layer: str, z: int, x: int, y: int) -> Tuple[bool, any, str]:
+    """
+    Return (success, Image or error, source) for one tile. source is
+    "cache", "upstream", or "stale" when an expired tile is served
+    because the upstream fetch failed.
+    """
+    relative = tile_path(layer, z, x, y)
+    cached = _tile_cache.read(relative)
+    if cached is not None and cached[1] < TILE_LAYER_TTLS[layer]:
+        _tile_cache.stats["hits"] += 1
+        return True, Image(data=cached[0], format="png"), "cache"
+
+    _tile_cache.stats["misses"] += 1
+    content, error = fetch_tile(layer, z, x, y)
+    if not error:
+        _tile_cache.put(relative, content)
+        return True, Image(data=content, format="png"), "upstream"
+    if cached is not None:
+        _tile_cache.stats["stale"] += 1
+        return True, Image(data=cached[0], format="png"), "stale"
+    return False, error, "error"
+
+def neighbor_tiles(z: int, x: int, y: int, radius: int) -> List[Tuple[int, int]]:
+    """Tiles within radius of (x, y) at zoom z, nearest ring first; x wraps around the antimeridian."""
+    size = 1 << z
+    rings = sorted(
+        ((dx, dy) for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1) if dx or dy),
+        key=lambda offset: max(abs(offset[0]), abs(offset[1])),
+    )
+    neighbors = dict.fromkeys(((x + dx) % size, y + dy) for dx, dy in rings if 0 <= y + dy < size)
+    neighbors.pop((x, y), None)
+    return list(neighbors)
+
+def prefetch_tile(layer: str, z: int, x: int, y: int) -> None:
+    relative = tile_path(layer, z, x, y)
+    try:
+        cached = _tile_cache.get(relative)
+        if cached is None or cached[1] >= TILE_LAYER_TTLS[layer]:
+            content, error = fetch_tile(layer, z, x, y)
+            if not error:
+                _tile_cache.put(relative, content)
+                _tile_cache.stats["prefetched"] += 1
+    finally:
+        with _tile_prefetch_lock:
+            _tile_prefetching.discard(relative)
+
+def schedule_tile_prefetch(layer: str, z: int, x: int, y: int) -> int:
+    """Queue fetches of the missing or expired neighbors of a tile; returns how many were queued."""
+    global _tile_prefetcher
+    if TILE_PREFETCH_RADIUS <= 0 or quota_block_reason("tile"):
+        return 0
+    queued = 0
+    with _tile_prefetch_lock:
+        if _tile_prefetcher is None:
+            _tile_prefetcher = ThreadPoolExecutor(max_workers=TILE_PREFETCH_WORKERS, thread_name_prefix="tile-prefetch")
+        for nx, ny in neighbor_tiles(z, x, y, TILE_PREFETCH_RADIUS):
+            relative = tile_path(layer, z, nx, ny)
+            cached = _tile_cache.get(relative)
+            if relative in _tile_prefetching or (cached is not None and cached[1] < TILE_LAYER_TTLS[layer]):
+                continue
+            _tile_prefetching.add(relative)
+            _tile_prefetcher.submit(prefetch_tile, layer, z, nx, ny)
+            queued += 1
+    return queued
+
+@app.tool()
+@timed_tool
+def get_weather_map_tile(layer: str, z: int, x: int, y: int) -> Image | str:
+    """
+    Get one OpenWeatherMap weather map tile as a PNG image (slippy-map z/x/y addressing).
+    layer is one of clouds, precipitation, wind, temp or pressure. Tiles are cached on disk
+    and the neighboring tiles are prefetched in the background.
+    """
+    layer = layer.strip().lower().removesuffix("_new")
+    if layer not in TILE_LAYERS:
+        return f"Error: Unknown layer '{layer}'. Choose one of: {', '.join(TILE_LAYERS)}"
+    if not 0 <= z <= TILE_MAX_ZOOM:
+        return f"Error: Zoom must be between 0 and {TILE_MAX_ZOOM}"
+    if not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        return f"Error: Tile {x}/{y} is outside zoom level {z} (0 to {(1 << z) - 1})"
+    if not API_KEY:
+        return MISSING_API_KEY
+
+    success, result, _ = load_tile(layer, z, x, y)
+    if not success:
+        return f"Error fetching map tile {layer}/{z}/{x}/{y}: {result}"
+    schedule_tile_prefetch(layer, z, x, y)
+    return result
+
+# ---------------------------------------------------------------------------
+# Alert watcher: polls registered locations in the background and records
+# new, changed and expired alerts by comparing per-alert fingerprints
+# ---------------------------------------------------------------------------
+
+ALERT_CHANGE_LOG_SIZE = 500
+
+class AlertChange(TypedDict):
+    """One incremental alert event from the watcher"""
+    seq: int
+    location: str
+    kind: str  # new, changed or expired
+    detected: int
+    alert: WeatherAlert
+
+class AlertWatch:
+    """A watched location and the last alert state seen for it."""
+
+    def __init__(self, location_key: str, location: dict):
+        self.location_key = location_key
+        self.location = location
+        self.url = f"https://api.openweathermap.org/data/3.0/onecall?lat={location['lat']}&lon={location['lon']}&exclude=minutely,hourly,daily"
+        self.report: Optional[AlertReport] = None
+        self.fingerprint: Dict[str, int] = {}
+        self.rendered: Dict[str, str] = {}  # output format -> response for the current report
+        self.checked_at = 0
+        self.error = ""
+
+_alert_watches: Dict[str, AlertWatch] = {}
+_alert_changes: deque = deque(maxlen=ALERT_CHANGE_LOG_SIZE)
+_alert_change_seq = itertools.count(1)
+_alert_watch_lock = threading.Lock()
+_alert_wakeup = threading.Event()
+_alert_thread: Optional[threading.Thread] = None
+
+def alert_identity(alert: WeatherAlert) -> str:
+    """Identity of an alert across polls: who issued which event, starting when."""
+    return f"{alert['sender']}|{alert['event']}|{alert['start']}"
+
+def alert_fingerprint(alerts: List[WeatherAlert]) -> Dict[str, int]:
+    """Map each alert's identity to a hash of the parts that can change (end time, text)."""
+    return {alert_identity(alert): hash((alert["end"], alert["description"])) for alert in alerts}
+
+def diff_alerts(
+    previous: Dict[str, int], current: Dict[str, int],
+    previous_alerts: List[WeatherAlert], current_alerts: List[WeatherAlert],
+) -> List[Tuple[str, WeatherAlert]]:
+    """Return (kind, alert) for every alert that appeared, changed or went away."""
+    changes = []
+    for alert in current_alerts:
+        identity = alert_identity(alert)
+        if identity not in previous:
+            changes.append(("new", alert))
+        elif previous[identity] != current[identity]:
+            changes.append(("changed", alert))
+    for alert in previous_alerts:
+        if alert_identity(alert) not in current:
+            changes.append(("expired", alert))
+    return changes
+
+def poll_alert_watch(watch: AlertWatch) -> int:
+    """
+    Refresh one watched location from upstream (never from the response
+    cache, which may be up to CACHE_TTL old); returns the number of
+    changes recorded.
+    """
+    success, data = make_http_request(watch.url, timeout=10, fresh=True)
+    now = int(time.time())
+    if not success:
+        watch.error = str(data)
+        return 0
+    try:
+        report = parse_alerts(watch.location, data)
+    except (KeyError, ValueError, TypeError) as e:
+        watch.error = f"Error parsing weather alerts: {e}"
+        return 0
+    report["alerts"] = [alert for alert in report["alerts"] if alert["end"] > now]
+    fingerprint = alert_fingerprint(report["alerts"])
+
+    with _alert_watch_lock:
+        watch.checked_at = now
+        watch.error = ""
+        if watch.report is not None and fingerprint == watch.fingerprint:
+            return 0
+        previous_alerts = watch.report["alerts"] if watch.report else []
+        changes = diff_alerts(watch.fingerprint, fingerprint, previous_alerts, report["alerts"])
+        for kind, alert in changes:
+            _alert_changes.append(AlertChange(
+                seq=next(_alert_change_seq), location=watch.location_key, kind=kind, detected=now, alert=alert,
+            ))
+        watch.report = report
+        watch.fingerprint = fingerprint
+        watch.rendered = {}
+    return len(changes)
+
+def _alert_watch_loop() -> None:
+    """Poll every watched location each ALERT_POLL_INTERVAL; exits when nothing is watched."""
+    global _alert_thread
+    while True:
+        _alert_wakeup.wait(max(1, ALERT_POLL_INTERVAL))
+        _alert_wakeup.clear()
+        with _alert_watch_lock:
+            if not _alert_watches:
+                _alert_thread = None
+                return
+            watches = list(_alert_watches.values())
+        for watch in watches:
+            try:
+                poll_alert_watch(watch)
+            except Exception as e:  # keep the watcher alive
+                watch.error = str(e)
+
+def watched_alerts(location_key: str) -> Optional[AlertWatch]:
+    """Return the watch for a location if it has been polled at least once."""
+    with _alert_watch_lock:
+        watch = _alert_watches.get(location_key)
+    return watch if watch is not None and watch.report is not None else None
+
+def render_alert_changes(model: dict) -> str:
+    """Render the alert change feed as text."""
+    if not model["changes"]:
+        return f"🔭 No alert changes since #{model['since']} (watching {model['watching']} locations)"
+
+    labels = {"new": "🆕 New", "changed": "✏️ Changed", "expired": "✅ Expired"}
+    result = f"🔭 Alert changes since #{model['since']}:\n\n"
+    for change in model["changes"]:
+        alert = change["alert"]
+        detected = datetime.utcfromtimestamp(change["detected"]).strftime("%Y-%m-%d %H:%M UTC")
+        result += f"#{change['seq']} {labels[change['kind']]}: {alert_emoji(alert['event'])} {alert['event']} for {change['location']} ({detected})\n"
+    result += f"\nNext cursor: {model['cursor']}"
+    return result
+
+@app.tool()
+@timed_tool
+def watch_weather_alerts(city: str, enabled: bool = True, output_format: str = "") -> str:
+    """
+    Start (or with enabled=False stop) background alert polling for a city.
+    Watched cities answer get_weather_alerts from the watcher's store, and
+    get_alert_changes lists new, changed and expired alerts.
+    """
+    global _alert_thread
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    city = clean_city_input(city)
+    location_key = parse_location(city).key
+    if not enabled:
+        with _alert_watch_lock:
+            removed = _alert_watches.pop(location_key, None)
+            if removed is not None and not _alert_watches:
+                _alert_wakeup.set()  # let the watcher thread exit
+        if removed is None:
+            return error_response(f"Error: {city} is not being watched", output_format)
+        return respond({"location": location_key, "watching": False}, lambda model: f"🔕 Stopped watching alerts for {city}", output_format)
+
+    success, place, _ = resolve_coordinates(parse_location(city))
+    if not success:
+        return error_response(f"Error: Could not find coordinates for {city}", output_format)
+
+    location_key = parse_location(city).key  # may have learned a more specific alias
+    with _alert_watch_lock:
+        watch = _alert_watches.get(location_key)
+        if watch is None and len(_alert_watches) >= ALERT_WATCH_MAX_LOCATIONS:
+            return error_response(f"Error: Already watching {ALERT_WATCH_MAX_LOCATIONS} locations (ALERT_WATCH_MAX_LOCATIONS)", output_format)
+        if watch is None:
+            watch = _alert_watches[location_key] = AlertWatch(location_key, place)
+        if _alert_thread is None:
+            _alert_thread = threading.Thread(target=_alert_watch_loop, name="alert-watcher", daemon=True)
+            _alert_thread.start()
+
+    poll_alert_watch(watch)
+    if watch.report is None:
+        return error_response(f"Error fetching weather alerts: {watch.error}", output_format)
+
+    model = {
+        "location": location_key,
+        "watching": True,
+        "poll_interval": ALERT_POLL_INTERVAL,
+        "alerts": watch.report["alerts"],
+    }
+    return respond(
+        model,
+        lambda model: f"🔔 Watching alerts for {city} every {ALERT_POLL_INTERVAL}s\n\n{render_alerts(watch.report)}",
+        output_format,
+    )
+
+@app.tool()
+@timed_tool
+def get_alert_changes(since: int = 0, output_format: str = "") -> str:
+    """List alerts that became new, changed or expired on watched cities since a cursor (the seq of the last change seen)."""
+    with _alert_watch_lock:
+        changes = [change for change in _alert_changes if change["seq"] > since]
+        watching = len(_alert_watches)
+        latest = _alert_changes[-1]["seq"] if _alert_changes else 0
+    model = {"since": since, "cursor": max(since, latest), "watching": watching, "changes": changes}
+    return respond(model, render_alert_changes, output_format)
+
+@app.tool()
+@timed_tool
+def get_weather_alerts(city: str, output_format: str = "") -> str:
+    """
+    Get weather alerts and warnings for the specified city. Set output_format="json" for structured output.
+    The city may also be "lat,lon" (skips geocoding), a city ID or "zip=94040,us". Cities registered with
+    watch_weather_alerts are answered from the watcher without an upstream call.
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+    location = parse_location(city)
+
+    # Watched locations answer from the watcher's store
+    watch = watched_alerts(location.key)
+    if watch is not None:
+        variant = resolve_output_format(output_format)
+        with _alert_watch_lock:
+            report, rendered = watch.report, watch.rendered.get(variant)
+        if rendered is None:
+            rendered = respond(report, render_alerts, output_format)
+            with _alert_watch_lock:
+                if watch.report is report:  # a poll may have replaced the report meanwhile
+                    watch.rendered[variant] = rendered
+        return rendered
+
+    # First get coordinates for the city (given coordinates skip geocoding)
+    success, place, sources = resolve_coordinates(location)
+
+    if not success:
+        return error_response(f"Error: Could not find coordinates for {city}", output_format)
+
+    lat = place["lat"]
+    lon = place["lon"]
+
+    # Get weather alerts using One Call API
+    alerts_url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&exclude=minutely,hourly,daily"
+    success, data = make_http_request(alerts_url, timeout=10)
+
+    if not success:
+        return error_response(f"Error fetching weather alerts: {data}", output_format)
+
+    def build() -> str:
+        try:
+            return respond(parse_alerts(place, data), render_alerts, output_format)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing weather alerts: {str(e)}", output_format)
+
+    return cached_render("get_weather_alerts", sources + (alerts_url,), (resolve_output_format(output_format),), build)
+
+# AQI level -> (emoji, level, description)
+AQI_LEVELS = {
+    1: ("🟢", "Good", "Air quality is satisfactory"),
+    2: ("🟡", "Fair", "Air quality is acceptable for most people"),
+    3: ("🟠", "Moderate", "Sensitive individuals may experience minor issues"),
+    4: ("🔴", "Poor", "Everyone may experience health effects"),
+    5: ("🟣", "Very Poor", "Health warnings of emergency conditions"),
+}
+AQI_UNKNOWN = ("❓", "Unknown", "Unknown air quality level")
+
+# Pollutant key -> display label, in display order
+AQI_COMPONENT_LABELS = [
+    ("co", "CO (Carbon Monoxide)"),
+    ("no", "NO (Nitrogen Monoxide)"),
+    ("no2", "NO₂ (Nitrogen Dioxide)"),
+    ("o3", "O₃ (Ozone)"),
+    ("so2", "SO₂ (Sulfur Dioxide)"),
+    ("pm2_5", "PM2.5 (Fine Particles)"),
+    ("pm10", "PM10 (Coarse Particles)"),
+    ("nh3", "NH₃ (Ammonia)"),
+]
+
+@traced("parse")
+def parse_air_quality(location: dict, data: dict) -> AirQuality:
+    """Extract the current AQI and pollutant concentrations from an air_pollution payload."""
+    aqi_data = data["list"][0]
+    aqi_index = aqi_data["main"]["aqi"]
+    _, level, summary = AQI_LEVELS.get(aqi_index, AQI_UNKNOWN)
+    return {
+        "name": location["name"],
+        "country": location.get("country", ""),
+        "aqi": aqi_index,
+        "level": level,
+        "summary": summary,
+        "components": aqi_data["components"],
+    }
+
+def render_air_quality(model: AirQuality) -> str:
+    """Render air quality data as text."""
+    aqi_index = model["aqi"]
+    emoji = AQI_LEVELS.get(aqi_index, AQI_UNKNOWN)[0]
+    components = model["components"]
+
+    result = f"🌬️ Air Quality for {place_name(model['name'], model['country'])}:\n\n"
+    result += f"📊 Overall AQI: {emoji} {model['level']} (Level {aqi_index}/5)\n"
+    result += f"📝 {model['summary']}\n\n"
+    result += "🧪 Pollutant Concentrations (μg/m³):\n"
+    for key, label in AQI_COMPONENT_LABELS:
+        result += f"• {label}: {components.get(key, 'N/A')}\n"
+
+    # Add health recommendations
+    if aqi_index >= 4:
+        result += "\n⚠️ Health Recommendations:\n"
+        result += "• Limit outdoor activities\n"
+        result += "• Wear a mask when outside\n"
+        result += "• Keep windows closed\n"
+        result += "• Use air purifiers indoors\n"
+    elif aqi_index == 3:
+        result += "\n💡 Recommendations:\n"
+        result += "• Sensitive individuals should limit outdoor activities\n"
+        result += "• Consider wearing a mask during exercise\n"
+
+    return result
+
+@app.tool()
+@timed_tool
+def get_air_quality(city: str, output_format: str = "") -> str:
+    """
+    Get air quality index and pollution data for the specified city. Set output_format="json" for structured output.
+    The city may also be "lat,lon" (skips geocoding), a city ID or "zip=94040,us".
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    # First get coordinates for the city (given coordinates skip geocoding)
+    success, place, sources = resolve_coordinates(parse_location(city))
+
+    if not success:
+        return error_response(f"Error: Could not find coordinates for {city}", output_format)
+
+    lat = place["lat"]
+    lon = place["lon"]
+
+    # Get air quality data
+    aqi_url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}"
+    success, data = make_http_request(aqi_url, timeout=10)
+
+    if not success:
+        return error_response(f"Error fetching air quality data: {data}", output_format)
+
+    def build() -> str:
+        try:
+            return respond(parse_air_quality(place, data), render_air_quality, output_format)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing air quality data: {str(e)}", output_format)
+
+    return cached_render("get_air_quality", sources + (aqi_url,), (resolve_output_format(output_format),), build)
+
+AIR_POLLUTION_URL = "http://api.openweathermap.org/data/2.5/air_pollution"
+AIR_QUALITY_CELL_DEGREES = 0.1  # nearby locations share one upstream series and cached response
+AIR_QUALITY_MAX_DAYS = {"forecast": 4, "history": 30}
+
+def coordinate_cell(lat: float, lon: float) -> Tuple[float, float]:
+    """Snap coordinates to the center of their AIR_QUALITY_CELL_DEGREES grid cell."""
+    step = AIR_QUALITY_CELL_DEGREES
+    return round(round(lat / step) * step, 4), round(round(lon / step) * step, 4)
+
+@traced("parse")
+def parse_air_quality_trend(place: dict, cell: Tuple[float, float], period: str, data: dict, start: int, end: int) -> AirQualityTrend:
+    """Daily peaks and per-pollutant statistics of the series points between start and end."""
+    series = slice_pollution(pollution_series(data), start, end)
+    if not series.timestamps:
+        raise ValueError("no air quality data points in the requested period")
+    timezone_offset = round(cell[1] / 15) * SECONDS_PER_HOUR  # local solar time; the payload carries no zone
+    days = []
+    for lo, hi in day_ranges(series.timestamps, timezone_offset):
+        first_dt = series.timestamps[lo]
+        aqi = series.aqi[lo:hi]
+        days.append({
+            "date": datetime.utcfromtimestamp(first_dt + timezone_offset).strftime("%Y-%m-%d"),
+            "first_dt": first_dt,
+            "max_aqi": max(aqi),
+            "mean_aqi": round(sum(aqi) / len(aqi), 2),
+            "maxima": {key: round(max(values[lo:hi]), 2) for key, values in series.components.items()},
+        })
+
+    pollutants = []
+    for key, values in series.components.items():
+        peak = max(values)
+        trend: PollutantTrend = {
+            "pollutant": key,
+            "mean": round(sum(values) / len(values), 2),
+            "max": round(peak, 2),
+            "max_dt": series.timestamps[values.index(peak)],
+            "guideline": None,
+            "window_hours": None,
+            "max_rolling_mean": None,
+            "exceedance_hours": None,
+        }
+        if key in POLLUTANT_GUIDELINES:
+            guideline, window = POLLUTANT_GUIDELINES[key]
+            means = rolling_means(values, window)
+            trend.update(
+                guideline=guideline,
+                window_hours=window,
+                max_rolling_mean=round(max(means), 2),
+                exceedance_hours=sum(map(guideline.__lt__, means)),
+            )
+        pollutants.append(trend)
+
+    return {
+        "name": place["name"],
+        "country": place.get("country", ""),
+        "lat": cell[0],
+        "lon": cell[1],
+        "period": period,
+        "timezone": timezone_offset,
+        "points": len(series.timestamps),
+        "days": days,
+        "pollutants": pollutants,
+    }
+
+def render_air_quality_trend(model: AirQualityTrend) -> str:
+    """Render daily AQI peaks and pollutant statistics as text."""
+    labels = dict(AQI_COMPONENT_LABELS)
+    short = {key: label.split(" ")[0] for key, label in AQI_COMPONENT_LABELS}
+    timezone_offset = model["timezone"]
+    span = f"{'next' if model['period'] == 'forecast' else 'past'} {max(1, round(model['points'] / 24))} days"
+
+    result = (
+        f"🌬️ Air Quality {model['period'].title()} for {place_name(model['name'], model['country'])} "
+        f"({span}, {model['points']} hourly points):\n\n"
+    )
+    result += "📅 Daily peaks (μg/m³):\n"
+    for day in model["days"]:
+        emoji, level, _ = AQI_LEVELS.get(day["max_aqi"], AQI_UNKNOWN)
+        peaks = " · ".join(f"{short[key]} {day['maxima'][key]:.1f}" for key in ("pm2_5", "pm10", "no2", "o3"))
+        result += (
+            f"• {format_date(day['first_dt'], timezone_offset)}: {emoji} AQI {day['max_aqi']} {level} "
+            f"(mean {day['mean_aqi']:.1f}) · {peaks}\n"
+        )
+
+    result += "\n🧪 Pollutants (rolling mean vs WHO 2021 guideline):\n"
+    for trend in model["pollutants"]:
+        peak_time = datetime.utcfromtimestamp(trend["max_dt"] + timezone_offset).strftime("%a %H:00")
+        line = f"• {labels[trend['pollutant']]}: mean {trend['mean']:.1f}, peak {trend['max']:.1f} ({peak_time})"
+        if trend["guideline"] is not None:
+            over = trend["exceedance_hours"]
+            line += (
+                f"; worst {trend['window_hours']}h mean {trend['max_rolling_mean']:.1f} / {trend['guideline']:g}"
+                f" → {'⚠️ ' if over else ''}{over} hours over"
+            )
+        result += line + "\n"
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def get_air_quality_trend(city: str, period: str = "forecast", days: int = 4, output_format: str = "") -> str:
+    """
+    Analyze hourly air quality for the next days (period="forecast", up to 4) or the past days (period="history",
+    up to 30): daily AQI and pollutant peaks, rolling means against WHO guidelines and hours over each guideline.
+    The city may also be "lat,lon", a city ID or "zip=94040,us". Set output_format="json" for structured output.
+    """
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    period = period.strip().lower()
+    if period not in AIR_QUALITY_MAX_DAYS:
+        return error_response('Error: period must be "forecast" or "history"', output_format)
+    days = max(1, min(days, AIR_QUALITY_MAX_DAYS[period]))
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    success, place, sources = resolve_coordinates(parse_location(city))
+    if not success:
+        return error_response(f"Error: Could not find coordinates for {city}", output_format)
+
+    lat, lon = coordinate_cell(place["lat"], place["lon"])
+    now = int(time.time()) // SECONDS_PER_HOUR * SECONDS_PER_HOUR  # hour-aligned so the URL is stable for an hour
+    if period == "forecast":
+        start, end = now, now + days * SECONDS_PER_DAY
+        url = f"{AIR_POLLUTION_URL}/forecast?lat={lat}&lon={lon}"
+    else:
+        start, end = now - days * SECONDS_PER_DAY, now
+        url = f"{AIR_POLLUTION_URL}/history?lat={lat}&lon={lon}&start={start}&end={end}"
+
+    success, data = make_http_request(url, timeout=10)
+    if not success:
+        return error_response(f"Error fetching air quality {period}: {data}", output_format)
+
+    def build() -> str:
+        try:
+            model = parse_air_quality_trend(place, (lat, lon), period, data, start, end)
+            return respond(model, render_air_quality_trend, output_format)
+        except (KeyError, ValueError, TypeError) as e:
+            return error_response(f"Error parsing air quality data: {e}", output_format)
+
+    return cached_render("get_air_quality_trend", sources + (url,), (resolve_output_format(output_format), days, start), build)
+
+# Upper bound of days since new moon -> (emoji, phase)
+MOON_PHASES = [
+    (1, "🌑", "New Moon"),
+    (7.4, "🌒", "Waxing Crescent"),
+    (8.4, "🌓", "First Quarter"),
+    (14.8, "🌔", "Waxing Gibbous"),
+    (15.8, "🌕", "Full Moon"),
+    (22.1, "🌖", "Waning Gibbous"),
+    (23.1, "🌗", "Last Quarter"),
+    (math.inf, "🌘", "Waning Crescent"),
+]
+MOON_PHASE_EMOJI = {phase: emoji for _, emoji, phase in MOON_PHASES}
+
+@traced("parse")
+def parse_astronomy(data: dict) -> AstronomyData:
+    """Derive sun and moon data from a /weather payload."""
+    sunrise_ts = data["sys"]["sunrise"]
+    sunset_ts = data["sys"]["sunset"]
+
+    # Calculate additional astronomy data
+    now = datetime.utcnow()
+    sunrise = datetime.utcfromtimestamp(sunrise_ts)
+    sunset = datetime.utcfromtimestamp(sunset_ts)
+
+    # Calculate solar noon (midpoint between sunrise and sunset)
+    solar_noon = sunrise + (sunset - sunrise) / 2
+
+    # Simple moon phase calculation (approximate)
+    # This is a simplified calculation - for production, you'd want a more accurate algorithm
+    days_since_new_moon = (now - datetime(2000, 1, 6)).days % 29.53
+    moon_phase = next(phase for limit, _, phase in MOON_PHASES if days_since_new_moon < limit)
+
+    # Calculate illumination percentage (approximate)
+    illumination = abs(math.cos((days_since_new_moon / 29.53) * 2 * math.pi)) * 100
+
+    # Calculate if it's currently day or night
+    if sunrise <= now <= sunset:
+        next_event = "sunset"
+        time_to_event = sunset - now
+    else:
+        # Calculate time to next sunrise
+        next_event = "sunrise"
+        next_sunrise = sunrise + timedelta(days=1) if now > sunset else sunrise
+        time_to_event = next_sunrise - now
+
+    return {
+        "name": data["name"],
+        "country": data.get("sys", {}).get("country", ""),
+        "timezone": data.get("timezone", 0),
+        "sunrise": sunrise_ts,
+        "sunset": sunset_ts,
+        "solar_noon": int(solar_noon.timestamp()),
+        "day_length": (sunset - sunrise).seconds,
+        "moon_phase": moon_phase,
+        "moon_illumination": round(illumination, 1),
+        "is_daytime": next_event == "sunset",
+        "next_event": next_event,
+        "next_event_in": time_to_event.seconds,
+    }
+
+def render_astronomy(model: AstronomyData) -> str:
+    """Render astronomy data as text."""
+    timezone_offset = model["timezone"]
+    hours, minutes = model["day_length"] // 3600, (model["day_length"] % 3600) // 60
+    event_hours, event_minutes = model["next_event_in"] // 3600, (model["next_event_in"] % 3600) // 60
+
+    result = f"🌌 Astronomy Data for {model['name']}, {model['country']}:\n\n"
+    result += f"🌅 Sunrise: {format_time(model['sunrise'], timezone_offset)}\n"
+    result += f"🌇 Sunset: {format_time(model['sunset'], timezone_offset)}\n"
+    result += f"☀️ Solar Noon: {format_time(model['solar_noon'], timezone_offset)}\n"
+    result += f"⏰ Day Length: {hours}h {minutes}m\n\n"
+    result += f"🌙 Moon Phase: {MOON_PHASE_EMOJI[model['moon_phase']]} {model['moon_phase']}\n"
+    result += f"💡 Moon Illumination: {model['moon_illumination']:.1f}%\n\n"
+
+    if model["is_daytime"]:
+        result += f"☀️ Currently: Daytime\n"
+        result += f"🌇 Sunset in: {event_hours}h {event_minutes}m\n"
+    else:
+        result += f"🌙 Currently: Nighttime\n"
+        result += f"🌅 Sunrise in: {event_hours}h {event_minutes}m\n"
+
+    return result
+
+@app.tool()
+@timed_tool
+def get_astronomy_data(city: str, output_format: str = "") -> str:
+    """Get detailed astronomy data including sunrise, sunset, moon phase, and solar position."""
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    # Get current weather data for basic astronomy info
+    location = parse_location(city)
+    url = f"{BASE_URL}/weather?{location.query}&units={UNITS}"
+    success, data = make_http_request(url, timeout=10, location_key=location.key)
+
+    if not success:
+        return error_response(f"Error fetching astronomy data: {data}", output_format)
+
+    try:
+        return respond(parse_astronomy(data), render_astronomy, output_format)
+    except (KeyError, ValueError) as e:
+        return error_response(f"Error parsing astronomy data: {str(e)}", output_format)
+
+def compare_highlights(cities: List[CurrentWeather]) -> dict:
+    """Pick the hottest, coldest and most humid of the successfully fetched cities."""
+    valid = [city for city in cities if "error" not in city]
+    if len(valid) < 2:
+        return {}
+    temps = [city["temp"] for city in valid]
+    label = lambda city: f"{city['name']}, {city['country']}"
+    hottest = max(valid, key=lambda x: x["temp"])
+    coldest = min(valid, key=lambda x: x["temp"])
+    most_humid = max(valid, key=lambda x: x["humidity"])
+    return {
+        "hottest": {"name": label(hottest), "temp": hottest["temp"]},
+        "coldest": {"name": label(coldest), "temp": coldest["temp"]},
+        "most_humid": {"name": label(most_humid), "humidity": most_humid["humidity"]},
+        "temp_range": max(temps) - min(temps),
+    }
+
+def render_comparison_entry(index: int, data: dict, units: str) -> str:
+    """Render one city's block of a comparison as text."""
+    if "error" in data:
+        return f"{index}. ❌ {data['query']}: {data['error']}\n\n"
+
+    unit_symbol = "°C" if units == "metric" else "°F"
+    speed_unit = "m/s" if units == "metric" else "mph"
+    result = f"{index}. 📍 {data['name']}, {data['country']}:\n"
+    result += f"   🌡️ {data['temp']:.1f}{unit_symbol} (feels like {data['feels_like']:.1f}{unit_symbol})\n"
+    result += f"   🌤️ {data['description']}\n"
+    result += f"   💧 Humidity: {data['humidity']}%\n"
+    result += f"   💨 Wind: {data['wind_speed']:.1f} {speed_unit}\n"
+    result += f"   👁️ Visibility: {data['visibility']:.1f} km\n"
+    result += f"   🔍 Pressure: {data['pressure']} hPa\n\n"
+    return result
+
+def render_comparison(model: dict) -> str:
+    """Render a multi-city comparison as text."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+
+    result = f"🌍 Weather Comparison for {len(model['cities'])} Cities:\n\n"
+
+    # Create a formatted table
+    for i, data in enumerate(model["cities"], 1):
+        result += render_comparison_entry(i, data, model["units"])
+
+    # Add some comparison insights
+    highlights = model["highlights"]
+    if highlights:
+        result += "📊 Comparison Highlights:\n"
+        result += f"🔥 Hottest: {highlights['hottest']['name']} ({highlights['hottest']['temp']:.1f}{unit_symbol})\n"
+        result += f"🧊 Coldest: {highlights['coldest']['name']} ({highlights['coldest']['temp']:.1f}{unit_symbol})\n"
+        result += f"💧 Most Humid: {highlights['most_humid']['name']} ({highlights['most_humid']['humidity']}%)\n"
+        result += f"📈 Temperature Range: {highlights['temp_range']:.1f}{unit_symbol}\n"
+
+    return result
+
+def parse_comparison_entry(city: str, success: bool, data: any) -> dict:
+    """Parse one city's /weather result for a comparison, or describe why it failed."""
+    if not success:
+        return {"query": city, "error": f"Failed to fetch data: {data}"}
+    try:
+        return parse_current_weather(data)
+    except (KeyError, ValueError):
+        return {"query": city, "error": "Failed to parse weather data"}
+
+@app.tool()
+@timed_tool
+async def compare_weather(cities: str, output_format: str = "", ctx: Context = None) -> str:
+    """Compare current weather conditions between multiple cities (comma-separated, or semicolon-separated to include "lat,lon" coordinates, city IDs or "zip=" codes)."""
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Parse cities from a comma-separated string (semicolons when entries contain commas)
+    separator = ";" if ";" in cities else ","
+    city_list = [clean_city_input(city.strip()) for city in cities.split(separator) if city.strip()]
+
+    if len(city_list) < 2:
+        return error_response("Error: Please provide at least 2 cities separated by commas (e.g., 'London, Paris, Tokyo')", output_format)
+
+    if len(city_list) > 5:
+        return error_response("Error: Maximum 5 cities allowed for comparison", output_format)
+
+    locations = [parse_location(city) for city in city_list]
+    location_keys = [location.key for location in locations]
+    urls = [f"{BASE_URL}/weather?{location.query}&units={UNITS}" for location in locations]
+
+    # Fetch all cities concurrently, streaming each city's block as it arrives
+    def describe(index: int, success: bool, data: any) -> str:
+        entry = parse_comparison_entry(city_list[index], success, data)
+        if resolve_output_format(output_format) == "json":
+            return to_json(entry)
+        return render_comparison_entry(index + 1, entry, UNITS).strip()
+
+    fetched = await fetch_progressively(urls, ctx, describe, location_keys)
+
+    def build() -> str:
+        weather_data = [
+            parse_comparison_entry(city, success, data)
+            for city, (success, data) in zip(city_list, fetched)
+        ]
+        model = {"units": UNITS, "cities": weather_data, "highlights": compare_highlights(weather_data)}
+        return respond(model, render_comparison, output_format)
+
+    return cached_render("compare_weather", tuple(urls), (resolve_output_format(output_format),), build)
+
+# ---------------------------------------------------------------------------
+# Recommendation engine
+# ---------------------------------------------------------------------------
+
+# Unit-dependent thresholds referenced by name from RECOMMENDATION_RULES
+RECOMMENDATION_THRESHOLDS: Dict[str, Dict[str, float]] = {
+    "metric": {"hot": 25, "cold": 10, "extreme_heat": 35, "freezing": 0, "windy": 5, "strong_wind": 10},
+    "imperial": {"hot": 77, "cold": 50, "extreme_heat": 95, "freezing": 32, "windy": 11, "strong_wind": 22},
+}
+
+class RecommendationRule(NamedTuple):
+    """
+    One row of the recommendation table.
+
+    A rule fires when any of its clauses matches. Each clause is
+    (field, op, value) where value is a number, a threshold name from
+    RECOMMENDATION_THRESHOLDS, or a substring for the "contains" op.
+    Rules sharing a group are exclusive: only the first match fires.
+    """
+    group: Optional[str]
+    clauses: Tuple[Tuple[str, str, any], ...]
+    recommendations: Tuple[str, ...] = ()
+    warnings: Tuple[str, ...] = ()
+    clothing: Tuple[str, ...] = ()
+
+class CompiledRule(NamedTuple):
+    """A RecommendationRule with thresholds resolved for one unit system"""
+    group: Optional[str]
+    clauses: Tuple[Tuple[str, str, any], ...]
+    recommendations: Tuple[str, ...]
+    warnings: Tuple[str, ...]
+    clothing: Tuple[str, ...]
+
+class Recommendations(NamedTuple):
+    """Evaluated recommendations for a single observation"""
+    recommendations: List[str]
+    warnings: List[str]
+    clothing: List[str]
+
+# Table order is output order
+RECOMMENDATION_RULES: Tuple[RecommendationRule, ...] = (
+    # Temperature bands
+    RecommendationRule("temperature", (("temp", ">=", "hot"),), recommendations=(
+        "🏊‍♀️ Swimming or water activities",
+        "🍦 Enjoy ice cream or cold drinks",
+        "🌳 Seek shade in parks or gardens",
+        "🏠 Indoor activities during peak heat",
+    )),
+    RecommendationRule("temperature", (("temp", "<=", "cold"),), recommendations=(
+        "☕ Hot drinks and cozy indoor activities",
+        "🧥 Layer up for outdoor activities",
+        "🔥 Fireplace or heating activities",
+        "🏠 Indoor sports and entertainment",
+    )),
+    RecommendationRule("temperature", (), recommendations=(
+        "🚶‍♀️ Perfect for walking or hiking",
+        "🚴‍♂️ Great cycling weather",
+        "🏃‍♀️ Ideal for outdoor exercise",
+    )),
+    RecommendationRule(None, (("temp", ">", "extreme_heat"),), warnings=("🔥 Extreme heat - limit outdoor exposure",)),
+    RecommendationRule(None, (("temp", "<", "freezing"),), warnings=("🧊 Freezing conditions - dress warmly",)),
+
+    # Weather conditions
+    RecommendationRule("condition", (("main", "contains", "rain"), ("main", "contains", "drizzle")), recommendations=(
+        "☔ Bring an umbrella",
+        "🏛️ Visit museums or indoor attractions",
+        "📚 Perfect reading weather",
+        "🎬 Movie theater or indoor entertainment",
+    ), warnings=("🌧️ Wet conditions - drive carefully",)),
+    RecommendationRule("condition", (("main", "contains", "snow"),), recommendations=(
+        "⛷️ Skiing or snowboarding",
+        "⛄ Build a snowman",
+        "🛷 Sledding activities",
+        "❄️ Winter photography",
+    ), warnings=("🌨️ Snowy conditions - check road conditions",)),
+    RecommendationRule("condition", (("main", "contains", "clear"), ("description", "contains", "sun")), recommendations=(
+        "📸 Perfect for photography",
+        "🌻 Outdoor picnics",
+        "🏖️ Beach or outdoor activities",
+        "🌅 Sunrise/sunset viewing",
+    )),
+    RecommendationRule("condition", (("main", "contains", "cloud"),), recommendations=(
+        "🚶‍♀️ Comfortable for walking",
+        "🏃‍♀️ Good for outdoor exercise",
+        "📸 Great for landscape photography",
+    )),
+    RecommendationRule("condition", (("main", "contains", "storm"), ("description", "contains", "thunder")), recommendations=(
+        "🏠 Stay indoors",
+        "📱 Charge devices in case of power outage",
+        "🎮 Indoor games and entertainment",
+    ), warnings=("⛈️ Severe weather - avoid outdoor activities",)),
+
+    # Wind, humidity and visibility
+    RecommendationRule(None, (("wind_speed", ">", "windy"),), recommendations=("🪁 Great for kite flying",)),
+    RecommendationRule(None, (("wind_speed", ">", "strong_wind"),), warnings=("💨 Strong winds - secure loose objects",)),
+    RecommendationRule("humidity", (("humidity", ">", 80),), recommendations=("💧 High humidity - stay hydrated",),
+                       warnings=("🌫️ Muggy conditions - take breaks in AC",)),
+    RecommendationRule("humidity", (("humidity", "<", 30),), recommendations=("🧴 Low humidity - use moisturizer",)),
+    RecommendationRule("visibility", (("visibility", "<", 1),), warnings=("🌫️ Poor visibility - drive with caution",)),
+    RecommendationRule("visibility", (("visibility", ">", 10),), recommendations=("👁️ Excellent visibility for sightseeing",)),
+
+    # Clothing
+    RecommendationRule("clothing", (("temp", ">=", "hot"),),
+                       clothing=("Light, breathable clothing", "Sun hat and sunglasses", "Sunscreen")),
+    RecommendationRule("clothing", (("temp", "<=", "cold"),), clothing=("Warm layers", "Jacket or coat", "Gloves and hat")),
+    RecommendationRule("clothing", (), clothing=("Comfortable casual clothing", "Light jacket if needed")),
+    RecommendationRule(None, (("main", "contains", "rain"),), clothing=("Waterproof jacket", "Umbrella")),
+)
+
+_COMPARISONS = {
+    ">": lambda column, threshold: [value > threshold for value in column],
+    ">=": lambda column, threshold: [value >= threshold for value in column],
+    "<": lambda column, threshold: [value < threshold for value in column],
+    "<=": lambda column, threshold: [value <= threshold for value in column],
+    "contains": lambda column, needle: [needle in value for value in column],
+}
+
+@lru_cache(maxsize=None)
+def compile_recommendation_rules(units: str) -> Tuple[CompiledRule, ...]:
+    """Resolve named thresholds for a unit system once and cache the result."""
+    thresholds = RECOMMENDATION_THRESHOLDS["metric" if units == "metric" else "imperial"]
+    compiled = []
+    for rule in RECOMMENDATION_RULES:
+        clauses = tuple(
+            (field, op, thresholds[value] if isinstance(value, str) and op != "contains" else value)
+            for field, op, value in rule.clauses
+        )
+        compiled.append(CompiledRule(rule.group, clauses, rule.recommendations, rule.warnings, rule.clothing))
+    return tuple(compiled)
+
+def weather_observation(data: dict) -> Dict[str, any]:
+    """Extract the fields the recommendation rules read from a /weather payload."""
+    return {
+        "temp": data["main"]["temp"],
+        "humidity": data["main"]["humidity"],
+        "wind_speed": data["wind"]["speed"],
+        "main": data["weather"][0]["main"].lower(),
+        "description": data["weather"][0]["description"].lower(),
+        "visibility": data.get("visibility", 10000) / 1000,  # convert to km
+    }
+
+def evaluate_recommendations(observations: List[Dict[str, any]], units: str = UNITS) -> List[Recommendations]:
+    """
+    Evaluate the rule table against many observations at once.
+    Each rule is applied to a whole column in one pass, so the cost per
+    extra observation is a handful of comparisons.
+    """
+    count = len(observations)
+    if not count:
+        return []
+    columns = {field: [obs[field] for obs in observations] for field in observations[0]}
+    results = [Recommendations([], [], []) for _ in range(count)]
+    claimed: Dict[str, List[bool]] = {}
+
+    for rule in compile_recommendation_rules(units):
+        mask = [not rule.clauses] * count
+        for field, op, value in rule.clauses:
+            mask = [a or b for a, b in zip(mask, _COMPARISONS[op](columns[field], value))]
+        if rule.group is not None:
+            taken = claimed.setdefault(rule.group, [False] * count)
+            mask = [m and not t for m, t in zip(mask, taken)]
+            claimed[rule.group] = [m or t for m, t in zip(mask, taken)]
+
+        for index, fired in enumerate(mask):
+            if fired:
+                result = results[index]
+                result.recommendations.extend(rule.recommendations)
+                result.warnings.extend(rule.warnings)
+                result.clothing.extend(rule.clothing)
+
+    return results
+
+# (OWM city ID, observation time) -> recommendations evaluated in one batch
+# pass when a bulk /group answer arrives, so the cities being requested
+# together are ready before get_weather_recommendations asks for them
+_precomputed_recommendations: "OrderedDict[Tuple[int, int], Recommendations]" = OrderedDict()
+_precomputed_lock = threading.Lock()
+_recommendation_stats: Counter = Counter()  # "precomputed" / "served"
+
+def observation_id(data: any) -> Optional[Tuple[int, int]]:
+    """(city ID, observation time) of a /weather payload or /group item, if it has both."""
+    if not isinstance(data, dict) or not isinstance(data.get("id"), int) or not isinstance(data.get("dt"), int):
+        return None
+    return data["id"], data["dt"]
+
+def precompute_recommendations(items: List[dict]) -> int:
+    """Evaluate every city of a fresh /group answer in one batch; returns the number stored."""
+    keys, observations = [], []
+    for item in items:
+        key = observation_id(item)
+        if key is None:
+            continue
+        try:
+            observations.append(weather_observation(item))
+        except (KeyError, IndexError, TypeError):
+            continue
+        keys.append(key)
+    evaluated = evaluate_recommendations(observations, UNITS)
+    with _precomputed_lock:
+        for key, result in zip(keys, evaluated):
+            _precomputed_recommendations[key] = result
+            _precomputed_recommendations.move_to_end(key)
+        while len(_precomputed_recommendations) > CACHE_MAX_ENTRIES:
+            _precomputed_recommendations.popitem(last=False)
+        _recommendation_stats["precomputed"] += len(keys)
+    return len(keys)
+
+def precomputed_recommendations(data: any) -> Optional[Recommendations]:
+    """Recommendations precomputed for exactly this observation, if any."""
+    key = observation_id(data)
+    if key is None:
+        return None
+    with _precomputed_lock:
+        result = _precomputed_recommendations.get(key)
+        if result is not None:
+            _recommendation_stats["served"] += 1
+        return result
+
+def render_recommendations(model: WeatherRecommendations) -> str:
+    """Render recommendations as text."""
+    unit_symbol = "°C" if model["units"] == "metric" else "°F"
+    result = f"🎯 Activity Recommendations for {model['name']}, {model['country']}:\n"
+    result += f"Current: {model['temp']:.1f}{unit_symbol}, {model['description']}\n\n"
+
+    # Format output
+    if model["recommendations"]:
+        result += "✅ Recommended Activities:\n"
+        for rec in model["recommendations"][:8]:  # Limit to top 8 recommendations
+            result += f"• {rec}\n"
+        result += "\n"
+
+    if model["warnings"]:
+        result += "⚠️ Weather Warnings:\n"
+        for warning in model["warnings"]:
+            result += f"• {warning}\n"
+        result += "\n"
+
+    result += "👕 Clothing Suggestions:\n"
+    for item in model["clothing"]:
+        result += f"• {item}\n"
+
+    return result.strip()
+
+@app.tool()
+@timed_tool
+def get_weather_recommendations(city: str, output_format: str = "") -> str:
+    """Get activity recommendations based on current weather conditions. Set output_format="json" for structured output."""
+    if not API_KEY:
+        return error_response(MISSING_API_KEY, output_format)
+
+    # Clean up the city input
+    city = clean_city_input(city)
+
+    # Get current weather data
+    location = parse_location(city)
+    url = f"{BASE_URL}/weather?{location.query}&units={UNITS}"
+    success, data = make_http_request(url, timeout=10, location_key=location.key)
+
+    if not success:
+        return error_response(f"Error fetching weather data: {data}", output_format)
+
+    def build() -> str:
+        try:
+            observation = weather_observation(data)
+            evaluated = precomputed_recommendations(data) or evaluate_recommendations([observation], UNITS)[0]
+            model: WeatherRecommendations = {
+                "name": data["name"],
+                "country": data.get("sys", {}).get("country", ""),
+                "temp": observation["temp"],
+                "description": data["weather"][0]["description"].capitalize(),
+                "units": UNITS,
+                "recommendations": evaluated.recommendations,
+                "warnings": evaluated.warnings,
+                "clothing": evaluated.clothing,
+            }
+            return respond(model, render_recommendations, output_format)
+        except (KeyError, ValueError) as e:
+            return error_response(f"Error parsing weather data for recommendations: {str(e)}", output_format)
+
+    return cached_render("get_weather_recommendations", (url,), (resolve_output_format(output_format),), build)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        parser = argparse.ArgumentParser(prog="openweather.py replay", description="Replay recorded traffic against recorded upstream responses")
+        parser.add_argument("recording", help="file written by RECORD_FILE or the record_traffic tool")
+        parser.add_argument("--speed", type=float, default=1.0, help="time compression factor (default: 1, real time)")
+        options = parser.parse_args(sys.argv[2:])
+        print(replay_traffic(options.recording, options.speed))
+    else:
+        start_sharding()
+        app.run()
@@ -8,14 +8,26 @@ Tests all OpenWeather functionality including:
 - Weather forecasts
 - Error handling
 - Input validation
+- Offline engine behavior (location aliases, city index, history rollups, /group batching,
+  recommendation rules, API key pool, alert watcher, map tile cache, shard ring and peer
+  forwarding), with the upstream API stubbed
 
 Usage:
     python tests/test_openweather.py
 """
 
 import requests
+import httpx
+import gzip
+import asyncio
+import itertools
 import json
+import os
+import sys
+import tempfile
+import threading
 import time
+from contextlib import contextmanager
 
 def test_openweather_status():
     """Test OpenWeather status endpoint"""
@@ -131,6 +143,34 @@ def test_weather_forecast():
     print(f"\n📊 Forecast tests: {success_count}/{len(test_cases)} passed")
     return success_count >= len(test_cases) // 2
 
+def test_forecast_batch():
+    """Test multi-city batch forecast functionality"""
+    print("\n📦 Testing Batch Forecasts...")
+
+    payload = {"locations": ["London", "Tokyo", "40.71,-74.01"], "days": 2}
+
+    try:
+        response = requests.post(
+            "http://localhost:8989/openweather/get_forecasts_batch",
+            json=payload,
+            timeout=30
+        )
+
+        if response.status_code == 200:
+            result = response.text.strip('"').replace('\\n', '\n')
+            location_count = result.count("📍")
+            if "Forecast Summary" in result and location_count == len(payload["locations"]):
+                print(f"   ✅ Batch forecast received for {location_count} locations")
+                return True
+            print(f"   ❌ Expected {len(payload['locations'])} locations, found {location_count}")
+        else:
+            print(f"   ❌ HTTP {response.status_code}")
+
+    except Exception as e:
+        print(f"   ❌ Error - {e}")
+
+    return False
+
 def test_error_handling():
     """Test error handling with invalid inputs"""
     print("\n🚨 Testing Error Handling...")
@@ -181,6 +221,713 @@ def test_error_handling():
     print(f"\n📊 Error handling tests: {success_count}/{len(error_tests)} passed")
     return success_count >= len(error_tests) // 2
 
+# ---------------------------------------------------------------------------
+# Offline engine tests: import openweather.py directly and stub the upstream API
+# ---------------------------------------------------------------------------
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mcp", "servers", "openweather")
+_engine = None
+
+def load_engine():
+    """Import the server module once, with a dummy API key and a scratch data directory"""
+    global _engine
+    if _engine is None:
+        os.environ.setdefault("OPENWEATHER_API_KEY", "test-key")
+        os.environ["OPENWEATHER_DATA_DIR"] = tempfile.mkdtemp(prefix="openweather-test-")
+        sys.path.insert(0, os.path.abspath(SERVER_DIR))
+        import openweather
+        _engine = openweather
+    return _engine
+
+def reset_engine(engine):
+    """Forget cached payloads, renderings and learned locations between tests"""
+    with engine._response_cache_lock:
+        engine._response_cache.clear()
+    with engine._render_cache_lock:
+        engine._render_cache.clear()
+        engine._render_keys_by_url.clear()
+    with engine._location_aliases_lock:
+        engine._location_aliases.clear()
+    with engine._location_ids_lock:
+        engine._location_ids.clear()
+    with engine._negative_cache_lock:
+        engine._negative_cache.clear()
+
+@contextmanager
+def stub_upstream(engine, answer):
+    """Answer upstream requests with answer(url) -> (status, body); yields the URLs requested"""
+    requested = []
+    original = engine.fetch_upstream
+
+    def fetch(url, key, timeout):
+        requested.append(url)
+        status, body = answer(url)
+        return httpx.Response(status, content=json.dumps(body).encode(), request=httpx.Request("GET", url))
+
+    engine.fetch_upstream = fetch
+    try:
+        yield requested
+    finally:
+        engine.fetch_upstream = original
+
+def weather_payload(name, country, city_id, temp=60.0, lat=0.0, lon=0.0, dt=1700000000):
+    """A minimal /weather response body"""
+    return {
+        "id": city_id, "name": name, "dt": dt, "timezone": 0,
+        "coord": {"lat": lat, "lon": lon},
+        "sys": {"country": country, "sunrise": dt - 21600, "sunset": dt + 21600},
+        "main": {"temp": temp, "feels_like": temp, "humidity": 50, "pressure": 1013},
+        "wind": {"speed": 5.0, "deg": 180},
+        "weather": [{"main": "Clear", "description": "clear sky"}],
+        "visibility": 10000,
+    }
+
+def fetch_weather(engine, city):
+    """Fetch /weather for a location argument the way the tools do"""
+    location = engine.parse_location(city)
+    url = f"{engine.BASE_URL}/weather?{location.query}&units={engine.UNITS}"
+    return engine.make_http_request(url, timeout=10, location_key=location.key)
+
+def test_location_aliases():
+    """Every spelling of a city maps to one canonical key and one upstream call"""
+    print("\n🔤 Testing Location Aliases...")
+    engine = load_engine()
+    reset_engine(engine)
+
+    assert engine.normalize_location_key("  London,  United Kingdom ") == "london,gb"
+    assert engine.normalize_location_key("Phoenix, Arizona") == "phoenix,az,us"
+    assert engine.normalize_location_key("Paris, FR") == "paris,fr"
+    assert engine.normalize_location_key("Tbilisi, Georgia") == "tbilisi,georgia"
+    assert engine.normalize_location_key("Atlanta, Georgia, USA") == "atlanta,ga,us"
+
+    def answer(url):
+        if "q=phoenix" in url:
+            return 200, weather_payload("Phoenix", "US", 5308655)
+        return 200, weather_payload("London", "GB", 2643743)
+
+    with stub_upstream(engine, answer) as requested:
+        for spelling in ["London", "london", "  LONDON ", "London, UK", "London, United Kingdom"]:
+            success, data = fetch_weather(engine, spelling)
+            assert success and data["name"] == "London"
+        assert len(requested) == 1, requested
+        assert engine.canonical_location_key("London") == "london,gb"
+
+        for spelling in ["Phoenix, AZ", "phoenix, arizona", "Phoenix,AZ,US", "PHOENIX , az"]:
+            success, data = fetch_weather(engine, spelling)
+            assert success and data["name"] == "Phoenix"
+        assert len(requested) == 2, requested
+        assert engine.canonical_location_key("phoenix,az") == "phoenix,az,us"
+
+    # A state name that is also a country is sent as given, not as "<city>,ga,us"
+    with stub_upstream(engine, lambda url: (200, weather_payload("Tbilisi", "GE", 611717))) as requested:
+        success, data = fetch_weather(engine, "Tbilisi, Georgia")
+        assert success and data["name"] == "Tbilisi"
+        assert "q=tbilisi,georgia&" in requested[0], requested
+
+    print("   ✅ 9 spellings of 2 cities cost 2 upstream calls; Tbilisi, Georgia stays in Georgia")
+
+FIXTURE_CITIES = [
+    {"id": 2643743, "name": "London", "country": "GB", "coord": {"lat": 51.5085, "lon": -0.1257}, "population": 7556900},
+    {"id": 6058560, "name": "London", "state": "", "country": "CA", "coord": {"lat": 42.9834, "lon": -81.233}, "population": 346765},
+    {"id": 2643734, "name": "Londonderry", "country": "GB", "coord": {"lat": 54.9981, "lon": -7.3093}, "population": 83652},
+    {"id": 3458449, "name": "Londrina", "country": "BR", "coord": {"lat": -23.3103, "lon": -51.1628}, "population": 506701},
+    {"id": 2657896, "name": "Zürich", "country": "CH", "coord": {"lat": 47.3667, "lon": 8.55}, "population": 341730},
+    {"id": 2988507, "name": "Paris", "country": "FR", "coord": {"lat": 48.8534, "lon": 2.3488}, "population": 2138551},
+    {"id": 4717560, "name": "Paris", "state": "TX", "country": "US", "coord": {"lat": 33.6609, "lon": -95.5555}, "population": 25171},
+    {"id": 5308655, "name": "Phoenix", "state": "AZ", "country": "US", "coord": {"lat": 33.4484, "lon": -112.074}, "population": 1445632},
+]
+
+def build_fixture_index(engine):
+    """Build a city index from a small gzipped city list and open it"""
+    directory = tempfile.mkdtemp(prefix="openweather-cities-")
+    source_path = os.path.join(directory, "city.list.json.gz")
+    with gzip.open(source_path, "wt", encoding="utf-8") as f:
+        json.dump(FIXTURE_CITIES, f)
+    index_path = os.path.join(directory, "city_index.bin")
+    assert engine.build_city_index(source_path, index_path) == len(FIXTURE_CITIES)
+    return engine.CityIndex(index_path)
+
+def test_city_index():
+    """Prefix, fuzzy and accent-folded lookups in the offline city index"""
+    print("\n🔎 Testing City Index...")
+    engine = load_engine()
+    index = build_fixture_index(engine)
+
+    # Prefix ranges cover every folded name sharing the prefix
+    start, end = index.prefix_range(b"lond")
+    assert sorted(index.record(i).name for i in range(start, end)) == ["London", "London", "Londonderry", "Londrina"]
+    start, end = index.prefix_range(b"london")
+    assert end - start == 3
+    assert index.prefix_range(b"lx") == (0, 0)
+
+    # Exact names first, then by population; prefix matches after them
+    results = index.search("London")
+    assert [(record.id, distance) for record, distance in results[:3]] == [(2643743, 0), (6058560, 0), (2643734, 0)]
+    assert [record.id for record, _ in index.search("par")] == [2988507, 4717560]
+    assert [record.id for record, _ in index.search("london", country="ca")] == [6058560]
+
+    # One transposed pair still finds London, ranked by population
+    record, distance = index.search("Lodnon")[0]
+    assert (record.id, distance) == (2643743, 1)
+
+    # Accents fold both ways
+    assert engine.search_key("  Zürich ") == "zurich"
+    for query in ("zurich", "ZÜRICH"):
+        record, distance = index.search(query)[0]
+        assert (record.name, distance) == ("Zürich", 0)
+
+    print("   ✅ Prefix, fuzzy, accent and ranking lookups matched")
+
+def test_history_rollups():
+    """Observations fold into hourly and daily rollups; refetched observations are not counted twice"""
+    print("\n📈 Testing History Rollups...")
+    engine = load_engine()
+    reset_engine(engine)
+
+    day_start = int(time.time()) // 86400 * 86400
+    first_hour, second_hour = day_start + 3600, day_start + 7200
+    readings = [  # (dt, temp, wind, description)
+        (first_hour + 60, 50.0, 3.0, "light rain"),
+        (first_hour + 1800, 59.0, 5.0, "light rain"),
+        (second_hour + 60, 68.0, 7.0, "clear sky"),
+    ]
+    url = f"{engine.BASE_URL}/weather?q=oslo,no&units={engine.UNITS}"
+    for dt, temp, wind, description in readings + readings[:1]:  # the first one is fetched twice
+        payload = weather_payload("Oslo", "NO", 3143244, temp=temp, lat=59.91, lon=10.75, dt=dt)
+        payload["wind"]["speed"] = wind
+        payload["weather"][0]["description"] = description
+        engine.history_record(url, "oslo,no", payload)
+
+    success, daily = engine.query_history(engine.parse_location("Oslo, Norway"), 1, "daily")
+    assert success, daily
+    assert len(daily["buckets"]) == 1 and daily["observations"] == 3
+    bucket = daily["buckets"][0]
+    assert bucket["start"] == day_start
+    assert (bucket["min_temp"], bucket["max_temp"], bucket["mean_temp"]) == (50.0, 68.0, 59.0)
+    assert (bucket["mean_wind"], bucket["max_wind"]) == (5.0, 7.0)
+    assert bucket["condition"] == "Light rain"
+
+    success, hourly = engine.query_history(engine.parse_location("id=3143244"), 1, "hourly")
+    assert success, hourly
+    assert [(b["start"], b["observations"], b["condition"]) for b in hourly["buckets"]] == [
+        (first_hour, 2, "Light rain"), (second_hour, 1, "Clear sky"),
+    ]
+    assert hourly["buckets"][0]["mean_temp"] == 54.5
+
+    # Every city of a bulk /group answer is recorded under its ID
+    group = {"list": [
+        weather_payload("Bergen", "NO", 3161732, temp=45.0, lat=60.39, lon=5.32, dt=first_hour),
+        weather_payload("Trondheim", "NO", 3133880, temp=41.0, lat=63.43, lon=10.39, dt=first_hour),
+    ]}
+    engine.history_record(f"{engine.BASE_URL}/group?id=3161732,3133880&units={engine.UNITS}", None, group)
+    success, bergen = engine.query_history(engine.parse_location("3161732"), 1, "daily")
+    assert success and bergen["name"] == "Bergen" and bergen["buckets"][0]["max_temp"] == 45.0
+
+    success, error = engine.query_history(engine.parse_location("Nowhere"), 1, "daily")
+    assert not success and "no observations" in error
+
+    print("   ✅ Hourly and daily rollups aggregated 3 observations")
+
+def test_group_batching():
+    """Concurrent current-weather calls share one /group request and each gets its own city back"""
+    print("\n📦 Testing /group Micro-Batching...")
+    engine = load_engine()
+    reset_engine(engine)
+    cities = {2643743: ("London", "GB"), 2988507: ("Paris", "FR"), 5308655: ("Phoenix", "US")}
+    fetch_threads = []
+
+    def answer(url):
+        fetch_threads.append(threading.current_thread())
+        if "/group?" in url:
+            ids = [int(city_id) for city_id in url.split("id=")[1].split("&")[0].split(",")]
+            items = []
+            for city_id in ids:
+                if city_id in cities:  # /group leaves unknown IDs out
+                    item = weather_payload(*cities[city_id], city_id)
+                    item["sys"]["timezone"] = item.pop("timezone") + 3600  # under sys, unlike /weather
+                    items.append(item)
+            return 200, {"cnt": len(items), "list": items}
+        return 200, weather_payload("Oslo", "NO", 3143244)
+
+    async def call_all(queries):
+        return await asyncio.gather(*(engine.get_current_weather(city=query, output_format="json") for query in queries))
+
+    window = engine.GROUP_BATCH_WINDOW_MS
+    engine.GROUP_BATCH_WINDOW_MS = 200
+    before = engine._group_batcher.stats.copy()
+    try:
+        with stub_upstream(engine, answer) as requested:
+            results = asyncio.run(call_all(["2643743", "2988507", "id=5308655", "2643743", "999"]))
+    finally:
+        engine.GROUP_BATCH_WINDOW_MS = window
+    stats = engine._group_batcher.stats - before
+
+    # One request for the four distinct IDs, fanned back out to five callers
+    assert requested == [f"{engine.BASE_URL}/group?id=999,2643743,2988507,5308655&units={engine.UNITS}"], requested
+    assert (stats["batches"], stats["cities"], stats["callers"]) == (1, 4, 5)
+    names = [json.loads(result).get("name") for result in results[:4]]
+    assert names == ["London", "Paris", "Phoenix", "London"]
+    assert json.loads(results[0])["timezone"] == 3600
+    assert "not found" in results[4]
+
+    # Batched answers are cached like /weather answers, and a cached answer is served without a fetch
+    original = engine.make_http_request
+    engine.make_http_request = None
+    try:
+        with stub_upstream(engine, answer) as requested:
+            assert json.loads(asyncio.run(call_all(["2988507"]))[0])["name"] == "Paris"
+    finally:
+        engine.make_http_request = original
+    assert requested == []
+
+    # Without a window the fetch still runs off the event loop
+    fetch_threads.clear()
+    with stub_upstream(engine, answer) as requested:
+        assert json.loads(asyncio.run(call_all(["Oslo"]))[0])["name"] == "Oslo"
+    assert len(requested) == 1 and "/weather?q=oslo" in requested[0]
+    assert fetch_threads and threading.main_thread() not in fetch_threads
+
+    print("   ✅ 5 concurrent calls were served by 1 /group request")
+
+def legacy_recommendations(observation, units):
+    """The if/elif chain the recommendation rule table replaced, kept as a reference"""
+    temp, humidity, wind_speed = observation["temp"], observation["humidity"], observation["wind_speed"]
+    weather_main, weather_desc, visibility = observation["main"], observation["description"], observation["visibility"]
+    hot = 25 if units == "metric" else 77
+    cold = 10 if units == "metric" else 50
+    windy = 5 if units == "metric" else 11
+    recommendations, warnings, clothing = [], [], []
+
+    if temp >= hot:
+        recommendations += ["🏊‍♀️ Swimming or water activities", "🍦 Enjoy ice cream or cold drinks",
+                            "🌳 Seek shade in parks or gardens", "🏠 Indoor activities during peak heat"]
+        if temp > (35 if units == "metric" else 95):
+            warnings.append("🔥 Extreme heat - limit outdoor exposure")
+    elif temp <= cold:
+        recommendations += ["☕ Hot drinks and cozy indoor activities", "🧥 Layer up for outdoor activities",
+                            "🔥 Fireplace or heating activities", "🏠 Indoor sports and entertainment"]
+        if temp < (0 if units == "metric" else 32):
+            warnings.append("🧊 Freezing conditions - dress warmly")
+    else:
+        recommendations += ["🚶‍♀️ Perfect for walking or hiking", "🚴‍♂️ Great cycling weather", "🏃‍♀️ Ideal for outdoor exercise"]
+
+    if "rain" in weather_main or "drizzle" in weather_main:
+        recommendations += ["☔ Bring an umbrella", "🏛️ Visit museums or indoor attractions",
+                            "📚 Perfect reading weather", "🎬 Movie theater or indoor entertainment"]
+        warnings.append("🌧️ Wet conditions - drive carefully")
+    elif "snow" in weather_main:
+        recommendations += ["⛷️ Skiing or snowboarding", "⛄ Build a snowman", "🛷 Sledding activities", "❄️ Winter photography"]
+        warnings.append("🌨️ Snowy conditions - check road conditions")
+    elif "clear" in weather_main or "sun" in weather_desc:
+        recommendations += ["📸 Perfect for photography", "🌻 Outdoor picnics",
+                            "🏖️ Beach or outdoor activities", "🌅 Sunrise/sunset viewing"]
+    elif "cloud" in weather_main:
+        recommendations += ["🚶‍♀️ Comfortable for walking", "🏃‍♀️ Good for outdoor exercise", "📸 Great for landscape photography"]
+    elif "storm" in weather_main or "thunder" in weather_desc:
+        recommendations += ["🏠 Stay indoors", "📱 Charge devices in case of power outage", "🎮 Indoor games and entertainment"]
+        warnings.append("⛈️ Severe weather - avoid outdoor activities")
+
+    if wind_speed > windy:
+        recommendations.append("🪁 Great for kite flying")
+        if wind_speed > windy * 2:
+            warnings.append("💨 Strong winds - secure loose objects")
+
+    if humidity > 80:
+        recommendations.append("💧 High humidity - stay hydrated")
+        warnings.append("🌫️ Muggy conditions - take breaks in AC")
+    elif humidity < 30:
+        recommendations.append("🧴 Low humidity - use moisturizer")
+
+    if visibility < 1:
+        warnings.append("🌫️ Poor visibility - drive with caution")
+    elif visibility > 10:
+        recommendations.append("👁️ Excellent visibility for sightseeing")
+
+    if temp >= hot:
+        clothing += ["Light, breathable clothing", "Sun hat and sunglasses", "Sunscreen"]
+    elif temp <= cold:
+        clothing += ["Warm layers", "Jacket or coat", "Gloves and hat"]
+    else:
+        clothing += ["Comfortable casual clothing", "Light jacket if needed"]
+    if "rain" in weather_main:
+        clothing += ["Waterproof jacket", "Umbrella"]
+    return recommendations, warnings, clothing
+
+def test_recommendation_rules():
+    """The compiled rule table matches the old if/elif chain, one observation or thousands at once"""
+    print("\n🎯 Testing Recommendation Rules...")
+    engine = load_engine()
+    conditions = [("rain", "light rain"), ("drizzle", "drizzle"), ("snow", "snow"), ("clear", "clear sky"),
+                  ("clouds", "broken clouds"), ("clouds", "sunny intervals"), ("thunderstorm", "thunderstorm"),
+                  ("mist", "thunder nearby"), ("mist", "mist")]
+    grids = {
+        "metric": ([-5, 0, 5, 10, 18, 25, 30, 35, 40], [2, 5, 6, 10, 11]),
+        "imperial": ([20, 32, 40, 50, 65, 77, 90, 95, 100], [5, 11, 12, 22, 23]),
+    }
+    for units, (temps, winds) in grids.items():
+        observations = [
+            {"temp": temp, "humidity": humidity, "wind_speed": wind, "main": main, "description": description, "visibility": visibility}
+            for temp, (main, description), wind, humidity, visibility
+            in itertools.product(temps, conditions, winds, [20, 30, 50, 80, 90], [0.5, 1, 5, 10, 12])
+        ]
+        batch = engine.evaluate_recommendations(observations, units)
+        for observation, result in zip(observations, batch):
+            assert tuple(result) == legacy_recommendations(observation, units), observation
+        assert engine.evaluate_recommendations(observations[:1], units) == batch[:1]
+
+    print(f"   ✅ Rule table matched the if/elif chain on {len(observations)} observations per unit system")
+
+def test_precomputed_recommendations():
+    """Cities of a /group answer get their recommendations evaluated in one batch"""
+    print("\n🎯 Testing Precomputed Recommendations...")
+    engine = load_engine()
+    reset_engine(engine)
+    hot = weather_payload("Phoenix", "US", 5308655, temp=104.0)
+    cold = weather_payload("Oslo", "NO", 3143244, temp=25.0)
+    cold["weather"][0].update(main="Snow", description="light snow")
+
+    def answer(url):
+        return 200, {"cnt": 2, "list": [hot, cold]}
+
+    with stub_upstream(engine, answer) as requested:
+        success, data = engine.make_http_request(f"{engine.BASE_URL}/group?id=3143244,5308655&units={engine.UNITS}")
+    assert success and len(requested) == 1
+    phoenix = engine.precomputed_recommendations(hot)
+    oslo = engine.precomputed_recommendations(cold)
+    assert phoenix == engine.evaluate_recommendations([engine.weather_observation(hot)], engine.UNITS)[0]
+    assert "⛷️ Skiing or snowboarding" in oslo.recommendations
+    assert engine.precomputed_recommendations(dict(hot, dt=hot["dt"] + 600)) is None  # a newer observation
+
+    # The tool reuses the precomputed result for the same observation
+    served = engine._recommendation_stats["served"]
+    with stub_upstream(engine, lambda url: (200, hot)):
+        result = json.loads(engine.get_weather_recommendations(city="5308655", output_format="json"))
+    assert result["recommendations"] == phoenix.recommendations
+    assert engine._recommendation_stats["served"] == served + 1
+
+    print("   ✅ 2 cities precomputed from one /group answer and reused by the tool")
+
+def test_api_key_pool():
+    """Calls rotate across keys; a 401 benches a key from one API family only, a 429 from all"""
+    print("\n🔑 Testing API Key Pool...")
+    engine = load_engine()
+    reset_engine(engine)
+    sent = []  # (url, key)
+
+    def fetch(url, key, timeout):
+        sent.append((url, key))
+        if "/data/3.0/onecall" in url:
+            status, body = 401, {"cod": 401, "message": "Invalid API key"}  # free keys lack One Call 3.0
+        elif "q=rome" in url and not any("q=rome" in earlier for earlier, _ in sent[:-1]):
+            status, body = 429, {"cod": 429, "message": "Too many requests"}
+        else:
+            status, body = 200, weather_payload(url.split("q=")[1].split("&")[0].title(), "FR", 2988507)
+        return httpx.Response(status, content=json.dumps(body).encode(), request=httpx.Request("GET", url))
+
+    keys, original = engine._api_keys[:], engine.fetch_upstream
+    engine._api_keys[:] = [engine.ApiKeyState("key-aaaa"), engine.ApiKeyState("key-bbbb")]
+    engine.fetch_upstream = fetch
+    try:
+        # Rotation: the key with the most quota left takes the next call
+        for city in ["Lyon", "Nice", "Lille", "Metz"]:
+            assert fetch_weather(engine, city)[0]
+        assert sorted(key for _, key in sent) == ["key-aaaa", "key-aaaa", "key-bbbb", "key-bbbb"]
+
+        # One Call refuses both keys, which stay in rotation for current weather
+        sent.clear()
+        assert "Error" in engine.get_weather_alerts("51.5,-0.12")
+        assert [key for url, key in sent if "onecall" in url] in (["key-aaaa", "key-bbbb"], ["key-bbbb", "key-aaaa"])
+        sent.clear()
+        assert json.loads(asyncio.run(engine.get_current_weather(city="Paris", output_format="json")))["name"] == "Paris"
+        assert len(sent) == 1 and "/weather?q=paris" in sent[0][0]
+        sent.clear()
+        assert "benched for onecall" in engine.get_weather_alerts("51.5,-0.12")
+        assert sent == []  # no request while every key is benched from One Call
+        usage = {entry["key"]: entry for entry in engine.api_key_usage()}
+        assert usage["…aaaa"]["benched_for"] == 0 and set(usage["…aaaa"]["benched_families"]) == {"onecall"}
+
+        # A 429 benches the key from every family; the call is retried on the next key
+        assert fetch_weather(engine, "Rome")[0]
+        (_, throttled), (_, other) = sent
+        assert throttled != other
+        usage = {entry["key"]: entry for entry in engine.api_key_usage()}
+        assert usage[f"…{throttled[-4:]}"]["benched_for"] > 0 and usage[f"…{other[-4:]}"]["benched_for"] == 0
+        sent.clear()
+        for city in ["Tours", "Brest"]:
+            assert fetch_weather(engine, city)[0]
+        assert [key for _, key in sent] == [other, other]
+    finally:
+        engine._api_keys[:] = keys
+        engine.fetch_upstream = original
+
+    print("   ✅ Keys rotated, One Call 401s left current weather alone, a 429 moved calls to the next key")
+
+def test_alert_watcher():
+    """Watched cities answer from the store, and polls record new, changed and expired alerts"""
+    print("\n🔭 Testing Alert Watcher...")
+    engine = load_engine()
+    reset_engine(engine)
+    now = int(time.time())
+    flood = {"sender_name": "Met Office", "event": "Flood Warning", "start": now - 3600, "end": now + 7200,
+             "description": "River levels rising"}
+    wind = {"sender_name": "Met Office", "event": "Wind Warning", "start": now, "end": now + 3600,
+            "description": "Gusts up to 70 mph"}
+    upstream = {"alerts": [flood]}
+
+    with stub_upstream(engine, lambda url: (200, upstream)) as requested:
+        cursor = json.loads(engine.get_alert_changes(output_format="json"))["cursor"]
+        assert json.loads(engine.watch_weather_alerts("51.5,-0.12", output_format="json"))["watching"]
+        assert len(requested) == 1 and "/data/3.0/onecall" in requested[0]
+        thread = engine._alert_thread
+        watch = engine._alert_watches[engine.parse_location("51.5,-0.12").key]
+
+        # Answered from the store without an upstream call
+        report = json.loads(engine.get_weather_alerts("51.5,-0.12", output_format="json"))
+        assert [alert["event"] for alert in report["alerts"]] == ["Flood Warning"]
+        assert len(requested) == 1
+
+        # The same alerts again record nothing; new text is a change; an ended alert expires
+        assert engine.poll_alert_watch(watch) == 0
+        upstream["alerts"] = [dict(flood, description="River levels still rising")]
+        assert engine.poll_alert_watch(watch) == 1
+        upstream["alerts"] = [dict(flood, end=now - 60), wind]
+        assert engine.poll_alert_watch(watch) == 2
+        changes = json.loads(engine.get_alert_changes(since=cursor, output_format="json"))["changes"]
+        assert [(change["kind"], change["alert"]["event"]) for change in changes] == [
+            ("new", "Flood Warning"), ("changed", "Flood Warning"), ("new", "Wind Warning"), ("expired", "Flood Warning"),
+        ]
+        report = json.loads(engine.get_weather_alerts("51.5,-0.12", output_format="json"))
+        assert [alert["event"] for alert in report["alerts"]] == ["Wind Warning"]
+
+        # Unwatching a city that isn't watched does not wake the watcher into a poll
+        sent = len(requested)
+        assert "not being watched" in engine.watch_weather_alerts("48.85,2.35", enabled=False)
+        time.sleep(0.2)
+        assert len(requested) == sent and thread.is_alive()
+
+        # Removing the last watch lets the thread exit
+        assert "Stopped watching" in engine.watch_weather_alerts("51.5,-0.12", enabled=False)
+        thread.join(5)
+        assert not thread.is_alive() and engine._alert_thread is None
+        assert len(requested) == sent
+
+    print("   ✅ 4 alert changes recorded from 4 polls; the watcher exited with its last watch")
+
+def test_tile_cache():
+    """Map tiles: LRU eviction by bytes, lifetimes, stale fallback, unreadable files and neighbor prefetch"""
+    print("\n🗺️ Testing Map Tile Cache...")
+    engine = load_engine()
+
+    # LRU by total bytes; a lookup makes a tile recently used
+    cache = engine.TileCache(tempfile.mkdtemp(), max_bytes=250)
+    for name in "abc":
+        cache.put(f"{name}.png", name.encode() * 100)
+    assert list(cache.entries) == ["b.png", "c.png"] and not os.path.exists(os.path.join(cache.root, "a.png"))
+    assert cache.get("b.png") is not None
+    cache.put("d.png", b"d" * 100)
+    assert list(cache.entries) == ["b.png", "d.png"] and cache.size == 200 and cache.stats["evicted"] == 2
+
+    # Empty bodies are not cached; a file evicted or emptied under a reader is a miss
+    cache.put("e.png", b"")
+    assert "e.png" not in cache.entries
+    os.remove(os.path.join(cache.root, "b.png"))
+    assert cache.read("b.png") is None and "b.png" not in cache.entries and cache.size == 100
+    open(os.path.join(cache.root, "f.png"), "wb").close()
+    reopened = engine.TileCache(cache.root, max_bytes=250)
+    assert reopened.read("f.png") is None and list(reopened.entries) == ["d.png"]
+    assert reopened.read("d.png")[0] == b"d" * 100
+
+    upstream = {"status": 200, "body": b"\x89PNG tile"}
+    requested = []
+
+    def fetch(url, key, timeout):
+        requested.append(url)
+        return httpx.Response(upstream["status"], content=upstream["body"], request=httpx.Request("GET", url))
+
+    original = (engine._tile_cache, engine.fetch_upstream, engine.TILE_PREFETCH_RADIUS)
+    engine._tile_cache = engine.TileCache(tempfile.mkdtemp(), max_bytes=1 << 20)
+    engine.fetch_upstream = fetch
+    engine.TILE_PREFETCH_RADIUS = 0
+    try:
+        # Fetched once, then served from disk until the layer's lifetime runs out
+        assert engine.load_tile("clouds", 3, 2, 1)[::2] == (True, "upstream")
+        success, image, source = engine.load_tile("clouds", 3, 2, 1)
+        assert (success, source, image.data) == (True, "cache", b"\x89PNG tile") and len(requested) == 1
+        relative = engine.tile_path("clouds", 3, 2, 1)
+        size, _ = engine._tile_cache.entries[relative]
+        engine._tile_cache.entries[relative] = (size, time.time() - engine.TILE_LAYER_TTLS["clouds"] - 1)
+
+        # An expired tile is served stale when the refresh fails or comes back empty
+        upstream.update(status=500, body=b"")
+        assert engine.load_tile("clouds", 3, 2, 1)[::2] == (True, "stale")
+        upstream.update(status=200, body=b"")
+        success, image, source = engine.load_tile("clouds", 3, 2, 1)
+        assert (success, source, image.data) == (True, "stale", b"\x89PNG tile") and len(requested) == 3
+        success, error, source = engine.load_tile("clouds", 3, 5, 5)
+        assert (success, source) == (False, "error") and "Empty response" in error
+        assert engine.tile_path("clouds", 3, 5, 5) not in engine._tile_cache.entries
+
+        # The 8 neighbors are prefetched in the background, wrapping around the antimeridian
+        upstream.update(status=200, body=b"\x89PNG tile")
+        engine.TILE_PREFETCH_RADIUS = 1
+        requested.clear()
+        assert engine.get_weather_map_tile("temp", 2, 0, 1).data == b"\x89PNG tile"
+        deadline = time.time() + 5
+        while engine._tile_prefetching and time.time() < deadline:
+            time.sleep(0.01)
+        neighbors = {(x, y) for x in (3, 0, 1) for y in (0, 1, 2)} - {(0, 1)}
+        assert all(engine.tile_path("temp", 2, x, y) in engine._tile_cache.entries for x, y in neighbors)
+        assert len(requested) == 9 and engine._tile_cache.stats["prefetched"] == 8
+        assert engine.schedule_tile_prefetch("temp", 2, 0, 1) == 0
+    finally:
+        engine._tile_cache, engine.fetch_upstream, engine.TILE_PREFETCH_RADIUS = original
+
+    print("   ✅ LRU, lifetimes, stale fallback and 8 prefetched neighbors behaved")
+
+def forecast_payload(name, country, points=16, start=1700000000):
+    """A minimal /forecast response body with 3-hour points"""
+    return {
+        "city": {"name": name, "country": country, "timezone": 3600},
+        "list": [
+            {
+                "dt": start + i * 10800,
+                "main": {"temp": 50.0 + i, "humidity": 60},
+                "wind": {"speed": 4.0 + i / 10},
+                "weather": [{"main": "Clouds" if i % 3 else "Rain", "description": "broken clouds" if i % 3 else "light rain"}],
+            }
+            for i in range(points)
+        ],
+    }
+
+def test_hash_ring():
+    """Adding a replica only moves keys to it, about 1/N of them"""
+    print("\n🧭 Testing Shard Ring...")
+    engine = load_engine()
+    keys = [f"london,gb-{i}" for i in range(4000)]
+    old = engine.HashRing(["http://a", "http://b", "http://c"])
+    new = engine.HashRing(["http://a", "http://b", "http://c", "http://d"])
+
+    moved = [key for key in keys if next(old.successors(key)) != next(new.successors(key))]
+    assert all(next(new.successors(key)) == "http://d" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35, len(moved)
+    shares = new.shares()
+    assert abs(sum(shares.values()) - 1) < 1e-9
+    assert abs(shares["http://d"] - len(moved) / len(keys)) < 0.05
+
+    # Successors list every replica once, owner first; without the owner its keys go to the next one
+    order = list(new.successors(keys[0]))
+    assert sorted(order) == ["http://a", "http://b", "http://c", "http://d"]
+    survivors = engine.HashRing([node for node in new.nodes if node != order[0]])
+    assert next(survivors.successors(keys[0])) == order[1]
+
+    print(f"   ✅ Adding a 4th replica moved {len(moved) / len(keys):.0%} of keys, all to the new one")
+
+def test_wire_format():
+    """Cached payloads, columnar series included, survive the peer wire format"""
+    print("\n🧵 Testing Peer Wire Format...")
+    engine = load_engine()
+    forecast = engine.decode_payload(f"{engine.BASE_URL}/forecast?q=oslo&units=metric",
+                                     json.dumps(forecast_payload("Oslo", "NO")).encode())
+    pollution = engine.decode_payload(
+        "http://api.openweathermap.org/data/2.5/air_pollution/forecast?lat=59.9&lon=10.8",
+        json.dumps({"coord": {"lat": 59.9, "lon": 10.8}, "list": [
+            {"dt": 1700000000 + i * 3600, "main": {"aqi": 1 + i % 5}, "components": {"pm2_5": 3.5 * i}} for i in range(24)
+        ]}).encode(),
+    )
+    assert isinstance(forecast["series"], engine.ForecastSeries)
+    assert isinstance(pollution["series"], engine.PollutionSeries)
+
+    for payload in (forecast, pollution, weather_payload("Oslo", "NO", 3143244), [{"name": "Oslo"}]):
+        restored = engine.from_wire(json.loads(json.dumps(engine.to_wire(payload))))
+        assert restored == payload
+    restored = engine.from_wire(json.loads(json.dumps(engine.to_wire(forecast))))["series"]
+    assert type(restored) is engine.ForecastSeries
+    assert [column.typecode for column in restored[:5]] == ["q", "d", "d", "d", "H"]
+    assert engine.parse_forecast({"city": forecast["city"], "series": restored}) == engine.parse_forecast(forecast)
+
+    print("   ✅ Forecast and air quality series round-tripped with their array types")
+
+def test_peer_forwarding():
+    """A miss for a key owned by a peer is fetched by that peer and returned over the wire"""
+    print("\n📨 Testing Peer Forwarding...")
+    engine = load_engine()
+    reset_engine(engine)
+    server = engine.ThreadingHTTPServer(("127.0.0.1", 0), engine.ShardRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    peer = f"http://127.0.0.1:{server.server_address[1]}"
+    saved = engine._shard_ring, engine.SHARD_SELF, engine.SHARD_SECRET
+    engine.SHARD_SELF = "http://127.0.0.1:9"  # never contacted: it only owns keys
+    engine.SHARD_SECRET = "s3cret"
+    engine._shard_ring = engine.HashRing([engine.SHARD_SELF, peer])
+    engine._peer_down_until.clear()
+    before = engine.shard_stats()
+    try:
+        key = next(f"city{i}" for i in range(1000) if next(engine._shard_ring.successors(f"city{i}")) == peer)
+        url = f"{engine.BASE_URL}/forecast?q={key}&units={engine.UNITS}"
+        with stub_upstream(engine, lambda url: (200, forecast_payload(key.title(), "NO"))) as requested:
+            success, data = engine.make_http_request(url, timeout=5, location_key=key)
+        assert success, data
+        assert requested == [url]  # fetched once, by the peer
+        assert isinstance(data["series"], engine.ForecastSeries) and data["city"]["name"] == key.title()
+        stats = engine.shard_stats() - before
+        assert (stats["forwarded"], stats["served"], stats["peer errors"]) == (1, 1, 0)
+
+        # The endpoint checks the token and only fetches unsigned OpenWeatherMap URLs
+        endpoint = f"{peer}{engine.SHARD_PATH}"
+        assert httpx.get(endpoint, params={"url": url}, headers={"X-Shard-Token": "wrong"}).status_code == 403
+        assert httpx.get(endpoint, params={"url": "http://example.com/"}, headers={"X-Shard-Token": "s3cret"}).status_code == 400
+        peek = httpx.get(endpoint, params={"url": url, "peek": "1"}, headers={"X-Shard-Token": "s3cret"}).json()
+        assert engine.from_wire(peek["data"]) == data and 0 < peek["ttl"] <= engine.CACHE_TTL
+
+        # An unreachable owner is skipped, the key is fetched here and the peer reported as down
+        dead = "http://127.0.0.1:1"
+        engine._shard_ring = engine.HashRing([engine.SHARD_SELF, dead])
+        key = next(f"town{i}" for i in range(1000) if next(engine._shard_ring.successors(f"town{i}")) == dead)
+        url = f"{engine.BASE_URL}/forecast?q={key}&units={engine.UNITS}"
+        with stub_upstream(engine, lambda url: (200, forecast_payload(key.title(), "NO"))) as requested:
+            assert engine.make_http_request(url, timeout=1, location_key=key)[0]
+        assert requested == [url] and not engine.peer_alive(dead)
+        assert 0 < engine.peer_retry_in(dead) <= engine.SHARD_RETRY_SECONDS
+        assert f"{dead}: " in engine.shard_membership() and "unreachable, retry in" in engine.shard_membership()
+        assert (engine.shard_stats() - before)["peer errors"] == 1
+    finally:
+        engine._shard_ring, engine.SHARD_SELF, engine.SHARD_SECRET = saved
+        server.shutdown()
+        server.server_close()
+
+    # Without a secret the peer endpoint only starts on loopback
+    assert engine.is_loopback_host("127.0.0.1") and engine.is_loopback_host("::1") and engine.is_loopback_host("localhost")
+    assert not engine.is_loopback_host("10.0.0.5") and not engine.is_loopback_host("replica-1.internal")
+
+    print("   ✅ Miss forwarded to its owner, fetched once and returned as a ForecastSeries")
+
+OFFLINE_TESTS = [
+    test_location_aliases,
+    test_city_index,
+    test_history_rollups,
+    test_group_batching,
+    test_recommendation_rules,
+    test_precomputed_recommendations,
+    test_api_key_pool,
+    test_alert_watcher,
+    test_tile_cache,
+    test_hash_ring,
+    test_wire_format,
+    test_peer_forwarding,
+]
+
+def run_offline_tests():
+    """Run the offline engine tests, reporting failures instead of raising"""
+    passed = 0
+    for test in OFFLINE_TESTS:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"   ❌ {test.__name__}: {type(e).__name__} {e}")
+    print(f"\n📊 Offline engine tests: {passed}/{len(OFFLINE_TESTS)} passed")
+    return passed == len(OFFLINE_TESTS)
+
 def main():
     """Run all OpenWeather tests"""
     print("🌦️  OpenWeather MCP Server - Focused Test Suite")
@@ -190,7 +937,9 @@ def main():
     status_ok = test_openweather_status()
     weather_ok = test_current_weather()
     forecast_ok = test_weather_forecast()
+    batch_ok = test_forecast_batch()
     error_ok = test_error_handling()
+    offline_ok = run_offline_tests()
     
     # Summary
     print("\n" + "=" * 60)
@@ -198,9 +947,11 @@ def main():
     print(f"   Status Check: {'✅' if status_ok else '❌'}")
     print(f"   Current Weather: {'✅' if weather_ok else '❌'}")
     print(f"   Weather Forecast: {'✅' if forecast_ok else '❌'}")
+    print(f"   Batch Forecast: {'✅' if batch_ok else '❌'}")
     print(f"   Error Handling: {'✅' if error_ok else '❌'}")
+    print(f"   Offline Engine: {'✅' if offline_ok else '❌'}")
     
-    if all([status_ok, weather_ok, forecast_ok, error_ok]):
+    if all([status_ok, weather_ok, forecast_ok, batch_ok, error_ok, offline_ok]):
         print("\n🎉 All OpenWeather tests passed!")
         return True
     else: